@@ -0,0 +1,229 @@
+"""The shared clients, caches and chain of the application, and their startup in the background."""
+import asyncio
+import logging
+import time
+from typing import Callable
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class AppServices:
+    """Everything the endpoints share, built once per worker by build_services."""
+
+    def __init__(self, **services):
+        self.chat_options = services["chat_options"]
+        self.chat_batch_options = services["chat_batch_options"]
+        self.embedding_cache = services["embedding_cache"]
+        self.client_registry = services["client_registry"]
+        self.retrieval_cache = services["retrieval_cache"]
+        self.ratings_mirror = services["ratings_mirror"]
+        self.chat_builder = services["chat_builder"]
+        self.model_router = services["model_router"]
+        self.chain = services["chain"]
+        self.chat_coalescer = services["chat_coalescer"]
+        self.rating_queue = services["rating_queue"]
+        self.warmup = services["warmup"]
+
+    async def astart(self):
+        """Starts the background work of the services."""
+        await self.chat_builder.astart()
+        await self.rating_queue.astart()
+        if self.ratings_mirror:
+            await self.ratings_mirror.astart()
+
+    async def awarm(self):
+        """Opens the upstream connections and primes the caches, see Warmup."""
+        await self.warmup.arun()
+
+    def warmup_status(self) -> dict:
+        """Returns the status of every warmup step."""
+        return self.warmup.status()
+
+    async def aclose(self):
+        """Stops the background work and closes the shared clients."""
+        if self.ratings_mirror:
+            await self.ratings_mirror.aclose()
+        await self.rating_queue.aclose()
+        await self.client_registry.aclose()
+        await self.chat_builder.aclose()
+        self.embedding_cache.close()
+
+def build_services() -> AppServices:
+    """Builds the services from the configuration. The LangChain, OpenAI and Azure modules
+        are imported here rather than at the top, so the worker answers probes while they load."""
+    # pylint: disable=import-outside-toplevel
+    from libs.core.approaches.chat_conversation import build_chain
+    from libs.core.approaches.model_router import ModelRouter
+    from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+    from libs.core.services.client_registry import ClientRegistry
+    from libs.core.services.embedding_cache import EmbeddingCache
+    from libs.core.services.metrics import (
+        REGISTRY,
+        cache_collector,
+        model_router_collector,
+        rating_queue_collector,
+        ratings_mirror_collector,
+        resilience_collector
+    )
+    from libs.core.services.rating_queue import RatingQueue
+    from libs.core.services.ratings_mirror import RatingsMirror
+    from libs.core.services.request_coalescer import RequestCoalescer, config_fingerprint
+    from libs.core.services.resilience import Resilience
+    from libs.core.services.retrieval_cache import RetrievalCache
+    from libs.core.services.stage_metrics import StageMetricsHandler
+    from libs.core.services.tracing import configure_tracing
+    from libs.core.services.warmup import Warmup
+    # pylint: enable=import-outside-toplevel
+
+    chat_options = config.chat_options
+    multi_index_options = config.multi_index_options
+    ratings_mirror_options = config.ratings_mirror_options
+    model_router_options = config.model_router_options
+
+    resilience = Resilience(config.resilience_options)
+    embedding_cache = EmbeddingCache.from_options(config.embedding_cache_options)
+    client_registry = ClientRegistry(
+        multi_index_options, embedding_cache=embedding_cache, resilience=resilience)
+    retrieval_cache = RetrievalCache(config.retrieval_cache_options)
+    ratings_mirror = RatingsMirror(
+        options = ratings_mirror_options,
+        client_registry = client_registry,
+        index_name = chat_options.rated_answer_options.index_name
+    ) if ratings_mirror_options.enabled else None
+    chat_builder = MultiIndexChatBuilder(
+        multi_index_options = multi_index_options,
+        client_registry = client_registry,
+        ratings_mirror = ratings_mirror,
+        retrieval_cache = retrieval_cache
+    )
+    model_router = ModelRouter(
+        options = model_router_options,
+        builder = chat_builder,
+        system_prompt = chat_options.system_prompt
+    ) if model_router_options.enabled and model_router_options.routes else None
+    chain = build_chain(
+        builder=chat_builder,
+        chat_options=chat_options,
+        model_router=model_router
+    ).with_config(callbacks=[StageMetricsHandler()])
+    chat_coalescer = RequestCoalescer(
+        options = config.request_coalescing_options,
+        fingerprint = config_fingerprint(chat_options, multi_index_options)
+    )
+    rating_queue = RatingQueue(
+        options = config.rating_queue_options,
+        client_registry = client_registry,
+        index_name = chat_options.rated_answer_options.index_name,
+        upstream = resilience.upstream("ratings")
+    )
+
+    warmup = Warmup(
+        options = config.warmup_options,
+        builder = chat_builder,
+        client_registry = client_registry,
+        rated_answer_options = chat_options.rated_answer_options
+    )
+
+    configure_tracing(config.telemetry_options.opentelemetry_enabled)
+    REGISTRY.register_collector(cache_collector("embeddings", embedding_cache.stats))
+    REGISTRY.register_collector(cache_collector("sas_tokens", lambda: chat_builder.stats()["sas_tokens"]))
+    REGISTRY.register_collector(cache_collector("retrieval", retrieval_cache.stats))
+    REGISTRY.register_collector(cache_collector("chat_results", chat_coalescer.stats))
+    REGISTRY.register_collector(rating_queue_collector(rating_queue.stats))
+    REGISTRY.register_collector(resilience_collector(resilience.stats))
+    if model_router:
+        REGISTRY.register_collector(model_router_collector(model_router.stats))
+    if ratings_mirror:
+        REGISTRY.register_collector(ratings_mirror_collector(ratings_mirror.stats))
+
+    return AppServices(
+        chat_options = chat_options,
+        chat_batch_options = config.chat_batch_options,
+        embedding_cache = embedding_cache,
+        client_registry = client_registry,
+        retrieval_cache = retrieval_cache,
+        ratings_mirror = ratings_mirror,
+        chat_builder = chat_builder,
+        model_router = model_router,
+        chain = chain,
+        chat_coalescer = chat_coalescer,
+        rating_queue = rating_queue,
+        warmup = warmup
+    )
+
+class ServicesStartup:
+    """Builds, starts and warms the services on a background task once the worker started.
+
+        The services are built on a thread, so the event loop keeps answering probes while
+        the heavy modules are imported. Requests wait until the services are built. The
+        startup is ready once the warmup finished, or gave up the steps which kept failing."""
+
+    def __init__(self, factory: Callable[[], AppServices] = build_services):
+        self._factory = factory
+        self._services: AppServices | None = None
+        self._built: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._state = "stopped"
+        self._error: str | None = None
+        self._timings = {}
+
+    @property
+    def ready(self) -> bool:
+        """Whether the services are built, started and their clients are warm."""
+        return self._state == "ready"
+
+    def start(self):
+        """Starts building the services on the running event loop."""
+        self._built = asyncio.Event()
+        self._state = "building"
+        self._task = asyncio.create_task(self._run())
+
+    async def _timed(self, phase: str, work):
+        start = time.perf_counter()
+        result = await work
+        self._timings[f"{phase}_seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    async def _run(self):
+        try:
+            services = await self._timed("build", asyncio.to_thread(self._factory))
+            await self._timed("start", services.astart())
+        except Exception as error: # pylint: disable=broad-except
+            logger.exception("The services failed to start")
+            self._state, self._error = "failed", repr(error)
+            self._built.set()
+            return
+        self._services = services
+        self._built.set()
+
+        self._state = "warming"
+        try:
+            await self._timed("warm", services.awarm())
+        except Exception: # pylint: disable=broad-except
+            logger.exception("The warmup failed, reporting ready without it")
+        self._state = "ready"
+
+    async def aget(self) -> AppServices:
+        """Returns the services, once they are built. Raises RuntimeError when they failed to start."""
+        if self._built is None:
+            raise RuntimeError("The services were not started")
+        await self._built.wait()
+        if self._services is None:
+            raise RuntimeError(f"The services failed to start: {self._error}")
+        return self._services
+
+    def status(self) -> dict:
+        """Returns the state of the startup, the duration of its phases, the status of
+            the warmup steps and why the services failed to start."""
+        warmup = self._services.warmup_status() if self._services else {}
+        return {"status": self._state, **self._timings, "warmup": warmup, "error": self._error}
+
+    async def aclose(self):
+        """Stops the startup if it is still running and closes the services."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._services:
+            await self._services.aclose()
+        self._state = "stopped"
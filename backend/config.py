@@ -1,15 +1,55 @@
-""" Configuration file for the chat application """
+""" Configuration file for the chat application.
+    The configuration is loaded, and each options object built, when it is first used,
+    so importing this module reads no files and builds nothing. """
+from functools import lru_cache
 from libs.core.models.options import (
+    ChatBatchOptions,
+    ChatConversationOptions,
+    EmbeddingCacheOptions,
+    ModelRouterOptions,
     MultiIndexVectorStoreOptions,
+    RatingQueueOptions,
+    RatingsMirrorOptions,
+    DeadlineOptions,
+    RequestCoalescingOptions,
+    ResilienceOptions,
+    RetrievalCacheOptions,
+    TelemetryOptions,
     VectorStoreOptions,
+    WarmupOptions,
     OpenAIOptions,
 )
 from settings_factory import load_config
 
-from libs.core.approaches.chat_conversation import ChatConversationOptions
+_OPTIONS = {
+    "vector_store_options": VectorStoreOptions,
+    "openai_options": OpenAIOptions,
+    "chat_options": ChatConversationOptions,
+    "multi_index_options": MultiIndexVectorStoreOptions,
+    "embedding_cache_options": EmbeddingCacheOptions,
+    "rating_queue_options": RatingQueueOptions,
+    "model_router_options": ModelRouterOptions,
+    "ratings_mirror_options": RatingsMirrorOptions,
+    "request_coalescing_options": RequestCoalescingOptions,
+    "retrieval_cache_options": RetrievalCacheOptions,
+    "chat_batch_options": ChatBatchOptions,
+    "telemetry_options": TelemetryOptions,
+    "warmup_options": WarmupOptions,
+    "resilience_options": ResilienceOptions,
+    "deadline_options": DeadlineOptions,
+}
 
-config = load_config()
-vector_store_options = VectorStoreOptions.from_settings(config)
-openai_options = OpenAIOptions.from_settings(config)
-chat_options = ChatConversationOptions.from_settings(config)
-multi_index_options = MultiIndexVectorStoreOptions.from_settings(config)
+@lru_cache(maxsize=None)
+def get_config() -> dict:
+    """Loads the configuration file and the environment on first use."""
+    return load_config()
+
+def __getattr__(name: str):
+    """Builds the options object on first access, e.g. config.chat_options, and keeps it."""
+    if name == "config":
+        return get_config()
+    options_type = _OPTIONS.get(name)
+    if options_type is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    options = globals()[name] = options_type.from_settings(get_config())
+    return options
@@ -0,0 +1,82 @@
+"""Answering many questions at once, such as evaluation and regression sets."""
+import asyncio
+from collections import deque
+from typing import AsyncIterator, List, Tuple
+
+from langchain_core.runnables import Runnable
+
+from libs.core.approaches.chat_conversation import LLM_LIMITER, SEARCH_LIMITER
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import ChatBatchOptions
+
+async def _answer(
+    chain: Runnable,
+    inputs: dict,
+    config: dict,
+    limiter: asyncio.Semaphore
+) -> Tuple[dict | None, Exception | None]:
+    async with limiter:
+        try:
+            return await chain.ainvoke(inputs, config), None
+        except Exception as error: # pylint: disable=broad-except
+            return None, error
+
+async def aanswer_batch(
+    chain: Runnable,
+    builder: MultiIndexChatBuilder,
+    questions: List[str],
+    batch_options: ChatBatchOptions
+) -> AsyncIterator[Tuple[int, dict | None, Exception | None]]:
+    """ Runs every question through the chain built by build_chain and yields
+        (index, output, error) in input order, with either the output or the error set.
+        The questions are embedded in batches of embedding_batch_size, and at most
+        max_concurrency questions, max_search_concurrency index searches and
+        max_llm_concurrency LLM calls are in flight at once. Only a window of the
+        results is held in memory, so the batch can be streamed out as it completes."""
+    config = {"configurable": {
+        SEARCH_LIMITER: asyncio.Semaphore(batch_options.max_search_concurrency),
+        LLM_LIMITER: asyncio.Semaphore(batch_options.max_llm_concurrency),
+    }}
+    limiter = asyncio.Semaphore(batch_options.max_concurrency)
+    window = max(batch_options.embedding_batch_size, batch_options.max_concurrency)
+    pending = deque()
+    index = 0
+
+    try:
+        for start in range(0, len(questions), batch_options.embedding_batch_size):
+            batch = questions[start:start + batch_options.embedding_batch_size]
+            try:
+                embeddings = await builder.aembed_questions(batch)
+            except Exception: # pylint: disable=broad-except
+                # The chain embeds each question of a failed batch on its own instead.
+                embeddings = [None] * len(batch)
+
+            for question, embedding in zip(batch, embeddings):
+                inputs = {"question": question}
+                if embedding:
+                    inputs["embedding"] = embedding
+                pending.append(asyncio.create_task(_answer(chain, inputs, config, limiter)))
+
+            while len(pending) > window:
+                yield (index, *await pending.popleft())
+                index += 1
+
+        while pending:
+            yield (index, *await pending.popleft())
+            index += 1
+    finally:
+        # Stops the remaining questions when the caller stops reading, e.g. on a disconnect.
+        for task in pending:
+            task.cancel()
+
+async def answer_batch(
+    chain: Runnable,
+    builder: MultiIndexChatBuilder,
+    questions: List[str],
+    batch_options: ChatBatchOptions
+) -> List[Tuple[dict | None, Exception | None]]:
+    """Runs every question through the chain and returns (output, error) for each, in input order."""
+    return [
+        (output, error)
+        async for _, output, error in aanswer_batch(chain, builder, questions, batch_options)
+    ]
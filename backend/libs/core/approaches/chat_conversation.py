@@ -1,50 +1,275 @@
 """Conversation logic for AI Chatbot."""
+from functools import cached_property, partial
 from operator import itemgetter
-from langchain_core.runnables import (RunnablePassthrough, RunnableParallel, RunnableLambda)
+from langchain_core.runnables import (
+    Runnable,
+    RunnableConfig,
+    RunnablePassthrough,
+    RunnableLambda
+)
 from langchain.output_parsers.openai_tools import JsonOutputKeyToolsParser
+from langchain_core.callbacks import BaseCallbackHandler
+from libs.core.approaches.model_router import THROTTLING_ERRORS, ModelRouter, classify_question
 from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
 from libs.core.models.options import ChatConversationOptions
 from libs.core.models.cited_answer import CitedAnswer
+from libs.core.services.context_packer import expand_citations
+from libs.core.services.deadline import DeadlineExceededError, deadline_of
+from libs.core.services.resilience import CIRCUIT_TRIAL, CircuitOpenError, Upstream
 
-def _route(options: ChatConversationOptions,
-    builder: MultiIndexChatBuilder,
+# Run name of the CitedAnswer output parser, used to pick its partial results out of a stream.
+CITED_ANSWER_PARSER = "cited_answer_parser"
+
+# Keys of the "configurable" run config entries holding the semaphores which bound
+# the concurrent index searches and LLM calls of a batch.
+SEARCH_LIMITER = "search_limiter"
+LLM_LIMITER = "llm_limiter"
+
+class _StageLambda(RunnableLambda):
+    """RunnableLambda whose dependencies are resolved once.
+        RunnableLambda reads the source of its function on every invocation to find
+        them, which costs more CPU than most of the stages themselves."""
+
+    @cached_property
+    def deps(self):
+        return super().deps
+
+def _route(answer_chain: Runnable,
+    default_answer: dict,
     context_info: dict):
     """Route the conversation based on the context variable."""
     if not context_info["context"]:
-        return builder.default_return_message(options.default_return_message)
+        return dict(default_answer)
+
+    return answer_chain
+
+async def _aroute(answer_chain: Runnable,
+    default_answer: dict,
+    context_info: dict,
+    config: RunnableConfig):
+    """Async version of _route. When the caller passed an LLM limiter,
+        the answer chain is run while holding it."""
+    routed = _route(answer_chain, default_answer, context_info)
+    limiter = config.get("configurable", {}).get(LLM_LIMITER)
+    if limiter is None or routed is not answer_chain:
+        return routed
+
+    async with limiter:
+        return await answer_chain.ainvoke(context_info, config)
+
+def _limited(afunc, limiter_name: str):
+    """Wraps an async stage so it waits for the named limiter, when the caller passed one.
+        The stage is called with the run config."""
+    async def limited(value, config: RunnableConfig):
+        limiter = config.get("configurable", {}).get(limiter_name)
+        if limiter is None:
+            return await afunc(value, config)
+        async with limiter:
+            return await afunc(value, config)
+
+    return limited
+
+def _get_documents(builder: MultiIndexChatBuilder, query: dict, config: RunnableConfig):
+    return builder.get_documents(query, deadline_of(config))
+
+async def _aget_documents(builder: MultiIndexChatBuilder, query: dict, config: RunnableConfig):
+    return await builder.aget_documents(query, deadline_of(config))
+
+def _token_budget(builder: MultiIndexChatBuilder, config: RunnableConfig) -> int | None:
+    deadline = deadline_of(config)
+    return deadline.context_token_budget(builder.context_token_budget) if deadline else None
+
+def _format_docs(builder: MultiIndexChatBuilder, docs, config: RunnableConfig):
+    return builder.format_docs(docs, _token_budget(builder, config))
+
+async def _aformat_docs(builder: MultiIndexChatBuilder, docs, config: RunnableConfig):
+    return await builder.aformat_docs(docs, _token_budget(builder, config))
+
+def _within_deadline(
+    upstream: Upstream,
+    llm: Runnable,
+    max_tokens: int | None,
+    prompt,
+    config: RunnableConfig):
+    """Calls the LLM with at most the time left until the deadline of the request, and
+        with fewer tokens when time is short. Raises DeadlineExceededError when too
+        little time is left to call it, and CircuitOpenError while the circuit of the
+        upstream is open. A trial call of the circuit is marked with its token."""
+    deadline = deadline_of(config)
+    if deadline is not None:
+        deadline.check_llm()
+    trial = upstream.check()
+    if trial is not None:
+        llm = llm.with_config(metadata={CIRCUIT_TRIAL: trial})
+    if deadline is None:
+        return llm
+    return llm.bind(max_tokens=deadline.max_tokens(max_tokens), timeout=deadline.remaining())
+
+def _with_packed_context(info: dict) -> dict:
+    """Moves the packed context and its sources up to where the prompt expects them."""
+    return info | info["packed_context"]
+
+def _finalize_answer(info: dict) -> dict:
+    """Puts the signed URLs back into the citations, and adds the indexes
+        which were left out of the context to the answer. An answer without
+        some of the indexes is marked as degraded."""
+    answer = info["answer"]
+    dropped_indexes = info["retrieval"]["dropped_indexes"]
+    return answer | {
+        "citations": expand_citations(answer["citations"], info["sources"]),
+        "dropped_indexes": dropped_indexes,
+        "classification": info.get("classification"),
+        "degraded": answer.get("degraded", False) or bool(dropped_indexes),
+    }
+
+def _route_rated_answer(documents_chain: Runnable, query: dict):
+    """Return the rated answer when one was found, otherwise answer from the documents."""
+    if query["rated_answer"]:
+        return query["rated_answer"]
+
+    return documents_chain
+
+def _check_circuit(upstream: Upstream, value):
+    """Fails fast with CircuitOpenError while the circuit of the upstream is open,
+        without taking the trial of a half open circuit, which is left to the LLM call."""
+    upstream.check(take_trial=False)
+    return value
+
+def _default_answer(default_answer: dict, _) -> dict:
+    """The default answer given instead of failing. It is marked as degraded, so it is
+        never reused for other requests."""
+    return dict(default_answer) | {"degraded": True}
+
+def _classify(query: dict) -> str:
+    return classify_question(query["question"])
+
+def _routed_answer_chain(
+    builder: MultiIndexChatBuilder,
+    chat_template: Runnable,
+    output_parser: Runnable,
+    model_router: ModelRouter,
+    upstream: Upstream,
+    circuit_recorder: BaseCallbackHandler | None) -> Runnable:
+    """The answer chain of every route, behind a stage which picks the route for the question.
+        When the chosen deployment throttles, the next route answers instead."""
+    answer_chains = {
+        route.deployment: chat_template
+            | _StageLambda(partial(_within_deadline, upstream,
+                builder.llm(route.deployment).bind_tools([CitedAnswer], tool_choice="CitedAnswer")
+                    .bind(max_tokens=route.max_tokens)
+                    .with_config(callbacks=[
+                        recorder for recorder in (model_router.recorder(route.deployment), circuit_recorder)
+                        if recorder]),
+                route.max_tokens), name="within_deadline")
+            | output_parser
+        for route in model_router.routes
+    }
+
+    def route_model(context_info: dict, config: RunnableConfig):
+        primary, *fallbacks = (
+            answer_chains[route.deployment]
+            for route in model_router.select(context_info, deadline_of(config)))
+        if not fallbacks:
+            return primary
+        return primary.with_fallbacks(fallbacks, exceptions_to_handle=THROTTLING_ERRORS)
+
+    return _StageLambda(route_model, name="route_model")
+
+def build_answer_chain(
+    builder: MultiIndexChatBuilder,
+    chat_options: ChatConversationOptions,
+    model_router: ModelRouter | None = None) -> Runnable:
+    """Building the chain that asks the LLM for a cited answer.
+        With a model router the deployment is chosen per question.
+        The LLM is not called while the circuit of the openai upstream is open."""
 
     # Creating a chat template with a system message and a human message.
     # Both messages are passed as templates.
-    
-    output_parser = JsonOutputKeyToolsParser(key_name="CitedAnswer", first_tool_only=True)
-    model = builder.llm()
+    chat_template = builder.chat_template(chat_options.system_prompt)
+    output_parser = JsonOutputKeyToolsParser(
+        key_name="CitedAnswer",
+        first_tool_only=True
+    ).with_config(run_name=CITED_ANSWER_PARSER)
+
+    upstream = builder.upstream("openai")
+    check_circuit = _StageLambda(partial(_check_circuit, upstream), name="check_circuit")
+    circuit_recorder = upstream.recorder()
+
+    if model_router:
+        return check_circuit | _routed_answer_chain(
+            builder, chat_template, output_parser, model_router, upstream, circuit_recorder)
 
-    llm_with_tool = model.bind_tools(
+    llm_with_tool = builder.llm().bind_tools(
         [CitedAnswer],
         tool_choice="CitedAnswer",
     )
+    if circuit_recorder:
+        llm_with_tool = llm_with_tool.with_config(callbacks=[circuit_recorder])
+    within_deadline = _StageLambda(
+        partial(_within_deadline, upstream, llm_with_tool, builder.max_tokens), name="within_deadline")
 
-    chat_template = builder.chat_template(options.system_prompt)
-    general_chain = chat_template | llm_with_tool | output_parser
-    return general_chain
+    return check_circuit | chat_template | within_deadline | output_parser
 
 def build_chain(
     builder: MultiIndexChatBuilder,
-    chat_options: ChatConversationOptions):
-    """Building the chain of runnables for the chat conversation."""
+    chat_options: ChatConversationOptions,
+    model_router: ModelRouter | None = None):
+    """Building the chain of runnables for the chat conversation.
+        The chain is stateless, so it is built once per process and shared by every request.
+        Every stage has an async implementation, so ainvoke never blocks the event loop.
+        While the circuit of an upstream is open, the default answer is returned at once.
+        A deadline passed in the run config shortens the searches, the context and the
+        LLM call, see Deadline."""
+
+    # Every index is searched in parallel; the ones that miss their deadline are dropped.
+    retrieval = RunnablePassthrough.assign(retrieval=_StageLambda(
+        partial(_get_documents, builder),
+        afunc=_limited(partial(_aget_documents, builder), SEARCH_LIMITER),
+        name="get_documents"))
+
+    # The best documents are packed into the token budget of the prompt.
+    context = RunnablePassthrough.assign(packed_context=itemgetter("retrieval")
+        | _StageLambda(builder.sort_and_filter_documents)
+        | _StageLambda(partial(_format_docs, builder), afunc=partial(_aformat_docs, builder),
+            name="format_docs")
+    ) | _StageLambda(_with_packed_context)
+
+    answer_chain = build_answer_chain(builder, chat_options, model_router)
+    default_answer = builder.default_return_message(chat_options.default_return_message)
+    route = _StageLambda(
+        partial(_route, answer_chain, default_answer),
+        afunc=partial(_aroute, answer_chain, default_answer),
+        name="route")
+
+    # The classification of the question is returned with the answer and steers the model router.
+    documents_chain = (RunnablePassthrough.assign(classification=_StageLambda(_classify))
+        | retrieval
+        | context
+        | RunnablePassthrough.assign(answer=route)
+        | _StageLambda(_finalize_answer))
+
+    # The question is embedded once, up front, and the vector is shared by every search.
+    # Batches embed their questions together and pass the embedding in with the question.
+    embedded_query = RunnablePassthrough.assign(
+        embedding=_StageLambda(builder.get_embedding, afunc=builder.aget_embedding))
+
+    fail_fast = {
+        "fallbacks": [_StageLambda(partial(_default_answer, default_answer), name="default_answer")],
+        "exceptions_to_handle": (CircuitOpenError, DeadlineExceededError),
+    }
 
-    docs = RunnableParallel(
-        {
-        "primary_documents": itemgetter("question") | RunnableLambda(builder.get_primary_documents),
-        "secondary_documents": itemgetter("question") | RunnableLambda(builder.get_secondary_documents)
-        })
+    rated_answer_options = chat_options.rated_answer_options
+    if not rated_answer_options.enabled:
+        return (embedded_query | documents_chain).with_fallbacks(**fail_fast)
 
-    filtered_docs = docs | RunnableLambda(builder.sort_and_filter_documents)
+    # Previously rated answers are checked before any index is searched or the LLM is called.
+    rated_answer = RunnablePassthrough.assign(
+        rated_answer=_StageLambda(
+            partial(builder.get_rated_answer, rated_answer_options),
+            afunc=partial(builder.aget_rated_answer, rated_answer_options),
+            name="get_rated_answer"))
 
-    chain = {"context" : filtered_docs | builder.format_docs,
-            "question": RunnablePassthrough() } | RunnableLambda(lambda info: _route(
-        options = chat_options,
-        builder = builder,
-        context_info = info))
+    chain = embedded_query | rated_answer | _StageLambda(
+        partial(_route_rated_answer, documents_chain), name="route_rated_answer")
 
-    return chain
+    return chain.with_fallbacks(**fail_fast)
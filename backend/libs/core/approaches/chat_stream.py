@@ -0,0 +1,32 @@
+"""Streaming of the cited answer while the LLM is still generating it."""
+from typing import AsyncIterator, Tuple
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from libs.core.approaches.chat_conversation import CITED_ANSWER_PARSER
+
+async def astream_answer(
+    chain: Runnable,
+    inputs: dict,
+    config: RunnableConfig | None = None
+) -> AsyncIterator[Tuple[str, object]]:
+    """Runs the chain and yields ("token", text) events for every new piece of the answer,
+        followed by a single ("answer", output) event with the complete chain output.
+        The answer is read from the partially parsed CitedAnswer tool call arguments,
+        so tokens are sent before the citations have been generated."""
+    streamed = ""
+    output = None
+    async for event in chain.astream_events(inputs, config, version="v2"):
+        if event["event"] == "on_parser_stream" and event["name"] == CITED_ANSWER_PARSER:
+            answer = (event["data"]["chunk"] or {}).get("answer") or ""
+            if len(answer) > len(streamed) and answer.startswith(streamed):
+                yield "token", answer[len(streamed):]
+                streamed = answer
+        elif event["event"] == "on_chain_end" and not event["parent_ids"]:
+            output = event["data"]["output"]
+
+    # Answers which do not come from the LLM, such as rated answers, arrive in one piece.
+    answer = output["answer"]
+    if len(answer) > len(streamed) and answer.startswith(streamed):
+        yield "token", answer[len(streamed):]
+    yield "answer", output
@@ -0,0 +1,169 @@
+"""Routing of the LLM call across several chat deployments."""
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from openai import RateLimitError
+
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import ModelRouteOptions, ModelRouterOptions
+from libs.core.services.deadline import Deadline
+from libs.core.services.embedding_cache import normalize_text
+from libs.core.services.metrics import LLM_ROUTED
+
+# Errors which move the call on to the next deployment.
+THROTTLING_ERRORS = (RateLimitError,)
+
+_CHIT_CHAT = {
+    "hi", "hello", "hey", "thanks", "thank you", "thanks a lot", "good morning",
+    "good afternoon", "good evening", "bye", "goodbye", "ok", "okay", "great", "cool",
+}
+_CONTINUATION_PREFIXES = ("continue", "go on", "tell me more", "more details", "and then", "what else")
+_STRUCTURED_MARKERS = (
+    "step by step", "steps", "list", "compare", "comparison", "difference between",
+    "vs", "versus", "table", "pros and cons",
+)
+# The markers match whole words only, so "vegetable" is not a table nor "footsteps" steps.
+_CONTINUATION = re.compile(rf"^(?:{'|'.join(map(re.escape, _CONTINUATION_PREFIXES))})\b")
+_STRUCTURED = re.compile(rf"\b(?:{'|'.join(map(re.escape, _STRUCTURED_MARKERS))})\b")
+
+def classify_question(question: str) -> str:
+    """A cheap classification of the question, which decides the deployments that may answer it.
+        Returns the name of its approach type, as listed in the approaches of the routes."""
+    text = normalize_text(question).strip(" ?!.")
+    if text in _CHIT_CHAT:
+        return "CHIT_CHAT"
+    if _CONTINUATION.search(text):
+        return "CONTINUATION"
+    if _STRUCTURED.search(text):
+        return "STRUCTURED"
+    return "UNSTRUCTURED"
+
+@dataclass
+class _DeploymentState:
+    latency_ewma: float | None = None
+    throttled_until: float = 0.0
+    calls: int = 0
+    throttles: int = 0
+
+class _DeploymentRecorder(BaseCallbackHandler):
+    """Reports the latency and throttling of the LLM calls of one deployment to the router."""
+
+    run_inline = True
+
+    def __init__(self, router: "ModelRouter", deployment: str):
+        self._router = router
+        self._deployment = deployment
+        self._starts: Dict[UUID, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs: Any):
+        self._starts[run_id] = time.monotonic()
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self._router.record_latency(self._deployment, time.monotonic() - start)
+
+    def on_llm_error(self, error, *, run_id, **kwargs: Any):
+        self._starts.pop(run_id, None)
+        if isinstance(error, THROTTLING_ERRORS):
+            self._router.record_throttle(self._deployment)
+
+class ModelRouter:
+    """Chooses the deployment which answers a question, with the others as fallbacks.
+
+        The routes are configured cheapest and fastest first. A route may answer when
+        it serves the classification of the question, the question is short enough for
+        it, the prompt plus max_tokens fits its context window and it is not throttled.
+        The first of those whose average latency is within its limit is used, or else
+        the one with the lowest average latency. When the deadline of the request is close,
+        the limit is at most the time left. A deployment which returned a 429 is
+        skipped for throttle_cooldown_seconds, and the call falls back to the next route."""
+
+    def __init__(self, options: ModelRouterOptions, builder: MultiIndexChatBuilder, system_prompt: str):
+        self._options = options
+        self._builder = builder
+        self._system_prompt_tokens = builder.count_tokens(system_prompt)
+        self._state = {route.deployment: _DeploymentState() for route in options.routes}
+        self._lock = threading.Lock()
+
+    @property
+    def routes(self) -> List[ModelRouteOptions]:
+        """The configured routes, in order of preference."""
+        return self._options.routes
+
+    def recorder(self, deployment: str) -> BaseCallbackHandler:
+        """The callback handler which reports the calls of the deployment to the router."""
+        return _DeploymentRecorder(self, deployment)
+
+    def record_latency(self, deployment: str, seconds: float):
+        """Updates the exponentially weighted average latency of the deployment."""
+        alpha = self._options.latency_ewma_alpha
+        with self._lock:
+            state = self._state[deployment]
+            state.calls += 1
+            state.latency_ewma = (seconds if state.latency_ewma is None
+                else alpha * seconds + (1 - alpha) * state.latency_ewma)
+
+    def record_throttle(self, deployment: str):
+        """Skips the deployment for the cooldown after it throttled a call."""
+        with self._lock:
+            state = self._state[deployment]
+            state.throttles += 1
+            state.throttled_until = time.monotonic() + self._options.throttle_cooldown_seconds
+
+    def _fits(self, route: ModelRouteOptions, prompt_tokens: int) -> bool:
+        return prompt_tokens + route.max_tokens <= route.context_window
+
+    def _latency(self, route: ModelRouteOptions) -> float:
+        latency = self._state[route.deployment].latency_ewma
+        return 0.0 if latency is None else latency
+
+    def _in_time(self, route: ModelRouteOptions, seconds_left: float | None) -> bool:
+        limits = [limit for limit in (route.max_latency_seconds, seconds_left) if limit is not None]
+        return not limits or self._latency(route) <= min(limits)
+
+    def select(self, context_info: dict, deadline: Deadline | None = None) -> List[ModelRouteOptions]:
+        """Returns the routes to try for the question and its packed context, best first."""
+        question = context_info["question"]
+        classification = context_info.get("classification") or classify_question(question)
+        question_tokens = self._builder.count_tokens(question)
+        prompt_tokens = (self._system_prompt_tokens + question_tokens
+            + self._builder.count_tokens(context_info.get("context", "")))
+        now = time.monotonic()
+
+        fitting = [route for route in self.routes if self._fits(route, prompt_tokens)] or list(self.routes)
+        available = [
+            route for route in fitting
+            if self._state[route.deployment].throttled_until <= now
+        ] or fitting
+        eligible = [
+            route for route in available
+            if classification in route.approaches
+            and (route.max_question_tokens is None or question_tokens <= route.max_question_tokens)
+        ] or available
+
+        seconds_left = deadline.remaining() if deadline and deadline.short else None
+        primary = next(
+            (route for route in eligible if self._in_time(route, seconds_left)),
+            min(eligible, key=self._latency))
+        LLM_ROUTED.inc(deployment=primary.deployment, classification=classification)
+        return [primary] + [route for route in available if route is not primary]
+
+    def stats(self) -> dict:
+        """Returns the average latency and throttling of every deployment."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                deployment: {
+                    "latency_ewma_seconds": state.latency_ewma,
+                    "throttled": state.throttled_until > now,
+                    "calls": state.calls,
+                    "throttles": state.throttles,
+                }
+                for deployment, state in self._state.items()
+            }
@@ -1,53 +1,113 @@
 """This module contains the MultiIndexChatBuilder class
 which is used to build a dynamic chat conversation"""
 
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from textwrap import dedent
+from time import monotonic
+from typing import List
 
 from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import AIMessage
 from langchain_core.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
     SystemMessagePromptTemplate,
 )
 
-from libs.core.models.options import MultiIndexVectorStoreOptions
+from libs.core.models.options import IndexOptions, MultiIndexVectorStoreOptions, RatedAnswerOptions
 from libs.core.services.search_vector_index_service import (
-    search,
-    generate_azure_search_client,
-    generate_embeddings
+    asearch_by_vector,
+    avector_search,
+    search_by_vector,
+    vector_search
 )
+from libs.core.services.client_registry import ClientRegistry
+from libs.core.services.context_packer import ContextPacker, TokenCounter, source_reference
+from libs.core.services.deadline import Deadline
+from libs.core.services.metrics import UPSTREAM_ERRORS
+from libs.core.services.near_duplicates import NearDuplicateFilter
+from libs.core.services.ratings_mirror import RatingsMirror
+from libs.core.services.resilience import Upstream
+from libs.core.services.retrieval_cache import RetrievalCache
+from libs.core.services.top_k_merge import merge_top_k
+from libs.core.services.tracing import observe
 from libs.core.services.sas_token_service import SasTokenService
 from libs.core.models.cited_answer import CitedAnswer
 
+logger = logging.getLogger(__name__)
+
+# The threads of the search pool kept for each index. A search which missed its deadline
+# keeps its thread until the SDK gives up after the read timeout of the search policy,
+# so an index only gets new searches while it holds fewer threads than this.
+SEARCH_THREADS_PER_INDEX = 4
+
 class MultiIndexChatBuilder:
     """Class used to help build a dynamic chat conversation."""
     def __init__(
             self,
-            multi_index_options: MultiIndexVectorStoreOptions
+            multi_index_options: MultiIndexVectorStoreOptions,
+            client_registry: ClientRegistry | None = None,
+            ratings_mirror: RatingsMirror | None = None,
+            retrieval_cache: RetrievalCache | None = None
         ):
-        self._primary_index_name = multi_index_options.primary_index_name
-        self._secondary_index_name = multi_index_options.secondary_index_name
+        self._indexes = multi_index_options.indexes
+        self._containers = {container for index in self._indexes for container in index.containers}
+        self._final_k = multi_index_options.final_k
+        self._min_reranker_score = multi_index_options.min_reranker_score
+        self._score_normalization = multi_index_options.score_normalization
+        deduplication = multi_index_options.deduplication
+        self._near_duplicates = NearDuplicateFilter(deduplication) if deduplication.enabled else None
+        self._fetch_k = self._final_k * deduplication.fetch_factor if deduplication.enabled else self._final_k
+        self._token_counter = TokenCounter(
+            multi_index_options.open_ai_options.ai_model_options.deployment_model)
+        self._context_packer = ContextPacker(
+            self._token_counter,
+            multi_index_options.context_token_budget,
+            multi_index_options.min_chunk_tokens)
         self._vector_store_options = multi_index_options.vector_store_options
         self._open_ai_options = multi_index_options.open_ai_options
         self._storage_account_options = multi_index_options.storage_account_options
         self._token_service = SasTokenService(multi_index_options.storage_account_options)
+        self._clients = client_registry or ClientRegistry(multi_index_options)
+        self._ratings_mirror = ratings_mirror
+        self._retrieval_cache = retrieval_cache
+        self._search = self.upstream("search")
+        self._executor = ThreadPoolExecutor(
+            max_workers=SEARCH_THREADS_PER_INDEX * len(self._indexes),
+            thread_name_prefix="index-search")
+        self._running_searches = {index.name: 0 for index in self._indexes}
+        self._running_lock = threading.Lock()
 
+    @property
+    def indexes(self) -> List[IndexOptions]:
+        """The indexes searched for documents."""
+        return self._indexes
 
-    def llm(self):
-        """Creates and returns an instance of a LLM class."""
-        open_ai_options = self._open_ai_options
-        api_options = open_ai_options.api_options
-        model_options = open_ai_options.ai_model_options
-        return AzureChatOpenAI(
-            openai_api_version=api_options.api_version,
-            azure_deployment=model_options.deployment_model,
-            azure_endpoint=api_options.endpoint,
-            api_key=api_options.api_key,
-            temperature=model_options.temperature,
-            max_tokens=model_options.max_tokens,
-            n=model_options.n,
-        )
+    def llm(self, deployment: str | None = None) -> AzureChatOpenAI:
+        """Returns the shared instance of the LLM class for the deployment,
+            by default the configured deployment."""
+        model_options = self._open_ai_options.ai_model_options
+        return self._clients.chat_model(deployment or model_options.deployment_model)
+
+    @property
+    def context_token_budget(self) -> int:
+        """The configured token budget of the context."""
+        return self._context_packer.token_budget
+
+    @property
+    def max_tokens(self) -> int | None:
+        """The configured max_tokens of the LLM calls."""
+        return self._open_ai_options.ai_model_options.max_tokens
+
+    def upstream(self, name: str) -> Upstream:
+        """Returns the upstream of the given name, with the policy its calls are made with."""
+        return self._clients.resilience.upstream(name)
+
+    def count_tokens(self, text: str) -> int:
+        """Counts the tokens of the text for the configured deployment."""
+        return self._token_counter.count(text)
 
     def chat_template(self, system_prompt):
         """Creates a chat template with a system message and a human message."""
@@ -60,50 +120,260 @@ class MultiIndexChatBuilder:
             ]
         )
 
-    def _get_documents(self, index_name: str, query: str):
-        embedding = generate_embeddings(self._open_ai_options)
-        client = generate_azure_search_client(
-            index_name = index_name,
-            vector_store_options = self._vector_store_options,
-            embedding_function = embedding)
-        return search(client, query, 10)
+    def embed_query(self, question: str) -> List[float]:
+        """Embeds the question once so the vector can be shared by every index search."""
+        with observe("embed_query", upstream="embeddings"):
+            return self._clients.embeddings().embed_query(question)
+
+    async def aembed_query(self, question: str) -> List[float]:
+        """Async version of embed_query."""
+        with observe("embed_query", upstream="embeddings"):
+            return await self._clients.embeddings().aembed_query(question)
+
+    async def aembed_questions(self, questions: List[str]) -> List[List[float]]:
+        """Embeds many questions with batched calls to the embedding model."""
+        with observe("embed_questions", upstream="embeddings"):
+            return await self._clients.embeddings().aembed_documents(questions)
+
+    def get_embedding(self, query: dict) -> List[float]:
+        """Returns the embedding passed in with the question, or embeds the question."""
+        return query.get("embedding") or self.embed_query(query["question"])
+
+    async def aget_embedding(self, query: dict) -> List[float]:
+        """Async version of get_embedding."""
+        return query.get("embedding") or await self.aembed_query(query["question"])
+
+    def fetch_size(self, index: IndexOptions) -> int:
+        """ The number of documents retrieved from an index. The merged top k never holds
+            more than final_k documents from one index, so retrieving more is wasted,
+            unless some are dropped as near-duplicates."""
+        return min(index.k, self._fetch_k)
+
+    def _get_documents(self, index: IndexOptions, query: dict):
+        client = self._clients.search_client(index.name)
+        return search_by_vector(
+            client, query["question"], query["embedding"], self.fetch_size(index),
+            cache=self._retrieval_cache, upstream=self._search)
+
+    async def _aget_documents(self, index: IndexOptions, query: dict):
+        client = await self._clients.asearch_client(index.name)
+        return await asearch_by_vector(
+            client, query["question"], query["embedding"], self.fetch_size(index),
+            cache=self._retrieval_cache, upstream=self._search)
+
+    def _submit_search(self, index: IndexOptions, query: dict):
+        """ Submits the search of the index to the pool, or returns None when the index
+            already holds all its threads, so a hung index cannot starve the others."""
+        with self._running_lock:
+            if self._running_searches[index.name] >= SEARCH_THREADS_PER_INDEX:
+                return None
+            self._running_searches[index.name] += 1
+        future = self._executor.submit(self._get_documents, index, query)
+        future.add_done_callback(lambda _: self._search_done(index.name))
+        return future
+
+    def _search_done(self, index_name: str):
+        with self._running_lock:
+            self._running_searches[index_name] -= 1
+
+    @staticmethod
+    def _timeout(index: IndexOptions, deadline: Deadline | None) -> float:
+        return deadline.search_timeout(index.timeout_seconds) if deadline else index.timeout_seconds
+
+    def get_documents(self, query: dict, deadline: Deadline | None = None):
+        """ Searches every index in parallel with the question and its embedding.
+            Indexes which fail or miss their timeout are left out of the documents
+            and reported in dropped_indexes, so one slow index cannot stall the answer.
+            With a deadline, the timeouts end before the time kept for the LLM call.
+            A search which missed its timeout runs on until the read timeout of the search
+            client, and an index whose threads are all taken that way is dropped at once."""
+        start = monotonic()
+        timeouts = {index.name: self._timeout(index, deadline) for index in self._indexes}
+        futures = {index.name: self._submit_search(index, query) for index in self._indexes}
 
-    def get_primary_documents(self, question: str):
-        """ Creating a new instance of the SearchVectorIndexService class with the 
-            primary index name."""
-        return self._get_documents(self._primary_index_name, question)
+        documents, dropped_indexes = {}, []
+        for index in self._indexes:
+            if futures[index.name] is None:
+                logger.warning("Index %s has no free search thread", index.name)
+                UPSTREAM_ERRORS.inc(upstream="search", reason="saturated")
+                dropped_indexes.append(index.name)
+                continue
+            remaining = max(0.0, start + timeouts[index.name] - monotonic())
+            try:
+                documents[index.name] = futures[index.name].result(timeout=remaining)
+            except FutureTimeoutError:
+                logger.warning("Index %s missed its %.2fs deadline", index.name, timeouts[index.name])
+                UPSTREAM_ERRORS.inc(upstream="search", reason="timeout")
+                futures[index.name].cancel()
+                dropped_indexes.append(index.name)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Search of index %s failed", index.name)
+                dropped_indexes.append(index.name)
 
-    def get_secondary_documents(self, question: str):
-        """ Creating a new instance of the SearchVectorIndexService class with the 
-            secondary index name."""
-        return self._get_documents(self._secondary_index_name, question)
+        return {"documents": documents, "dropped_indexes": dropped_indexes}
+
+    async def aget_documents(self, query: dict, deadline: Deadline | None = None):
+        """ Async version of get_documents. Searches which miss their timeout are cancelled."""
+        timeouts = [self._timeout(index, deadline) for index in self._indexes]
+        results = await asyncio.gather(
+            *(
+                asyncio.wait_for(self._aget_documents(index, query), timeout)
+                for index, timeout in zip(self._indexes, timeouts)
+            ),
+            return_exceptions=True)
+
+        documents, dropped_indexes = {}, []
+        for index, timeout, result in zip(self._indexes, timeouts, results):
+            if isinstance(result, asyncio.TimeoutError):
+                logger.warning("Index %s missed its %.2fs deadline", index.name, timeout)
+                UPSTREAM_ERRORS.inc(upstream="search", reason="timeout")
+                dropped_indexes.append(index.name)
+            elif isinstance(result, Exception):
+                logger.error("Search of index %s failed", index.name, exc_info=result)
+                dropped_indexes.append(index.name)
+            else:
+                documents[index.name] = result
+
+        return {"documents": documents, "dropped_indexes": dropped_indexes}
+
+    def get_rated_answer(self, rated_answer_options: RatedAnswerOptions, query: dict):
+        """ Looks up the ratings of similar questions. Returns the rated response when
+            a thumbs-up rating passes the threshold and no thumbs-down rating outranks it.
+            Only its citations of documents of the indexes are returned, signed again.
+            The ratings are searched in the local mirror once it has been loaded."""
+        if self._ratings_mirror and self._ratings_mirror.ready:
+            ratings = self._ratings_mirror.search(query["embedding"], rated_answer_options.k)
+        else:
+            client = self._clients.search_client(rated_answer_options.index_name)
+            ratings = vector_search(client, query["embedding"], rated_answer_options.k, upstream=self._search)
+        rated = self._select_rated_answer(rated_answer_options, ratings)
+        if not rated:
+            return None
+
+        return {
+            "answer": rated.metadata["response"],
+            "citations": [
+                citation | {"url": self._signed_url(*blob)}
+                for citation, blob in self._rated_citations(rated)
+            ],
+            "served_from_cache": True,
+        }
+
+    async def aget_rated_answer(self, rated_answer_options: RatedAnswerOptions, query: dict):
+        """ Async version of get_rated_answer."""
+        if self._ratings_mirror and self._ratings_mirror.ready:
+            ratings = self._ratings_mirror.search(query["embedding"], rated_answer_options.k)
+        else:
+            client = await self._clients.asearch_client(rated_answer_options.index_name)
+            ratings = await avector_search(
+                client, query["embedding"], rated_answer_options.k, upstream=self._search)
+        rated = self._select_rated_answer(rated_answer_options, ratings)
+        if not rated:
+            return None
+
+        return {
+            "answer": rated.metadata["response"],
+            "citations": [
+                citation | {"url": await self._asigned_url(*blob)}
+                for citation, blob in self._rated_citations(rated)
+            ],
+            "served_from_cache": True,
+        }
+
+    @staticmethod
+    def _select_rated_answer(rated_answer_options: RatedAnswerOptions, ratings):
+        for document, score in sorted(ratings, key=lambda rating: rating[1], reverse=True):
+            if score < rated_answer_options.min_score:
+                break
+            labels = document.metadata.get("labels", [])
+            if "rating:thumbs-down" in labels:
+                return None
+            if "rating:thumbs-up" in labels:
+                return document
+        return None
 
     def sort_and_filter_documents(self, _dict):
-        """ Function for filtering and sorting documents based on their reranked scores.
-            Using LangChain this could be split out into multiple runnables for better
-            readability and maintainability."""
-        primary_documents = _dict["primary_documents"]
-        secondary_documents = _dict["secondary_documents"]
-        documents = primary_documents + secondary_documents
-
-        # Reverse sorting the documents based on the reranked score.
-        documents = sorted(documents, key=lambda document: document[2], reverse=True)
-        documents = documents[:3]
-        return documents
-
-    def format_docs(self, docs):
-        """Function to format the documents into a string, with the URL included for citations"""
-        formatted_docs = ""
-        for i, d in enumerate(docs):
-            url = self._storage_account_options.url
-            file_name = d[0].metadata["file_name"]
-            container = d[0].metadata["container"]
-
-            sas_token = self._token_service.get_sas_token_for_blob(file_name, container)
-            formatted_docs += f'ID: {i}'
-            formatted_docs += f'URL: {url}/{container}/{file_name}?{sas_token}'
-            formatted_docs += f'CONTENT: {d[0].page_content}\n\n'
-        return formatted_docs
+        """ Merges the ranked documents of every index into the final_k best documents,
+            based on their normalized and weighted reranker scores. Of near-duplicate
+            documents, from any index, only the best scored one is kept."""
+        return merge_top_k(
+            _dict["documents"],
+            self._final_k,
+            weights={index.name: index.weight for index in self._indexes},
+            normalization=self._score_normalization,
+            min_score=self._min_reranker_score,
+            unique=self._near_duplicates.unique if self._near_duplicates else None)
+
+    def format_docs(self, docs, token_budget: int | None = None):
+        """ Packs the best documents into the context token budget, by default the configured
+            one. The prompt refers to each source by a short reference, the signed URLs are
+            returned as the sources and put back into the citations of the answer."""
+        context, packed = self._context_packer.pack([d[0].page_content for d in docs], token_budget)
+        sources = {
+            source_reference(i): self._signed_url(d[0].metadata["container"], d[0].metadata["file_name"])
+            for i, d in enumerate(docs[:packed])
+        }
+        return {"context": context, "sources": sources}
+
+    async def aformat_docs(self, docs, token_budget: int | None = None):
+        """Async version of format_docs, which never blocks on the user delegation key."""
+        context, packed = self._context_packer.pack([d[0].page_content for d in docs], token_budget)
+        sources = {
+            source_reference(i): await self._asigned_url(
+                d[0].metadata["container"], d[0].metadata["file_name"])
+            for i, d in enumerate(docs[:packed])
+        }
+        return {"context": context, "sources": sources}
+
+    def _signed_url(self, container: str, file_name: str) -> str:
+        url = self._storage_account_options.url
+        sas_token = self._token_service.get_sas_token_for_blob(file_name, container)
+        return f'{url}/{container}/{file_name}?{sas_token}'
+
+    async def _asigned_url(self, container: str, file_name: str) -> str:
+        url = self._storage_account_options.url
+        sas_token = await self._token_service.aget_sas_token_for_blob(file_name, container)
+        return f'{url}/{container}/{file_name}?{sas_token}'
+
+    def _split_url(self, citation_url: str):
+        """The container and file name of a citation URL, or None unless it points to a blob
+            of a container of the indexes."""
+        prefix = f'{self._storage_account_options.url}/'
+        if not citation_url.startswith(prefix):
+            return None
+        container, _, file_name = citation_url[len(prefix):].split("?")[0].split("#")[0].partition("/")
+        if container not in self._containers or not file_name or ".." in file_name.split("/"):
+            return None
+        return container, file_name
+
+    def _rated_citations(self, rated):
+        """The citations stored with a rated answer, with the blob each one points to.
+            The citations are sent by the client which rated the answer, so their URLs are
+            never returned as they are: the blob URL is signed again, and the citations
+            which do not point to a document of the indexes are dropped."""
+        citations = []
+        for citation in rated.metadata.get("citations", []):
+            blob = self._split_url(str(citation.get("url", "")))
+            if blob:
+                citations.append((citation, blob))
+        return citations
+
+    def stats(self) -> dict:
+        """Returns the counters of the caches of the builder."""
+        return {"sas_tokens": self._token_service.stats()}
+
+    async def astart(self):
+        """Starts the background work of the builder, such as refreshing the user delegation key."""
+        await self._token_service.astart()
+
+    async def awarm_storage(self):
+        """Fetches what signing the citation URLs needs ahead of the first request."""
+        await self._token_service.awarm()
+
+    async def aclose(self):
+        """Closes the clients owned by the builder."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        await self._token_service.aclose()
     
     def default_return_message(self, default_return_message: str):
         """Function to return the default return message if no documents are found."""
@@ -1,12 +1,190 @@
 """ This module contains the OpenAIOptions class. """
+from typing import Dict, List, Literal
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
+class RatedAnswerOptions(BaseSettings):
+    """
+    Options for answering from previously rated responses instead of calling the LLM.
+    Args:
+        enabled: Whether the ratings index is checked before the LLM.
+        index_name: The index the ratings are stored in.
+        min_score: The minimum vector search score (cosine similarity based)
+            a thumbs-up rating needs to be returned as the answer.
+        k: The number of ratings retrieved for the question.
+    """
+    enabled: bool = Field()
+    index_name: str = Field()
+    min_score: float = Field()
+    k: int = Field()
+
+class RatingsMirrorOptions(BaseSettings):
+    """
+    Options for the local, memory-mapped copy of the ratings index.
+    Args:
+        enabled: Whether rated answers are looked up in the local copy instead of the index.
+        path: The directory holding the copy, shared by the workers of a host.
+        sync_interval_seconds: How often new ratings are copied from the index.
+    """
+    enabled: bool = Field()
+    path: str = Field()
+    sync_interval_seconds: float = Field()
+
+class RatingQueueOptions(BaseSettings):
+    """
+    Options for buffering ratings before they are stored in the ratings index.
+    Args:
+        batch_size: The most ratings stored in one batch. A full batch is flushed immediately.
+        flush_interval_seconds: How long a rating waits for a batch to fill up.
+        max_pending: The most ratings held in memory, the oldest are dropped beyond it.
+    """
+    batch_size: int = Field()
+    flush_interval_seconds: float = Field()
+    max_pending: int = Field()
+
+class ChatBatchOptions(BaseSettings):
+    """
+    Options for answering a batch of questions.
+    Args:
+        embedding_batch_size: The number of questions embedded in one call.
+        max_concurrency: The most questions of a batch answered at once.
+        max_search_concurrency: The most index searches of a batch in flight at once.
+        max_llm_concurrency: The most LLM calls of a batch in flight at once.
+    """
+    embedding_batch_size: int = Field()
+    max_concurrency: int = Field()
+    max_search_concurrency: int = Field()
+    max_llm_concurrency: int = Field()
+
+class RetrievalCacheOptions(BaseSettings):
+    """
+    Options for caching the results of index searches.
+    Args:
+        enabled: Whether repeated searches are answered from the cache.
+        ttl_seconds: How long the results of a search are reused.
+        max_entries: The most searches whose results are kept.
+        versions_path: Path of the file holding the content versions of the indexes, shared
+            by the workers of a host. An empty value keeps the versions per worker, so an
+            invalidation only reaches the worker which received it.
+    """
+    enabled: bool = Field()
+    ttl_seconds: float = Field()
+    max_entries: int = Field()
+    versions_path: str | None = Field(default=None)
+
+class RequestCoalescingOptions(BaseSettings):
+    """
+    Options for answering identical chat requests once.
+    Args:
+        enabled: Whether identical concurrent requests share one execution of the chain.
+        result_ttl_seconds: How long an answer is reused for repeats of the request.
+        max_entries: The most answers kept for reuse.
+    """
+    enabled: bool = Field()
+    result_ttl_seconds: float = Field()
+    max_entries: int = Field()
+
+class TelemetryOptions(BaseSettings):
+    """
+    Options for the metrics and traces of the application.
+    Args:
+        opentelemetry_enabled: Whether the stages are recorded as OpenTelemetry spans,
+            when the OpenTelemetry API is installed.
+        trace_id_header: The request and response header carrying the trace ID.
+    """
+    opentelemetry_enabled: bool = Field()
+    trace_id_header: str = Field()
+
+class WarmupOptions(BaseSettings):
+    """
+    Options for the warmup a worker runs before it reports ready.
+    Args:
+        enabled: Whether the worker opens its upstream connections before it reports ready.
+        query: The text of the synthetic embedding and index searches.
+        prime_questions: Questions embedded and searched during the warmup, so they are
+            answered from the embedding and retrieval caches.
+        timeout_seconds: How long a warmup step may take before it counts as failed.
+        retry_seconds: How long the warmup waits before it runs the failed steps again.
+        max_attempts: How often a step is run before the worker reports ready without it.
+            0 runs it until it succeeds.
+    """
+    enabled: bool = Field()
+    query: str = Field()
+    prime_questions: List[str] = Field(default=[])
+    timeout_seconds: float = Field()
+    retry_seconds: float = Field()
+    max_attempts: int = Field()
+
+class UpstreamPolicyOptions(BaseSettings):
+    """
+    Options for the calls to one upstream service.
+    Args:
+        timeout_seconds: How long one attempt of a call may take.
+        max_retries: How often a call which was throttled, timed out or failed in transit is retried.
+        backoff_base_seconds: A retry waits a random time of up to backoff_base_seconds
+            times two to the power of the attempt, or the Retry-After of the service.
+        backoff_max_seconds: The longest wait before a retry.
+        failure_threshold: The consecutive failed calls after which the circuit opens.
+        open_seconds: How long an open circuit fails the calls at once, before it lets
+            a trial call through.
+        hedge_percentile: Calls which take longer than this percentile of the recent calls
+            are sent a second time, and the first response is used. None disables hedging.
+        hedge_min_samples: The calls measured before any call is hedged.
+    """
+    timeout_seconds: float = Field()
+    max_retries: int = Field()
+    backoff_base_seconds: float = Field(default=0.1)
+    backoff_max_seconds: float = Field(default=5.0)
+    failure_threshold: int = Field()
+    open_seconds: float = Field()
+    hedge_percentile: float | None = Field(default=None)
+    hedge_min_samples: int = Field(default=50)
+
+class ResilienceOptions(BaseSettings):
+    """
+    Options for the timeouts, retries, circuit breakers and hedging of the upstream calls.
+    Args:
+        enabled: Whether the policies are applied. Disabled, the SDK defaults are used.
+        upstreams: The policy of every upstream, by name: "search", "embeddings",
+            "openai" and "ratings". Upstreams without a policy keep the SDK defaults.
+    """
+    enabled: bool = Field()
+    upstreams: Dict[str, UpstreamPolicyOptions] = Field()
+
+class DeadlineOptions(BaseSettings):
+    """
+    Options for the time budget of a chat request.
+    Args:
+        enabled: Whether the chat requests have a deadline.
+        header: The request header with the seconds the client waits for the answer.
+        default_seconds: The budget of the requests without the header.
+        max_seconds: The longest budget a client may ask for.
+        llm_reserve_seconds: The time kept for the LLM call. The index searches are
+            cut short so they end before it, or halfway to the deadline when it is closer.
+        min_llm_seconds: The LLM is not called, and the default answer is returned,
+            when less time than this is left.
+        short_seconds: When less time than this is left for the LLM call, the context is
+            shrunk by short_context_fraction, max_tokens is capped at short_max_tokens
+            and the model router prefers the deployments which answer in time.
+        short_context_fraction: The share of the context token budget used when time is short.
+        short_max_tokens: The max_tokens of the LLM call when time is short.
+    """
+    enabled: bool = Field()
+    header: str = Field()
+    default_seconds: float = Field()
+    max_seconds: float = Field()
+    llm_reserve_seconds: float = Field()
+    min_llm_seconds: float = Field()
+    short_seconds: float = Field()
+    short_context_fraction: float = Field()
+    short_max_tokens: int = Field()
+
 class ChatConversationOptions(BaseSettings):
     """Class used to manage the chat conversation
         and chain runnables together for the chat conversation"""
     system_prompt: str = Field()
     default_return_message: str = Field()
+    rated_answer_options: RatedAnswerOptions = Field()
 
 class ApiOptions(BaseSettings):
     """
@@ -36,6 +214,55 @@ class ModelOptions(BaseSettings):
     max_tokens: int = Field()
     n: int = Field()
 
+class ModelRouteOptions(BaseSettings):
+    """
+    Options for one chat deployment the model router can choose.
+    Args:
+        deployment: The chat deployment.
+        context_window: The most tokens of the prompt plus the answer the model accepts.
+        max_tokens: The most tokens generated for the answer.
+        approaches: The ApproachType names of the questions the deployment answers.
+        max_question_tokens: The longest question the deployment answers. None for any length.
+        max_latency_seconds: The average latency above which the next deployment is preferred.
+            None for no limit.
+    """
+    deployment: str = Field()
+    context_window: int = Field()
+    max_tokens: int = Field()
+    approaches: List[str] = Field()
+    max_question_tokens: int | None = Field(default=None)
+    max_latency_seconds: float | None = Field(default=None)
+
+class ModelRouterOptions(BaseSettings):
+    """
+    Options for routing the LLM call across several chat deployments.
+    Args:
+        enabled: Whether the router chooses the deployment, instead of always using deployment_model.
+        latency_ewma_alpha: The weight of the latest call in the average latency of a deployment.
+        throttle_cooldown_seconds: How long a deployment which throttled a call is skipped.
+        routes: The deployments, cheapest and fastest first.
+    """
+    enabled: bool = Field()
+    latency_ewma_alpha: float = Field()
+    throttle_cooldown_seconds: float = Field()
+    routes: List[ModelRouteOptions] = Field()
+
+class EmbeddingCacheOptions(BaseSettings):
+    """
+    Options for configuring the embedding cache.
+    Args:
+        max_entries: The maximum number of vectors kept in memory.
+        ttl_seconds: How long a cached vector stays valid. None keeps it until evicted.
+        persist_path: Path of the sqlite file used as the on-disk tier.
+            An empty value disables the on-disk tier.
+        persist_max_entries: The maximum number of vectors kept on disk, the oldest are
+            dropped first. None keeps every vector until it expires.
+    """
+    max_entries: int = Field()
+    ttl_seconds: float | None = Field()
+    persist_path: str | None = Field()
+    persist_max_entries: int | None = Field(default=None)
+
 class OpenAIOptions(BaseSettings):
     """
     Options for configuring the OpenAI service.
@@ -60,20 +287,89 @@ class StorageAccountOptions(BaseSettings):
     """
     Options for configuring the Storage Account where the original documents are stored.
     Args:
-        url: The base url of the storage account.
+        url: The base url of the storage account, the endpoint when one is set.
+        endpoint: Optional blob endpoint replacing the public one, such as a local emulator.
+        sas_scope: Whether a SAS token is signed for each "blob" or shared by a whole "container".
+        sas_expiry_seconds: The lifetime of a SAS token.
+        sas_min_remaining_seconds: A cached SAS token is reused while at least this much
+            of its lifetime remains.
+        sas_cache_max_entries: The number of SAS tokens kept in memory.
+        user_delegation_key_lifetime_seconds: The lifetime of the user delegation key
+            used with managed identity, at most 7 days.
     Note: The system expects that the container name will be returned with the document metadata.
     """
     account_name: str = Field()
     account_key: str = Field()
     use_account_key: bool = Field()
+    sas_scope: Literal["blob", "container"] = Field(default="blob")
+    sas_expiry_seconds: int = Field(default=3600)
+    sas_min_remaining_seconds: int = Field(default=900)
+    sas_cache_max_entries: int = Field(default=10000)
+    user_delegation_key_lifetime_seconds: int = Field(default=86400)
+    endpoint: str | None = Field(default=None)
     @property
     def url(self):
-        return f"https://{self.account_name}.blob.core.windows.net"
+        return self.endpoint or f"https://{self.account_name}.blob.core.windows.net"
+
+class IndexOptions(BaseSettings):
+    """
+    Options for one of the indexes searched for documents.
+    Args:
+        name: The name of the index.
+        k: The most documents retrieved from the index, fewer when the final k is smaller.
+        weight: Multiplier applied to the reranker scores of the index.
+        timeout_seconds: How long the chain waits for the index before it continues without it.
+        containers: The blob containers holding the documents of the index. The citations of
+            a rated answer are only signed again when they point into one of them.
+    """
+    name: str = Field()
+    k: int = Field()
+    weight: float = Field()
+    timeout_seconds: float = Field()
+    containers: List[str] = Field(default=[])
+
+class DeduplicationOptions(BaseSettings):
+    """
+    Options for dropping retrieved documents which are near-duplicates of better scored ones.
+    Args:
+        enabled: Whether near-duplicate documents are dropped before the top k is taken.
+        similarity_threshold: The estimated Jaccard similarity of the word shingles of two
+            documents from which the lower scored one is dropped.
+        shingle_size: The number of consecutive words in a shingle.
+        num_hashes: The number of MinHash functions in the signature of a document.
+        bands: The number of bands the signatures are split into to find the candidate
+            duplicates. num_hashes must be a multiple of it.
+        fetch_factor: Each index is asked for up to fetch_factor times final_k documents,
+            at most its k, so final_k distinct documents remain.
+    """
+    enabled: bool = Field(default=False)
+    similarity_threshold: float = Field(default=0.8)
+    shingle_size: int = Field(default=3)
+    num_hashes: int = Field(default=64)
+    bands: int = Field(default=16)
+    fetch_factor: int = Field(default=2)
 
 class MultiIndexVectorStoreOptions(BaseSettings):
-    """Options for configuring the multi-index vector store service."""
-    primary_index_name: str = Field()
-    secondary_index_name: str = Field()
+    """
+    Options for configuring the multi-index vector store service.
+    Args:
+        indexes: The indexes searched for documents, at least one.
+        final_k: The number of documents, across all indexes, used as context.
+        min_reranker_score: Documents with a lower reranker score are never used as context.
+        score_normalization: How the reranker scores of each index are rescaled before
+            they are merged, one of "none", "max" or "min_max".
+        context_token_budget: The most tokens the documents may use in the prompt.
+        min_chunk_tokens: A document which does not fit the budget is truncated
+            when at least this many of its tokens fit, otherwise it is dropped.
+        deduplication: How near-duplicate documents are dropped.
+    """
+    indexes: List[IndexOptions] = Field(min_length=1)
+    final_k: int = Field(default=3)
+    min_reranker_score: float = Field(default=0.0)
+    score_normalization: Literal["none", "max", "min_max"] = Field(default="none")
+    context_token_budget: int = Field(default=3000)
+    min_chunk_tokens: int = Field(default=100)
+    deduplication: DeduplicationOptions = Field(default_factory=DeduplicationOptions)
     vector_store_options: VectorStoreOptions = Field()
     open_ai_options: OpenAIOptions = Field()
     storage_account_options: StorageAccountOptions = Field()
@@ -0,0 +1,148 @@
+"""Process-wide registry for the Azure search, embedding and chat model clients."""
+import asyncio
+import threading
+from typing import Dict
+
+import httpx
+from langchain_community.vectorstores.azuresearch import AzureSearch
+from langchain_core.embeddings import Embeddings
+from langchain_openai import AzureChatOpenAI
+
+from libs.core.models.options import MultiIndexVectorStoreOptions
+from libs.core.services.embedding_cache import EmbeddingCache
+from libs.core.services.resilience import Resilience
+from libs.core.services.search_vector_index_service import (
+    CachedEmbeddings,
+    generate_azure_search_client,
+    generate_embeddings
+)
+
+def _search_client_options(timeout_seconds: float) -> dict:
+    """Options of the Azure SDK search clients of an upstream with a policy: the searches
+        are retried with the policy, within the deadline of the index, and every attempt
+        gives up connecting or waiting for the response after timeout_seconds."""
+    return {"retry_total": 0, "connection_timeout": timeout_seconds, "read_timeout": timeout_seconds}
+
+class ClientRegistry:
+    """Creates each client once per index / deployment and reuses it across requests.
+        All OpenAI clients share one HTTP connection pool, which is closed on shutdown.
+        The clients of upstreams with a policy leave retrying to it, except the chat models,
+        which are retried by their SDK with the timeout and retries of the policy."""
+
+    def __init__(
+            self,
+            multi_index_options: MultiIndexVectorStoreOptions,
+            embedding_cache: EmbeddingCache | None = None,
+            resilience: Resilience | None = None
+        ):
+        self._vector_store_options = multi_index_options.vector_store_options
+        self._open_ai_options = multi_index_options.open_ai_options
+        self._embedding_cache = embedding_cache
+        self._resilience = resilience or Resilience()
+        self._lock = threading.Lock()
+        self._http_client: httpx.Client = None
+        self._http_async_client: httpx.AsyncClient = None
+        self._embeddings: Embeddings = None
+        self._search_clients: Dict[str, AzureSearch] = {}
+        self._chat_models: Dict[str, AzureChatOpenAI] = {}
+
+    @property
+    def resilience(self) -> Resilience:
+        """The policies of the upstream calls made with the clients."""
+        return self._resilience
+
+    def _get_http_client(self) -> httpx.Client:
+        if not self._http_client:
+            self._http_client = httpx.Client()
+        return self._http_client
+
+    def _get_http_async_client(self) -> httpx.AsyncClient:
+        if not self._http_async_client:
+            self._http_async_client = httpx.AsyncClient()
+        return self._http_async_client
+
+    def embeddings(self, cached: bool = True) -> Embeddings:
+        """Returns the shared embeddings client, backed by the embedding cache if one is set.
+            With cached False the embedding cache is bypassed, e.g. to reach the model."""
+        if not self._embeddings:
+            with self._lock:
+                if not self._embeddings:
+                    self._embeddings = generate_embeddings(
+                        self._open_ai_options,
+                        http_client=self._get_http_client(),
+                        cache=self._embedding_cache,
+                        http_async_client=self._get_http_async_client(),
+                        upstream=self._resilience.upstream("embeddings"))
+        if not cached and isinstance(self._embeddings, CachedEmbeddings):
+            return self._embeddings.embeddings
+        return self._embeddings
+
+    def search_client(self, index_name: str) -> AzureSearch:
+        """Returns the shared search client for the given index."""
+        client = self._search_clients.get(index_name)
+        if client:
+            return client
+
+        embeddings = self.embeddings()
+        policy = self._resilience.policy("search")
+        with self._lock:
+            if index_name not in self._search_clients:
+                self._search_clients[index_name] = generate_azure_search_client(
+                    index_name=index_name,
+                    vector_store_options=self._vector_store_options,
+                    embedding_function=embeddings,
+                    search_client_options=_search_client_options(policy.timeout_seconds) if policy else None)
+            return self._search_clients[index_name]
+
+    async def asearch_client(self, index_name: str) -> AzureSearch:
+        """Returns the shared search client for the given index. The first call for an
+            index loads the index schema, so it runs in a thread to keep the event loop free."""
+        client = self._search_clients.get(index_name)
+        if client:
+            return client
+        return await asyncio.to_thread(self.search_client, index_name)
+
+    def chat_model(self, deployment: str) -> AzureChatOpenAI:
+        """Returns the shared chat model for the given deployment."""
+        model = self._chat_models.get(deployment)
+        if model:
+            return model
+
+        with self._lock:
+            if deployment not in self._chat_models:
+                api_options = self._open_ai_options.api_options
+                model_options = self._open_ai_options.ai_model_options
+                policy = self._resilience.policy("openai")
+                retries = {"max_retries": policy.max_retries, "timeout": policy.timeout_seconds} if policy else {}
+                self._chat_models[deployment] = AzureChatOpenAI(
+                    openai_api_version=api_options.api_version,
+                    azure_deployment=deployment,
+                    azure_endpoint=api_options.endpoint,
+                    api_key=api_options.api_key,
+                    temperature=model_options.temperature,
+                    max_tokens=model_options.max_tokens,
+                    n=model_options.n,
+                    http_client=self._get_http_client(),
+                    http_async_client=self._get_http_async_client(),
+                    **retries,
+                )
+            return self._chat_models[deployment]
+
+    async def aclose(self):
+        """Closes every client and the shared connection pools."""
+        with self._lock:
+            search_clients = list(self._search_clients.values())
+            http_client, http_async_client = self._http_client, self._http_async_client
+            self._search_clients = {}
+            self._chat_models = {}
+            self._embeddings = None
+            self._http_client = None
+            self._http_async_client = None
+
+        for client in search_clients:
+            client.client.close()
+            await client.async_client.close()
+        if http_client:
+            http_client.close()
+        if http_async_client:
+            await http_async_client.aclose()
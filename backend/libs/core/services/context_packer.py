@@ -0,0 +1,99 @@
+"""This module packs the top-ranked documents into a token budget for the prompt."""
+
+import logging
+from typing import Dict, List, Tuple
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Used when the tokenizer of the model cannot be loaded, for example without network access.
+_CHARACTERS_PER_TOKEN = 4
+
+class TokenCounter:
+    """Counts and truncates text in the tokens of a model.
+        Falls back to an estimate of four characters per token when the
+        encoding of the model is unavailable."""
+
+    def __init__(self, model_name: str):
+        try:
+            self._encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self._encoding = self._get_encoding("cl100k_base")
+        except Exception: # pylint: disable=broad-except
+            logger.warning("Tokenizer for %s is unavailable, estimating token counts", model_name)
+            self._encoding = None
+
+    @staticmethod
+    def _get_encoding(encoding_name: str):
+        try:
+            return tiktoken.get_encoding(encoding_name)
+        except Exception: # pylint: disable=broad-except
+            logger.warning("Tokenizer %s is unavailable, estimating token counts", encoding_name)
+            return None
+
+    def count(self, text: str) -> int:
+        """Returns the number of tokens in the text."""
+        if self._encoding is None:
+            return -(-len(text) // _CHARACTERS_PER_TOKEN)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Returns the start of the text which fits in max_tokens."""
+        if self._encoding is None:
+            return text[:max_tokens * _CHARACTERS_PER_TOKEN]
+        return self._encoding.decode(self._encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def source_reference(source_id: int) -> str:
+    """The short reference which stands in for the signed URL of a source in the prompt."""
+    return f"source-{source_id}"
+
+class ContextPacker:
+    """Fits the documents, best first, into a budget of prompt tokens.
+        A document which does not fit is truncated when at least min_chunk_tokens
+        of it fit, and every document after it is dropped."""
+
+    def __init__(self, token_counter: TokenCounter, token_budget: int, min_chunk_tokens: int):
+        self._token_counter = token_counter
+        self._token_budget = token_budget
+        self._min_chunk_tokens = min_chunk_tokens
+
+    @property
+    def token_budget(self) -> int:
+        """The configured budget of prompt tokens."""
+        return self._token_budget
+
+    def pack(self, contents: List[str], token_budget: int | None = None) -> Tuple[str, int]:
+        """Packs the contents, which are ranked best first, into the token budget, by default
+            the configured one. Returns the context and the number of documents in it,
+            which are always the first ones."""
+        chunks = []
+        token_budget = self._token_budget if token_budget is None else token_budget
+        remaining = token_budget
+        for source_id, content in enumerate(contents):
+            header = f'ID: {source_id}\nURL: {source_reference(source_id)}\nCONTENT: '
+            available = remaining - self._token_counter.count(header)
+            content_tokens = self._token_counter.count(content)
+            if content_tokens > available:
+                if available < self._min_chunk_tokens:
+                    break
+                content = self._token_counter.truncate(content, available)
+                content_tokens = available
+
+            chunks.append(f'{header}{content}\n\n')
+            remaining = available - content_tokens
+
+        if len(chunks) < len(contents):
+            logger.debug("Packed %s of %s documents into %s tokens",
+                len(chunks), len(contents), token_budget)
+        return "".join(chunks), len(chunks)
+
+def expand_citations(citations: List[dict], sources: Dict[str, str]) -> List[dict]:
+    """Replaces the short source references in the citations with the signed URLs."""
+    expanded = []
+    for citation in citations:
+        url = (sources.get(citation.get("url"))
+            or sources.get(source_reference(citation.get("source_id")))
+            or citation.get("url"))
+        expanded.append(citation | {"url": url})
+    return expanded
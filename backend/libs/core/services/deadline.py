@@ -0,0 +1,69 @@
+"""The time budget of a request, and how its stages shorten their work as it runs out."""
+import math
+import time
+from typing import Mapping
+
+from libs.core.models.options import DeadlineOptions
+
+# Key of the "configurable" run config entry holding the deadline of the request.
+DEADLINE = "deadline"
+
+class DeadlineExceededError(Exception):
+    """Raised instead of calling the LLM when too little time is left to answer."""
+
+class Deadline:
+    """The point in time by which a request must be answered."""
+
+    def __init__(self, seconds: float, options: DeadlineOptions):
+        self._options = options
+        self._expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str], options: DeadlineOptions) -> "Deadline | None":
+        """The deadline the client asked for in the header, at most max_seconds, or the
+            default one when the header is missing, not positive or not finite.
+            None when deadlines are disabled."""
+        if not options.enabled:
+            return None
+        try:
+            seconds = float(headers.get(options.header, ""))
+        except ValueError:
+            seconds = 0.0
+        if not math.isfinite(seconds) or seconds <= 0:
+            seconds = options.default_seconds
+        return cls(min(seconds, options.max_seconds), options)
+
+    def remaining(self) -> float:
+        """The seconds left until the deadline."""
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def short(self) -> bool:
+        """Whether the LLM call has to be shortened to answer in time."""
+        return self.remaining() < self._options.short_seconds
+
+    def search_timeout(self, timeout_seconds: float) -> float:
+        """The timeout of an index search, which ends before the time kept for the LLM call,
+            or halfway to the deadline when it is closer than twice that."""
+        remaining = self.remaining()
+        return min(timeout_seconds, remaining - min(self._options.llm_reserve_seconds, remaining / 2))
+
+    def context_token_budget(self, token_budget: int) -> int:
+        """The token budget of the context, which is shrunk when time is short."""
+        return int(token_budget * self._options.short_context_fraction) if self.short else token_budget
+
+    def max_tokens(self, max_tokens: int | None) -> int | None:
+        """The max_tokens of the LLM call, which is capped when time is short."""
+        if not self.short:
+            return max_tokens
+        return min(max_tokens or self._options.short_max_tokens, self._options.short_max_tokens)
+
+    def check_llm(self):
+        """Raises DeadlineExceededError when too little time is left to call the LLM."""
+        remaining = self.remaining()
+        if remaining < self._options.min_llm_seconds:
+            raise DeadlineExceededError(f"Only {remaining:.1f}s were left to call the LLM")
+
+def deadline_of(config: Mapping) -> Deadline | None:
+    """Returns the deadline passed in the run config of a chain, if any."""
+    return (config or {}).get("configurable", {}).get(DEADLINE)
@@ -0,0 +1,219 @@
+"""Cache of embedding vectors keyed by normalized text and embedding model."""
+import asyncio
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from typing import List
+
+from libs.core.models.options import EmbeddingCacheOptions
+from libs.core.services.ttl_lru_cache import TtlLruCache
+
+logger = logging.getLogger(__name__)
+
+# The vectors waiting for the writer, beyond which new vectors are not stored on disk.
+MAX_QUEUED_WRITES = 10000
+# The attempts to write a batch before its vectors are dropped.
+WRITE_ATTEMPTS = 3
+
+def normalize_text(text: str) -> str:
+    """Normalizes unicode, casing and whitespace so equivalent questions share a key."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+class _SqliteVectorStore:
+    """On-disk tier storing vectors as float32 blobs, shared by every worker on the host.
+
+        Writes are queued to a writer thread which commits them in batches, so storing a
+        vector never waits on the disk. The writer also drops the expired rows and the
+        oldest rows beyond max_entries every prune_seconds, and once more on close.
+        A batch which fails is rolled back and tried again a few times, then dropped, as
+        are the vectors stored while the queue is full: the tier is only a cache."""
+
+    def __init__(
+            self,
+            path: str,
+            ttl_seconds: float | None,
+            max_entries: int | None = None,
+            prune_seconds: float = 60.0
+        ):
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._prune_seconds = prune_seconds
+        self._lock = threading.Lock()
+        self._connection = self._connect()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+        self._connection.commit()
+        self._writes: queue.Queue = queue.Queue(maxsize=MAX_QUEUED_WRITES)
+        self.dropped_writes = 0
+        self._writer = threading.Thread(target=self._write, name="embedding-cache-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, timeout=5, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def get(self, key: str) -> List[float] | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT created, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        created, blob = row
+        if self._ttl_seconds is not None and created + self._ttl_seconds <= time.time():
+            return None
+        return array("f", blob).tolist()
+
+    def set(self, key: str, vector: List[float]):
+        try:
+            self._writes.put_nowait((key, time.time(), array("f", vector).tobytes()))
+        except queue.Full:
+            self._dropped(1)
+
+    def _dropped(self, count: int):
+        with self._lock:
+            self.dropped_writes += count
+
+    def _write(self):
+        connection = self._connect()
+        pruned_at = 0.0
+        closing = False
+        while not closing:
+            rows = [self._writes.get()]
+            while True:
+                try:
+                    rows.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            closing = rows[-1] is None
+            rows = [row for row in rows if row is not None]
+            prune = closing or time.monotonic() - pruned_at >= self._prune_seconds
+            self._write_batch(connection, rows, prune)
+            if prune:
+                pruned_at = time.monotonic()
+        connection.close()
+
+    def _write_batch(self, connection: sqlite3.Connection, rows: list, prune: bool):
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                if rows:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)", rows)
+                if prune:
+                    self._prune(connection)
+                connection.commit()
+                return
+            except sqlite3.Error:
+                logger.warning("Writing %d vectors to the embedding cache failed (attempt %d of %d)",
+                    len(rows), attempt, WRITE_ATTEMPTS, exc_info=True)
+                connection.rollback()
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(0.1 * attempt)
+        logger.error("Dropped %d vectors of the embedding cache", len(rows))
+        self._dropped(len(rows))
+
+    def _prune(self, connection: sqlite3.Connection):
+        if self._ttl_seconds is not None:
+            connection.execute(
+                "DELETE FROM embeddings WHERE created <= ?", (time.time() - self._ttl_seconds,))
+        if self._max_entries is not None:
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,))
+
+    def close(self):
+        """Writes the queued vectors and closes the connections."""
+        self._writes.put(None)
+        self._writer.join()
+        with self._lock:
+            self._connection.close()
+
+class EmbeddingCache:
+    """Bounded in-memory LRU / TTL cache of embeddings with an optional sqlite tier
+        that survives restarts."""
+
+    def __init__(
+            self,
+            max_entries: int = 10000,
+            ttl_seconds: float | None = None,
+            persist_path: str | None = None,
+            persist_max_entries: int | None = None
+        ):
+        self._memory = TtlLruCache(max_entries, ttl_seconds)
+        self._store = _SqliteVectorStore(
+            persist_path, ttl_seconds, persist_max_entries) if persist_path else None
+        self._lock = threading.Lock()
+        self.persistent_hits = 0
+
+    @classmethod
+    def from_options(cls, options: EmbeddingCacheOptions) -> "EmbeddingCache":
+        """Creates the cache from the configured options."""
+        return cls(
+            max_entries=options.max_entries,
+            ttl_seconds=options.ttl_seconds,
+            persist_path=options.persist_path or None,
+            persist_max_entries=options.persist_max_entries)
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        """Returns the cache key for the text embedded with the given model."""
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str, model: str) -> List[float] | None:
+        """Returns the cached vector for the text, or None on a miss."""
+        key = self.key(text, model)
+        vector = self._memory.get(key)
+        if vector is None and self._store:
+            vector = self._hit_on_disk(key, self._store.get(key))
+        return vector
+
+    async def aget(self, text: str, model: str) -> List[float] | None:
+        """Async version of get, which reads the on-disk tier in a worker thread."""
+        key = self.key(text, model)
+        vector = self._memory.get(key)
+        if vector is None and self._store:
+            vector = self._hit_on_disk(key, await asyncio.to_thread(self._store.get, key))
+        return vector
+
+    def _hit_on_disk(self, key: str, vector: List[float] | None) -> List[float] | None:
+        if vector is not None:
+            with self._lock:
+                self.persistent_hits += 1
+            self._memory.set(key, vector)
+        return vector
+
+    def set(self, text: str, model: str, vector: List[float]):
+        """Stores the vector for the text in every tier. The on-disk tier is written
+            in the background."""
+        key = self.key(text, model)
+        self._memory.set(key, vector)
+        if self._store:
+            self._store.set(key, vector)
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters of the cache, and the vectors
+            which could not be written to disk. A miss in memory which is served from
+            disk counts as a hit."""
+        stats = self._memory.stats()
+        with self._lock:
+            persistent_hits = self.persistent_hits
+        return stats | {
+            "hits": stats["hits"] + persistent_hits,
+            "misses": stats["misses"] - persistent_hits,
+            "persistent_hits": persistent_hits,
+            "dropped_writes": self._store.dropped_writes if self._store else 0,
+        }
+
+    def close(self):
+        """Writes the queued vectors to the on-disk tier and closes it."""
+        if self._store:
+            self._store.close()
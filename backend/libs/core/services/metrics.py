@@ -0,0 +1,255 @@
+"""In-process metrics, rendered in the Prometheus text exposition format."""
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+@dataclass
+class Sample:
+    """One value of a metric which is read from a collector when the metrics are rendered."""
+    name: str
+    kind: str
+    help: str
+    labels: Dict[str, str]
+    value: float
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    """A value which only goes up, per combination of label values."""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Adds the amount to the counter of the label values."""
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        """Returns the exposition lines of the counter."""
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in values:
+            labels = _format_labels(dict(zip(self.label_names, key)))
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Counts observations in cumulative buckets, per combination of label values."""
+
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            label_names: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+        ):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Records one observation for the label values."""
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One count per bucket plus the +Inf bucket, then the sum.
+                series = self._series[key] = [0] * (len(self._buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        """Returns the exposition lines of the histogram."""
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, values in series:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    labels | {"le": "+Inf" if bound == float("inf") else _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Holds the metrics of the process and the collectors which read values,
+        such as cache statistics, at render time."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Counter | Histogram] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        """Returns the counter with the name, creating it on first use."""
+        return self._register(name, lambda: Counter(name, help_text, label_names))
+
+    def histogram(
+            self,
+            name: str,
+            help_text: str,
+            label_names: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+        ) -> Histogram:
+        """Returns the histogram with the name, creating it on first use."""
+        return self._register(name, lambda: Histogram(name, help_text, label_names, buckets))
+
+    def _register(self, name: str, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+    def register_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """Adds a function whose samples are read every time the metrics are rendered."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        samples: Dict[str, List[Sample]] = {}
+        for collector in collectors:
+            for sample in collector():
+                samples.setdefault(sample.name, []).append(sample)
+        for name, group in samples.items():
+            lines.append(f"# HELP {name} {group[0].help}")
+            lines.append(f"# TYPE {name} {group[0].kind}")
+            for sample in group:
+                lines.append(f"{name}{_format_labels(sample.labels)} {_format_value(sample.value)}")
+
+        return "\n".join(lines) + "\n"
+
+def cache_collector(cache_name: str, stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Returns a collector reporting the hits, misses, evictions and size of a cache."""
+    def collect():
+        values = stats()
+        labels = {"cache": cache_name}
+        yield Sample("cache_hits_total", "counter", "Lookups answered by the cache.",
+            labels, values.get("hits", 0))
+        yield Sample("cache_misses_total", "counter", "Lookups not answered by the cache.",
+            labels, values.get("misses", 0))
+        yield Sample("cache_evictions_total", "counter", "Entries evicted or expired.",
+            labels, values.get("evictions", 0))
+        yield Sample("cache_entries", "gauge", "Entries held by the cache.",
+            labels, values.get("entries", 0))
+    return collect
+
+def rating_queue_collector(stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Returns a collector reporting the depth and counters of the rating queue."""
+    def collect():
+        values = stats()
+        yield Sample("rating_queue_depth", "gauge", "Ratings waiting to be stored.",
+            {}, values["queue_depth"])
+        for counter in ("flushed", "duplicates", "dropped", "failed"):
+            yield Sample("rating_queue_ratings_total", "counter", "Ratings by what happened to them.",
+                {"outcome": counter}, values[counter])
+        yield Sample("rating_queue_last_flush_seconds", "gauge", "Duration of the last flush.",
+            {}, values["last_flush_seconds"])
+    return collect
+
+def ratings_mirror_collector(stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Returns a collector reporting the size and syncs of the local ratings mirror."""
+    def collect():
+        values = stats()
+        yield Sample("ratings_mirror_rows", "gauge", "Ratings held by the local mirror.",
+            {}, values["rows"])
+        yield Sample("ratings_mirror_syncs_total", "counter", "Syncs of the mirror from the index.",
+            {"outcome": "succeeded"}, values["syncs"])
+        yield Sample("ratings_mirror_syncs_total", "counter", "Syncs of the mirror from the index.",
+            {"outcome": "failed"}, values["sync_failures"])
+    return collect
+
+def model_router_collector(stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Returns a collector reporting the average latency and throttling of every chat deployment."""
+    def collect():
+        for deployment, values in stats().items():
+            labels = {"deployment": deployment}
+            yield Sample("llm_latency_ewma_seconds", "gauge", "Average latency of the LLM calls.",
+                labels, values["latency_ewma_seconds"] or 0.0)
+            yield Sample("llm_throttled", "gauge", "Whether the deployment is skipped after a 429.",
+                labels, int(values["throttled"]))
+            yield Sample("llm_throttles_total", "counter", "LLM calls throttled with a 429.",
+                labels, values["throttles"])
+    return collect
+
+def resilience_collector(stats: Callable[[], dict]) -> Callable[[], Iterable[Sample]]:
+    """Returns a collector reporting the circuit of every upstream with a policy."""
+    def collect():
+        for upstream, values in stats().items():
+            labels = {"upstream": upstream}
+            yield Sample("upstream_circuit_open", "gauge",
+                "Whether calls to the upstream fail at once, 0.5 while a trial call is let through.",
+                labels, {"closed": 0.0, "half_open": 0.5, "open": 1.0}[values["circuit"]])
+            yield Sample("upstream_consecutive_failures", "gauge",
+                "Failed calls to the upstream since the last one which succeeded.",
+                labels, values["consecutive_failures"])
+    return collect
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_duration_seconds", "Duration of the stages of the chat chain.", ("stage",))
+STAGE_ERRORS = REGISTRY.counter(
+    "chat_stage_errors_total", "Stages of the chat chain which raised an error.", ("stage",))
+SEARCH_SECONDS = REGISTRY.histogram(
+    "search_request_duration_seconds", "Duration of the requests to a search index.", ("index",))
+SAS_SIGNING_SECONDS = REGISTRY.histogram(
+    "sas_signing_duration_seconds", "Duration of signing a SAS token.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "Tokens used by the LLM.", ("model", "kind"))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "upstream_errors_total", "Failed calls to the services the app depends on.",
+    ("upstream", "reason"))
+COALESCED_REQUESTS = REGISTRY.counter(
+    "chat_coalesced_requests_total",
+    "Requests answered by an identical request in flight, or by its cached result.",
+    ("source",))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "upstream_retries_total", "Calls to an upstream which were retried.", ("upstream", "reason"))
+UPSTREAM_HEDGES = REGISTRY.counter(
+    "upstream_hedged_requests_total", "Slow calls to an upstream which were sent a second time.",
+    ("upstream",))
+CIRCUIT_REJECTED = REGISTRY.counter(
+    "upstream_circuit_rejected_total", "Calls failed at once because the circuit of the upstream was open.",
+    ("upstream",))
+NEAR_DUPLICATES = REGISTRY.counter(
+    "near_duplicate_documents_total", "Retrieved documents dropped as near-duplicates of better scored ones.")
+LLM_ROUTED = REGISTRY.counter(
+    "llm_routed_requests_total", "LLM calls by the deployment chosen for them.",
+    ("deployment", "classification"))
@@ -0,0 +1,83 @@
+"""Dropping near-duplicate documents, found with MinHash signatures and locality sensitive hashing."""
+
+import re
+import zlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from libs.core.models.options import DeduplicationOptions
+from libs.core.services.metrics import NEAR_DUPLICATES
+from libs.core.services.top_k_merge import ScoredDocument
+
+_WORD = re.compile(r"\w+")
+# A prime above 2^32: the hash functions are (a * x + b) mod _PRIME, with a, b and x below 2^32,
+# which cannot overflow 64 bits.
+_PRIME = np.uint64(4294967311)
+_SEED = 1
+
+class NearDuplicateFilter:
+    """Drops the documents whose text is a near-duplicate of a document kept before them.
+
+        The similarity of two documents is the Jaccard similarity of their sets of
+        word shingles, estimated by the share of equal MinHash values in their signatures.
+        The signatures are split into bands, and a document is only compared with the kept
+        documents which share a band with it, so the cost is linear in the number of
+        documents. With 16 bands of 4 hashes, pairs at least 0.8 similar share a band with
+        a probability above 99.9%."""
+
+    def __init__(self, options: DeduplicationOptions):
+        if options.num_hashes % options.bands:
+            raise ValueError("num_hashes must be a multiple of bands")
+        self._options = options
+        self._rows = options.num_hashes // options.bands
+        rng = np.random.default_rng(_SEED)
+        self._a = rng.integers(1, 2**32, size=(options.num_hashes, 1), dtype=np.uint64)
+        self._b = rng.integers(0, 2**32, size=(options.num_hashes, 1), dtype=np.uint64)
+
+    def shingles(self, text: str) -> List[int]:
+        """The hashes of the word shingles of the text, empty for a text without words."""
+        words = _WORD.findall(text.lower())
+        size = self._options.shingle_size
+        if len(words) <= size:
+            return [zlib.crc32(" ".join(words).encode("utf-8"))] if words else []
+        return list({
+            zlib.crc32(" ".join(words[i:i + size]).encode("utf-8"))
+            for i in range(len(words) - size + 1)
+        })
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """The MinHash signature of the text, None for a text without words."""
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        hashes = (self._a * np.asarray(shingles, dtype=np.uint64) + self._b) % _PRIME
+        return hashes.min(axis=1)
+
+    def _bands(self, signature: np.ndarray) -> Iterator[Tuple[int, bytes]]:
+        for band in range(self._options.bands):
+            yield band, signature[band * self._rows:(band + 1) * self._rows].tobytes()
+
+    def unique(self, documents: Iterable[ScoredDocument]) -> Iterator[ScoredDocument]:
+        """Yields the documents, best first, without those similar to one yielded before.
+            The documents are read lazily, so taking the top k stops the comparisons."""
+        kept: List[np.ndarray] = []
+        buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        for document in documents:
+            signature = self.signature(document[0].page_content)
+            if signature is None:
+                yield document
+                continue
+            bands = list(self._bands(signature))
+            candidates = {kept_id for band in bands for kept_id in buckets.get(band, ())}
+            if any(
+                np.mean(kept[kept_id] == signature) >= self._options.similarity_threshold
+                for kept_id in candidates
+            ):
+                NEAR_DUPLICATES.inc()
+                continue
+
+            for band in bands:
+                buckets.setdefault(band, []).append(len(kept))
+            kept.append(signature)
+            yield document
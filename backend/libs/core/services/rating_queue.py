@@ -0,0 +1,154 @@
+"""Buffers ratings and stores them in the ratings index in batches."""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import List
+
+from libs.core.models.options import RatingQueueOptions
+from libs.core.services.client_registry import ClientRegistry
+from libs.core.services.metrics import UPSTREAM_ERRORS
+from libs.core.services.resilience import Upstream
+from libs.core.services.search_vector_index_service import (
+    arate_batch,
+    rating_document_id,
+    rating_key
+)
+from libs.core.services.tracing import error_reason
+
+logger = logging.getLogger(__name__)
+
+class RatingQueue:
+    """Acknowledges ratings as soon as they are queued and stores them in the background.
+        A batch is flushed when batch_size ratings are pending or flush_interval_seconds
+        have passed. Identical ratings are stored once. Pending ratings are flushed
+        on shutdown. Each batch is stored with the policy of the ratings upstream."""
+
+    def __init__(
+            self,
+            options: RatingQueueOptions,
+            client_registry: ClientRegistry,
+            index_name: str,
+            upstream: Upstream | None = None
+        ):
+        self._options = options
+        self._clients = client_registry
+        self._upstream = upstream or Upstream("ratings")
+        self._index_name = index_name
+        self._pending: OrderedDict = OrderedDict()
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task = None
+        self._closing = False
+        self._counters = {"flushed": 0, "duplicates": 0, "dropped": 0, "failed": 0, "batches": 0}
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+        self._total_flush_seconds = 0.0
+
+    def submit(
+            self,
+            dialog_id: str,
+            rating: bool | None,
+            request: str,
+            response: str,
+            citations: List[dict] | None = None
+        ) -> dict:
+        """Queues the rating and returns the id of the document it will be stored as."""
+        key = rating_key(rating, request, response)
+        if key in self._pending:
+            self._counters["duplicates"] += 1
+        self._pending[key] = {
+            "key": key,
+            "rating": rating,
+            "request": request,
+            "response": response,
+            "citations": citations,
+        }
+        self._pending.move_to_end(key)
+        self._drop_overflow()
+
+        if len(self._pending) >= self._options.batch_size:
+            self._batch_ready.set()
+
+        return {"dialog_id": dialog_id, "output": [rating_document_id(key)]}
+
+    def _drop_overflow(self):
+        """Drops the oldest ratings when the ratings index cannot keep up."""
+        while len(self._pending) > self._options.max_pending:
+            self._pending.popitem(last=False)
+            self._counters["dropped"] += 1
+
+    async def flush(self):
+        """Stores every pending rating, in batches of at most batch_size."""
+        async with self._flush_lock:
+            while self._pending:
+                batch = [
+                    self._pending.popitem(last=False)[1]
+                    for _ in range(min(self._options.batch_size, len(self._pending)))
+                ]
+                if not await self._flush_batch(batch):
+                    break
+
+    async def _flush_batch(self, batch: List[dict]) -> bool:
+        start = time.perf_counter()
+        try:
+            client = await self._clients.asearch_client(self._index_name)
+            await self._upstream.acall(lambda: arate_batch(client, batch))
+        except Exception as error: # pylint: disable=broad-except
+            logger.exception("Storing %s ratings failed, they will be retried", len(batch))
+            UPSTREAM_ERRORS.inc(upstream="search", reason=error_reason(error))
+            self._counters["failed"] += len(batch)
+            # Ratings submitted again while the batch was in flight are newer, keep those.
+            for rating in reversed(batch):
+                if rating["key"] not in self._pending:
+                    self._pending[rating["key"]] = rating
+                    self._pending.move_to_end(rating["key"], last=False)
+            self._drop_overflow()
+            return False
+
+        elapsed = time.perf_counter() - start
+        self._counters["flushed"] += len(batch)
+        self._counters["batches"] += 1
+        self._last_flush_seconds = elapsed
+        self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+        self._total_flush_seconds += elapsed
+        return True
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(
+                    self._batch_ready.wait(), self._options.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+    async def astart(self):
+        """Starts flushing the queue in the background."""
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def aclose(self):
+        """Stops the background flushing and stores the ratings which are still pending.
+            A flush in progress is allowed to finish rather than cancelled."""
+        self._closing = True
+        self._batch_ready.set()
+        if self._flush_task:
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        if self._pending:
+            logger.error("%s ratings could not be stored before shutdown", len(self._pending))
+
+    def stats(self) -> dict:
+        """Returns the queue depth, the flush latencies and the counters of the queue."""
+        batches = self._counters["batches"]
+        return {
+            "queue_depth": len(self._pending),
+            **self._counters,
+            "last_flush_seconds": self._last_flush_seconds,
+            "max_flush_seconds": self._max_flush_seconds,
+            "mean_flush_seconds": self._total_flush_seconds / batches if batches else 0.0,
+        }
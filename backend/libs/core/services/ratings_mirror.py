@@ -0,0 +1,313 @@
+"""Local, memory-mapped read replica of the ratings index."""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import List, Tuple
+
+import numpy as np
+from langchain_community.vectorstores.azuresearch import (
+    FIELDS_CONTENT,
+    FIELDS_CONTENT_VECTOR,
+    FIELDS_ID,
+    FIELDS_METADATA
+)
+from langchain_core.documents import Document
+
+from libs.core.models.options import RatingsMirrorOptions
+from libs.core.services.client_registry import ClientRegistry
+from libs.core.services.search_vector_index_service import _to_document
+
+logger = logging.getLogger(__name__)
+
+# Ids per filtered search when fetching new rows, which keeps the filter well within its length limit.
+_FETCH_BATCH_SIZE = 50
+# The files of a generation of the mirror.
+_EXTENSIONS = {"vectors": "f32", "offsets": "i64", "payloads": "bin", "ids": "json"}
+
+def _vector_score(similarities: np.ndarray) -> np.ndarray:
+    """The score AI Search gives a cosine similarity, so min_score means the same for both."""
+    return 1.0 / (2.0 - similarities)
+
+class RatingsMirror:
+    """Keeps a copy of the ratings index in memory-mapped files, and answers vector
+        searches from it: a float32 matrix of normalized vectors, a blob of the rows'
+        JSON payloads and the int64 offsets of each payload in the blob.
+
+        One worker per host holds a file lock and syncs the files from the index,
+        fetching only the rows whose ids it has not seen. Only the leader reads the ids;
+        the other workers read the small metadata file and map the rest, so each
+        payload is only parsed when its row is returned. Rows are appended to the
+        files, so readers keep their mapping; when rows were deleted the files are
+        written to a new generation instead. Every worker maps the same files,
+        so the mirror is held once in the page cache however many workers run."""
+
+    def __init__(self, options: RatingsMirrorOptions, client_registry: ClientRegistry, index_name: str):
+        self._options = options
+        self._clients = client_registry
+        self._index_name = index_name
+        self._metadata_path = os.path.join(options.path, "metadata.json")
+        self._lock_path = os.path.join(options.path, "sync.lock")
+        self._lock_file = None
+        self._loaded_stamp = None
+        # The vectors, offsets and payloads are replaced together, so a search never mixes two loads.
+        self._snapshot: Tuple[np.ndarray | None, np.ndarray | None, np.ndarray | None] = (None, None, None)
+        self._rows = 0
+        self._sync_task: asyncio.Task = None
+        self._counters = {"syncs": 0, "sync_failures": 0, "rows_fetched": 0, "reloads": 0}
+        self._last_sync_seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        """Whether the mirror holds rows it can search."""
+        return self._snapshot[0] is not None
+
+    def search(self, vector: List[float], number_of_results: int) -> List[Tuple[Document, float]]:
+        """Cosine top k search of the mirrored ratings, scored like a vector search of the index."""
+        vectors, offsets, payloads = self._snapshot
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if vectors is None or not norm or query.shape[0] != vectors.shape[1] or number_of_results < 1:
+            return []
+
+        similarities = vectors @ (query / norm)
+        k = min(number_of_results, similarities.shape[0])
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        scores = _vector_score(similarities[top])
+        documents = []
+        for i, score in zip(top, scores):
+            row = json.loads(payloads[offsets[i]:offsets[i + 1]].tobytes())
+            documents.append((Document(page_content=row["content"], metadata=row["metadata"]), float(score)))
+        return documents
+
+    def _path(self, name: str, generation: int) -> str:
+        return os.path.join(self._options.path, f"{name}-{generation}.{_EXTENSIONS[name]}")
+
+    def _read_metadata(self) -> dict | None:
+        try:
+            with open(self._metadata_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_json(self, path: str, value):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(temporary_path, path)
+
+    def _read_ids(self, metadata: dict) -> List[str]:
+        """The ids of the mirrored rows. The ids file may list rows past a failed write."""
+        if not metadata["rows"]:
+            return []
+        with open(self._path("ids", metadata["generation"]), "r", encoding="utf-8") as file:
+            return json.load(file)[:metadata["rows"]]
+
+    def reload(self):
+        """Maps the files again when the leader has changed them since the last load."""
+        try:
+            stat = os.stat(self._metadata_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._loaded_stamp:
+            return
+
+        metadata = self._read_metadata()
+        rows, generation = metadata["rows"], metadata["generation"]
+        snapshot = (None, None, None)
+        if rows:
+            vectors = np.memmap(
+                self._path("vectors", generation), dtype=np.float32, mode="r",
+                shape=(rows, metadata["dimensions"]))
+            offsets = np.memmap(self._path("offsets", generation), dtype=np.int64, mode="r", shape=(rows + 1,))
+            payloads = np.memmap(
+                self._path("payloads", generation), dtype=np.uint8, mode="r", shape=(int(offsets[rows]),))
+            snapshot = (vectors, offsets, payloads)
+        self._snapshot = snapshot
+        self._rows = rows
+        self._loaded_stamp = stamp
+        self._counters["reloads"] += 1
+
+    def _try_lead(self) -> bool:
+        """Takes the sync lock, unless another worker holds it."""
+        if self._lock_file:
+            return True
+        lock_file = open(self._lock_path, "a+b") # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _aindex_ids(self, client) -> List[str]:
+        """Lists the ids of every rating. The ratings index has no field telling when
+            a rating changed, and a deleted rating only shows by its id missing, so each
+            sync lists them all. Only the ids are returned, a few dozen bytes per rating,
+            and only the leader of each host lists them once per sync interval, which is
+            cheap for the tens of thousands of ratings expected. Past the 100,000 results
+            AI Search pages through, the sync would need a change marker in the index."""
+        results = await client.async_client.search(search_text="*", select=[FIELDS_ID])
+        return [result[FIELDS_ID] async for result in results]
+
+    async def _afetch_rows(self, client, ids: List[str]) -> List[dict]:
+        rows = []
+        for start in range(0, len(ids), _FETCH_BATCH_SIZE):
+            batch = ids[start:start + _FETCH_BATCH_SIZE]
+            results = await client.async_client.search(
+                search_text="*",
+                filter=f"search.in({FIELDS_ID}, '{','.join(batch)}', ',')",
+                select=[FIELDS_ID, FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, FIELDS_METADATA],
+                top=len(batch))
+            async for result in results:
+                document = _to_document(result)
+                rows.append({
+                    "id": result[FIELDS_ID],
+                    "payload": json.dumps(
+                        {"content": document.page_content, "metadata": document.metadata}).encode("utf-8"),
+                    "vector": result[FIELDS_CONTENT_VECTOR],
+                })
+        return rows
+
+    @staticmethod
+    def _normalized(rows: List[dict]) -> np.ndarray:
+        vectors = np.asarray([row["vector"] for row in rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    async def sync(self):
+        """Brings the files up to date with the index, fetching only the rows not mirrored yet.
+            The files are written in a worker thread to keep the event loop free."""
+        start = time.perf_counter()
+        client = await self._clients.asearch_client(self._index_name)
+        metadata = self._read_metadata() or {"generation": 0, "dimensions": 0, "rows": 0}
+        index_ids = await self._aindex_ids(client)
+
+        known_ids = self._read_ids(metadata)
+        known = set(known_ids)
+        new_rows = await self._afetch_rows(client, [i for i in index_ids if i not in known])
+        removed = known - set(index_ids)
+        if new_rows or removed:
+            await asyncio.to_thread(self._write_rows, metadata, known_ids, new_rows, removed)
+            self._counters["rows_fetched"] += len(new_rows)
+
+        self._counters["syncs"] += 1
+        self._last_sync_seconds = time.perf_counter() - start
+
+    def _write_rows(self, metadata: dict, ids: List[str], new_rows: List[dict], removed: set):
+        """Appends the new rows, or writes a new generation when rows were removed.
+            The metadata is replaced last, so readers never see rows before their data."""
+        generation, count = metadata["generation"], metadata["rows"]
+        new_vectors = self._normalized(new_rows) if new_rows else None
+        new_payloads = [row["payload"] for row in new_rows]
+        new_ids = [row["id"] for row in new_rows]
+
+        if removed:
+            kept = [i for i, row_id in enumerate(ids) if row_id not in removed]
+            vectors = np.fromfile(self._path("vectors", generation), dtype=np.float32).reshape(
+                -1, metadata["dimensions"])[kept]
+            if new_vectors is not None:
+                vectors = np.concatenate([vectors, new_vectors])
+            payloads = self._read_payloads(generation, count, kept) + new_payloads
+            ids = [ids[i] for i in kept] + new_ids
+            old_paths = [self._path(name, generation) for name in _EXTENSIONS]
+            generation += 1
+            vectors.tofile(self._path("vectors", generation))
+            with open(self._path("payloads", generation), "wb") as file:
+                file.write(b"".join(payloads))
+            self._offsets(0, payloads).tofile(self._path("offsets", generation))
+            self._write_json(self._path("ids", generation), ids)
+            self._write_json(self._metadata_path, {
+                "generation": generation,
+                "dimensions": vectors.shape[1] if ids else 0,
+                "rows": len(ids),
+            })
+            for old_path in old_paths:
+                if os.path.exists(old_path):
+                    # Workers which still map the old files keep reading them until they reload.
+                    os.remove(old_path)
+            return
+
+        # Data past the end of the old metadata is never read, so a failed append is harmless.
+        end = self._payloads_end(generation, count)
+        with open(self._path("vectors", generation), "ab") as file:
+            file.truncate(count * metadata["dimensions"] * 4)
+            new_vectors.tofile(file)
+        with open(self._path("payloads", generation), "ab") as file:
+            file.truncate(end)
+            file.write(b"".join(new_payloads))
+        with open(self._path("offsets", generation), "ab") as file:
+            file.truncate((count + 1) * 8 if count else 0)
+            offsets = self._offsets(end, new_payloads)
+            (offsets[1:] if count else offsets).tofile(file)
+        self._write_json(self._path("ids", generation), ids + new_ids)
+        self._write_json(self._metadata_path, {
+            "generation": generation,
+            "dimensions": new_vectors.shape[1],
+            "rows": count + len(new_rows),
+        })
+
+    @staticmethod
+    def _offsets(start: int, payloads: List[bytes]) -> np.ndarray:
+        """The offsets of the payloads written from start, followed by the end of the last one."""
+        return start + np.cumsum([0] + [len(payload) for payload in payloads], dtype=np.int64)
+
+    def _payloads_end(self, generation: int, count: int) -> int:
+        if not count:
+            return 0
+        return int(np.fromfile(self._path("offsets", generation), dtype=np.int64, count=count + 1)[count])
+
+    def _read_payloads(self, generation: int, count: int, kept: List[int]) -> List[bytes]:
+        offsets = np.fromfile(self._path("offsets", generation), dtype=np.int64, count=count + 1)
+        with open(self._path("payloads", generation), "rb") as file:
+            blob = file.read(int(offsets[count]))
+        return [blob[offsets[i]:offsets[i + 1]] for i in kept]
+
+    async def _run(self):
+        while True:
+            if self._try_lead():
+                try:
+                    await self.sync()
+                except Exception: # pylint: disable=broad-except
+                    logger.exception("Syncing the ratings mirror failed")
+                    self._counters["sync_failures"] += 1
+            try:
+                self.reload()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Loading the ratings mirror failed")
+            await asyncio.sleep(self._options.sync_interval_seconds)
+
+    async def astart(self):
+        """Loads the mirror and starts syncing it in the background."""
+        if self._sync_task:
+            return
+        os.makedirs(self._options.path, exist_ok=True)
+        self.reload()
+        self._sync_task = asyncio.create_task(self._run())
+
+    async def aclose(self):
+        """Stops syncing and releases the sync lock, so another worker can take it over."""
+        if self._sync_task:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def stats(self) -> dict:
+        """Returns the size of the mirror and the counters of its syncs."""
+        return {
+            "rows": self._rows,
+            "leader": self._lock_file is not None,
+            **self._counters,
+            "last_sync_seconds": self._last_sync_seconds,
+        }
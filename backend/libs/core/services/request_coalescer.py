@@ -0,0 +1,93 @@
+"""Single-flight execution of identical requests, with a short-lived result cache."""
+import asyncio
+import hashlib
+import json
+from typing import Awaitable, Callable, Dict
+
+from pydantic import BaseModel
+
+from libs.core.models.options import RequestCoalescingOptions
+from libs.core.services.deadline import Deadline
+from libs.core.services.embedding_cache import normalize_text
+from libs.core.services.metrics import COALESCED_REQUESTS
+from libs.core.services.ttl_lru_cache import TtlLruCache
+
+def config_fingerprint(*options: BaseModel) -> str:
+    """Hash of the options an answer depends on, so a configuration change never reuses old answers."""
+    settings = json.dumps([option.model_dump(mode="json") for option in options], sort_keys=True)
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+class RequestCoalescer:
+    """Runs identical concurrent requests once and shares the result with every caller.
+        Requests are identical when their normalized text and the configuration
+        fingerprint match. Results are kept for result_ttl_seconds, which absorbs the
+        burst of repeats which follows, e.g. during an incident. Failures, and results
+        marked as degraded such as the default answer given while an upstream is down,
+        are shared with the callers waiting on them but never cached. The shared execution is
+        cancelled once every caller waiting on it has gone away.
+
+        Callers short on time only share an execution with each other, since it gives a
+        shortened answer, which is not cached either. Callers with time to spare never
+        wait on such an execution, and callers short on time never wait on a full one."""
+
+    def __init__(self, options: RequestCoalescingOptions, fingerprint: str):
+        self._options = options
+        self._fingerprint = fingerprint
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self._results = TtlLruCache(options.max_entries, options.result_ttl_seconds)
+
+    def key(self, text: str) -> str:
+        """The key shared by the requests which get the same answer."""
+        return f"{self._fingerprint}:{normalize_text(text)}"
+
+    async def run(
+            self,
+            text: str,
+            execute: Callable[[], Awaitable[dict]],
+            deadline: Deadline | None = None
+        ) -> dict:
+        """Returns the result of execute for the text, running it at most once at a time per
+            key and class of deadline."""
+        if not self._options.enabled:
+            return await execute()
+
+        key = self.key(text)
+        result = self._results.get(key)
+        if result is not None:
+            COALESCED_REQUESTS.inc(source="cache")
+            return result
+
+        short = deadline is not None and deadline.short
+        flight = f"{key}:short" if short else key
+        task = self._in_flight.get(flight)
+        if task is None:
+            task = asyncio.create_task(self._execute(flight, None if short else key, execute))
+            self._in_flight[flight] = task
+        else:
+            COALESCED_REQUESTS.inc(source="in_flight")
+
+        self._waiters[flight] = self._waiters.get(flight, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[flight] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[flight] -= 1
+            if not self._waiters[flight]:
+                del self._waiters[flight]
+
+    async def _execute(self, flight: str, key: str | None, execute: Callable[[], Awaitable[dict]]) -> dict:
+        try:
+            result = await execute()
+            if key and not result.get("degraded"):
+                self._results.set(key, result)
+            return result
+        finally:
+            del self._in_flight[flight]
+
+    def stats(self) -> dict:
+        """Returns the requests in flight and the counters of the result cache."""
+        return {"in_flight": len(self._in_flight), **self._results.stats()}
@@ -0,0 +1,366 @@
+"""Timeouts, jittered retries, circuit breakers and hedged requests for the upstream calls."""
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, TypeVar
+from uuid import UUID
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+from libs.core.models.options import ResilienceOptions, UpstreamPolicyOptions
+from libs.core.services.metrics import CIRCUIT_REJECTED, UPSTREAM_HEDGES, UPSTREAM_RETRIES
+from libs.core.services.tracing import error_reason, status_code
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Status codes of the responses which are worth retrying: throttling and transient failures.
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+# The latencies per hedge key the percentile is taken from.
+LATENCY_WINDOW = 1000
+# Metadata key of an LLM call holding the circuit breaker trial it makes, if any.
+CIRCUIT_TRIAL = "circuit_trial"
+
+try:
+    from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+    _TRANSPORT_ERRORS: tuple = (ServiceRequestError, ServiceResponseError)
+except ImportError: # pragma: no cover - the Azure SDK is always installed with the app
+    _TRANSPORT_ERRORS = ()
+try:
+    from openai import APIConnectionError
+    _TRANSPORT_ERRORS += (APIConnectionError,)
+except ImportError: # pragma: no cover
+    pass
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(f"The circuit of {upstream} is open, retrying in {retry_in:.1f}s")
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether the call failed because the upstream was throttling, slow or unreachable,
+        rather than because of the request itself."""
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError) + _TRANSPORT_ERRORS):
+        return True
+    return status_code(error) in RETRYABLE_STATUS_CODES
+
+def retry_after(error: BaseException) -> float | None:
+    """The seconds the upstream asked to wait before retrying, from its Retry-After header."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header in ("retry-after-ms", "retry-after"):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            continue
+        return seconds / 1000 if header == "retry-after-ms" else seconds
+    return None
+
+class CircuitBreaker:
+    """Fails the calls at once after failure_threshold consecutive calls failed.
+        After open_seconds one trial call is let through: its success closes the
+        circuit, its failure opens it again. A trial which never reports back is
+        given up after open_seconds, so the circuit cannot stay half open. The trial
+        is identified by the token before_call returned, so only its own cancellation
+        gives it up early."""
+
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_at: float | None = None
+        self._trial: int | None = None
+        self._tokens = itertools.count(1)
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        """closed, open or half_open."""
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._trial_at is not None else "open"
+
+    def before_call(self, take_trial: bool = True) -> int | None:
+        """Raises CircuitOpenError unless the call may go ahead. Returns the token of
+            the trial when the call is the trial of a half open circuit, otherwise None.
+            Without take_trial the trial is left for a later call."""
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            now = time.monotonic()
+            if self._trial_at is not None and now - self._trial_at >= self._open_seconds:
+                self._trial_at = self._trial = None
+            retry_in = self._opened_at + self._open_seconds - now
+            if retry_in > 0 or self._trial_at is not None:
+                self._rejected += 1
+                CIRCUIT_REJECTED.inc(upstream=self._name)
+                raise CircuitOpenError(self._name, max(retry_in, 0.0))
+            if not take_trial:
+                return None
+            self._trial_at = now
+            self._trial = next(self._tokens)
+            return self._trial
+
+    def record_success(self):
+        """Closes the circuit."""
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("The circuit of %s closed", self._name)
+            self._failures = 0
+            self._opened_at = self._trial_at = self._trial = None
+
+    def record_failure(self):
+        """Counts a failed call, and opens the circuit after failure_threshold of them."""
+        with self._lock:
+            self._failures += 1
+            if self._trial_at is not None or (
+                    self._opened_at is None and self._failures >= self._failure_threshold):
+                logger.warning("The circuit of %s opened after %d failed calls", self._name, self._failures)
+                self._opened_at = time.monotonic()
+            self._trial_at = self._trial = None
+
+    def release(self, trial: int | None):
+        """Gives up the trial call with the token when it was cancelled, letting the next
+            call try. A cancelled call which was not the current trial changes nothing."""
+        with self._lock:
+            if trial is not None and trial == self._trial:
+                self._trial_at = self._trial = None
+
+    def stats(self) -> dict:
+        """Returns the state of the circuit."""
+        return {
+            "circuit": self.state,
+            "consecutive_failures": self._failures,
+            "rejected": self._rejected,
+        }
+
+class _CircuitRecorder(BaseCallbackHandler):
+    """Reports the outcome of the LLM calls to the circuit breaker of the upstream.
+        A call made as the trial of the circuit carries its token in the CIRCUIT_TRIAL
+        metadata, so its cancellation gives up the trial."""
+
+    run_inline = True
+
+    def __init__(self, upstream: "Upstream"):
+        self._upstream = upstream
+        self._runs: Dict[UUID, int | None] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata=None, **kwargs: Any):
+        self._runs[run_id] = (metadata or {}).get(CIRCUIT_TRIAL)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        if run_id in self._runs:
+            del self._runs[run_id]
+            self._upstream.breaker.record_success()
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        if run_id not in self._runs:
+            return
+        trial = self._runs.pop(run_id)
+        if isinstance(error, asyncio.CancelledError):
+            self._upstream.breaker.release(trial)
+        else:
+            self._upstream.record_outcome(error)
+
+class Upstream:
+    """Applies the policy of one upstream to its calls. Without a policy the calls are
+        made as they are, and a CircuitOpenError is never raised."""
+
+    def __init__(self, name: str, policy: UpstreamPolicyOptions | None = None):
+        self.name = name
+        self.policy = policy
+        self.breaker = CircuitBreaker(name, policy.failure_threshold, policy.open_seconds) if policy else None
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def check(self, take_trial: bool = True) -> int | None:
+        """Raises CircuitOpenError when the upstream should not be called. Returns the
+            token of the trial when the call is the trial of the circuit."""
+        return self.breaker.before_call(take_trial) if self.breaker else None
+
+    def record_outcome(self, error: BaseException | None):
+        """Reports a call the upstream answered, or the error it failed with. Errors caused by
+            the request rather than the upstream do not count against the circuit."""
+        if error is None or not is_retryable(error):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def recorder(self) -> BaseCallbackHandler | None:
+        """Returns a callback which reports the LLM calls to the circuit breaker, for chat
+            models which are retried by their SDK."""
+        return _CircuitRecorder(self) if self.policy else None
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        """Full jitter: a random wait of up to base * 2^attempt, unless the upstream asked for one."""
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.policy.backoff_max_seconds)
+        ceiling = min(self.policy.backoff_max_seconds, self.policy.backoff_base_seconds * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _should_retry(self, attempt: int, error: BaseException) -> bool:
+        if attempt >= self.policy.max_retries or not is_retryable(error):
+            return False
+        self._counters["retries"] += 1
+        UPSTREAM_RETRIES.inc(upstream=self.name, reason=error_reason(error))
+        logger.info("Retrying %s after %s", self.name, error_reason(error))
+        return True
+
+    def call(self, func: Callable[[], T]) -> T:
+        """Calls func with the retries and the circuit breaker of the policy. The sync
+            clients are given the timeout of the policy when they are created."""
+        if not self.policy:
+            return func()
+        self.check()
+        self._counters["calls"] += 1
+        attempt = 0
+        while True:
+            try:
+                result = func()
+            except Exception as error: # pylint: disable=broad-except
+                if self._should_retry(attempt, error):
+                    time.sleep(self._backoff(attempt, error))
+                    attempt += 1
+                    continue
+                self.record_outcome(error)
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, afunc: Callable[[], Awaitable[T]], hedge_key: str | None = None) -> T:
+        """Awaits afunc() with the timeout, retries and circuit breaker of the policy.
+            With a hedge key, an attempt slower than the hedge percentile of the recent
+            calls with the same key is started a second time, and the first result wins."""
+        if not self.policy:
+            return await afunc()
+        trial = self.check()
+        self._counters["calls"] += 1
+        attempt = 0
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    result = await asyncio.wait_for(self._attempt(afunc, hedge_key), self.policy.timeout_seconds)
+                except Exception as error: # pylint: disable=broad-except
+                    if self._should_retry(attempt, error):
+                        await asyncio.sleep(self._backoff(attempt, error))
+                        attempt += 1
+                        continue
+                    self.record_outcome(error)
+                    raise
+                self._record_latency(hedge_key, time.monotonic() - start)
+                self.breaker.record_success()
+                return result
+        except asyncio.CancelledError:
+            self.breaker.release(trial)
+            raise
+
+    def _record_latency(self, hedge_key: str | None, seconds: float):
+        if hedge_key is None or self.policy.hedge_percentile is None:
+            return
+        self._latencies.setdefault(hedge_key, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def hedge_delay(self, hedge_key: str | None) -> float | None:
+        """The latency after which a call with the key is hedged, None until enough calls were measured."""
+        if hedge_key is None or self.policy.hedge_percentile is None:
+            return None
+        latencies = self._latencies.get(hedge_key)
+        if not latencies or len(latencies) < self.policy.hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.policy.hedge_percentile / 100))
+        return ordered[index]
+
+    async def _attempt(self, afunc: Callable[[], Awaitable[T]], hedge_key: str | None) -> T:
+        delay = self.hedge_delay(hedge_key)
+        if delay is None:
+            return await afunc()
+
+        tasks: List[asyncio.Task] = [asyncio.ensure_future(afunc())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self._counters["hedges"] += 1
+                UPSTREAM_HEDGES.inc(upstream=self.name)
+                tasks.append(asyncio.ensure_future(afunc()))
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if not task.exception()]
+                if succeeded:
+                    if succeeded[0] is not tasks[0]:
+                        self._counters["hedge_wins"] += 1
+                    return succeeded[0].result()
+                if not pending:
+                    # Every request failed, the error of the first one is raised.
+                    return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        """Returns the counters of the calls and the state of the circuit."""
+        if not self.policy:
+            return {}
+        return self._counters | self.breaker.stats()
+
+class ResilientEmbeddings(Embeddings):
+    """Embeddings whose calls go through the policy of an upstream."""
+
+    def __init__(self, embeddings: Embeddings, upstream: Upstream):
+        self._embeddings = embeddings
+        self._upstream = upstream
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._upstream.call(lambda: self._embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._upstream.call(lambda: self._embeddings.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._upstream.acall(lambda: self._embeddings.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._upstream.acall(lambda: self._embeddings.aembed_query(text))
+
+class Resilience:
+    """The upstreams of the application, each with the policy configured for it."""
+
+    def __init__(self, options: ResilienceOptions | None = None):
+        policies = options.upstreams if options and options.enabled else {}
+        self._policies = policies
+        self._upstreams: Dict[str, Upstream] = {}
+        self._lock = threading.Lock()
+
+    def policy(self, name: str) -> UpstreamPolicyOptions | None:
+        """Returns the policy of the upstream, None when it keeps the SDK defaults."""
+        return self._policies.get(name)
+
+    def upstream(self, name: str) -> Upstream:
+        """Returns the shared upstream of the given name."""
+        with self._lock:
+            if name not in self._upstreams:
+                self._upstreams[name] = Upstream(name, self.policy(name))
+            return self._upstreams[name]
+
+    def stats(self) -> Dict[str, dict]:
+        """Returns the counters and the circuit of every upstream with a policy."""
+        with self._lock:
+            upstreams = list(self._upstreams.values())
+        return {upstream.name: upstream.stats() for upstream in upstreams if upstream.policy}
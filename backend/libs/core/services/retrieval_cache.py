@@ -0,0 +1,145 @@
+"""Cache of index search results keyed by index, query and filters."""
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Hashable, List, Tuple
+
+from langchain_core.documents import Document
+
+from libs.core.models.options import RetrievalCacheOptions
+from libs.core.services.embedding_cache import normalize_text
+from libs.core.services.ttl_lru_cache import TtlLruCache
+
+ScoredDocument = Tuple[Document, float, float]
+
+class RetrievalCache:
+    """Keeps the ranked results of index searches, so a repeated query skips both the
+        hybrid search and the semantic rerank. Results are stored compactly as
+        (content, metadata JSON, score, reranker score) tuples and rebuilt into new
+        documents on every hit, so callers cannot change what is cached.
+
+        An entry fetched with k results also answers the same query with a smaller k.
+        Keys include the content version of the index, so invalidating an index also
+        keeps searches which were in flight from storing results of the old content.
+
+        With a versions_path, the content versions are kept in a file shared by the
+        workers of the host, so an invalidation received by one worker stops every
+        worker from serving the old results. Without it, or on other hosts, the old
+        results are served until they expire."""
+
+    def __init__(self, options: RetrievalCacheOptions):
+        self._enabled = options.enabled
+        self._entries = TtlLruCache(options.max_entries, options.ttl_seconds)
+        self._versions_path = options.versions_path or None
+        self._loaded_stamp = None
+        self._versions: Dict[str, str] = {}
+        # Bumped when every index is invalidated at once.
+        self._generation = 0
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def key(self, index_name: str, query: str, filters: str | None) -> Hashable | None:
+        """The key of the query at the current content version of the index, or None when disabled."""
+        if not self._enabled:
+            return None
+        self._load_versions()
+        return (index_name, self._versions.get(index_name), self._generation,
+            normalize_text(query), filters)
+
+    def _load_versions(self):
+        """Reads the content versions again when another worker has changed them."""
+        if not self._versions_path:
+            return
+        try:
+            stat = os.stat(self._versions_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp == self._loaded_stamp:
+            return
+        with open(self._versions_path, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        with self._lock:
+            self._versions = state["versions"]
+            self._generation = state["generation"]
+            self._invalidations = state["invalidations"]
+            self._loaded_stamp = stamp
+
+    def _save_versions(self):
+        temporary_path = f"{self._versions_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump({
+                "versions": self._versions,
+                "generation": self._generation,
+                "invalidations": self._invalidations,
+            }, file)
+        os.replace(temporary_path, self._versions_path)
+
+    @contextmanager
+    def _versions_lock(self):
+        """Keeps the other workers from changing the shared versions meanwhile."""
+        if not self._versions_path:
+            yield
+            return
+        with open(f"{self._versions_path}.lock", "a+b") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key: Hashable | None, k: int) -> List[ScoredDocument] | None:
+        """Returns the k best cached results, or None when fewer were fetched."""
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        fetched_k, results = entry
+        if fetched_k < k and len(results) == fetched_k:
+            # The index may hold more results than were fetched.
+            return None
+        return [
+            (Document(page_content=content, metadata=json.loads(metadata)), score, reranker_score)
+            for content, metadata, score, reranker_score in results[:k]
+        ]
+
+    def set(self, key: Hashable | None, k: int, results: List[ScoredDocument]):
+        """Stores the results of a search for k documents."""
+        if key is None:
+            return
+        compact = tuple(
+            (document.page_content, json.dumps(document.metadata, default=str), score, reranker_score)
+            for document, score, reranker_score in results
+        )
+        self._entries.set(key, (k, compact))
+
+    def invalidate(self, index_name: str | None = None, version: str | None = None) -> int:
+        """Drops the cached results of the index, or of every index, because its content changed.
+            With a version, an index already at that version is left alone, so a re-indexing
+            pipeline can report its version more than once. Returns the number of results this
+            worker dropped; the other workers sharing the versions drop theirs on their next search."""
+        with self._versions_lock():
+            self._load_versions()
+            with self._lock:
+                if index_name and version is not None and self._versions.get(index_name) == version:
+                    return 0
+                self._invalidations += 1
+                if not index_name:
+                    self._generation = self._invalidations
+                else:
+                    self._versions = self._versions | {
+                        index_name: version if version is not None else f"#{self._invalidations}"}
+                if self._versions_path:
+                    self._save_versions()
+        if index_name:
+            return self._entries.invalidate(lambda key: key[0] == index_name)
+        dropped = len(self._entries)
+        self._entries.clear()
+        return dropped
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache and the content versions of the indexes."""
+        return {**self._entries.stats(), "versions": dict(self._versions)}
@@ -1,17 +1,44 @@
 """Module to generate SAS token for Azure Blob Storage"""
+import asyncio
+import logging
 from datetime import datetime, timedelta, timezone
 from dateutil.parser import isoparse
-from azure.storage.blob import generate_blob_sas, BlobServiceClient, BlobSasPermissions, UserDelegationKey
+from azure.storage.blob import (
+    generate_blob_sas,
+    generate_container_sas,
+    BlobServiceClient,
+    BlobSasPermissions,
+    ContainerSasPermissions,
+    UserDelegationKey
+)
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from libs.core.models.options import StorageAccountOptions
+from libs.core.services.metrics import SAS_SIGNING_SECONDS
+from libs.core.services.tracing import observe
+from libs.core.services.ttl_lru_cache import TtlLruCache
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before retrying a failed background refresh of the user delegation key.
+_REFRESH_RETRY_SECONDS = 30
 
 class SasTokenService:
-    """Manage the generation of SAS tokens for Azure Blob Storage."""
+    """Manage the generation of SAS tokens for Azure Blob Storage.
+        Tokens are cached per blob, or per container, and reused while enough of their
+        lifetime remains. With managed identity the user delegation key is refreshed
+        by a background task well before it expires."""
 
     def __init__(self, storage_account_options: StorageAccountOptions):
         self._storage_account_options = storage_account_options
         self._blob_service_client: BlobServiceClient = None
+        self._async_blob_service_client: AsyncBlobServiceClient = None
+        self._async_credential: AsyncDefaultAzureCredential = None
         self._user_delegation_key: UserDelegationKey = None
+        self._user_delegation_key_lock = asyncio.Lock()
+        self._refresh_task: asyncio.Task = None
+        self._tokens = TtlLruCache(storage_account_options.sas_cache_max_entries)
 
     def _create_blob_service_client(self):
         """Create a BlobServiceClient based on the connection string."""
@@ -25,47 +52,208 @@ class SasTokenService:
                 credential=DefaultAzureCredential()
             )
 
+    def _create_async_blob_service_client(self):
+        """Create the async BlobServiceClient used to fetch user delegation keys."""
+        self._async_credential = AsyncDefaultAzureCredential()
+        self._async_blob_service_client = AsyncBlobServiceClient(
+            self._storage_account_options.url,
+            credential=self._async_credential
+        )
+
+    def _user_delegation_key_expiry(self) -> datetime:
+        return isoparse(self._user_delegation_key.signed_expiry)
+
+    def _user_delegation_key_expired(self) -> bool:
+        return (not self._user_delegation_key
+            or self._user_delegation_key_expiry() < datetime.now(timezone.utc))
+
+    def _user_delegation_key_window(self):
+        now = datetime.now(timezone.utc)
+        lifetime = timedelta(seconds=self._storage_account_options.user_delegation_key_lifetime_seconds)
+        return {"key_start_time": now, "key_expiry_time": now + lifetime}
+
     def _get_user_delegation_key(self):
         """Get the user delegation key for the storage account."""
         if not self._blob_service_client:
             self._create_blob_service_client()
 
-        if not self._user_delegation_key or isoparse(self._user_delegation_key.signed_expiry) < datetime.now(timezone.utc):
-            self._user_delegation_key = self._blob_service_client.get_user_delegation_key(
-                key_start_time=datetime.now(timezone.utc),
-                key_expiry_time=datetime.now(timezone.utc) + timedelta(hours=1)
-            )
+        if self._user_delegation_key_expired():
+            with observe("get_user_delegation_key", upstream="blob"):
+                self._user_delegation_key = self._blob_service_client.get_user_delegation_key(
+                    **self._user_delegation_key_window())
 
         return self._user_delegation_key
 
-    def get_sas_token_for_blob(
+    async def _fetch_user_delegation_key(self):
+        if not self._async_blob_service_client:
+            self._create_async_blob_service_client()
+
+        with observe("get_user_delegation_key", upstream="blob"):
+            self._user_delegation_key = await self._async_blob_service_client.get_user_delegation_key(
+                **self._user_delegation_key_window())
+
+    async def _aget_user_delegation_key(self):
+        """Get the user delegation key for the storage account without blocking the event loop.
+            Concurrent requests share a single fetch. Only waits when the background
+            refresh has not produced a valid key."""
+        if not self._user_delegation_key_expired():
+            return self._user_delegation_key
+
+        async with self._user_delegation_key_lock:
+            if self._user_delegation_key_expired():
+                await self._fetch_user_delegation_key()
+
+        return self._user_delegation_key
+
+    def _seconds_until_refresh(self) -> float:
+        """The key is replaced while it can still sign a token for the full SAS expiry."""
+        refresh_at = (self._user_delegation_key_expiry()
+            - timedelta(seconds=self._storage_account_options.sas_expiry_seconds
+                + self._storage_account_options.sas_min_remaining_seconds))
+        return max(_REFRESH_RETRY_SECONDS, (refresh_at - datetime.now(timezone.utc)).total_seconds())
+
+    async def _refresh_user_delegation_key(self):
+        while True:
+            try:
+                async with self._user_delegation_key_lock:
+                    await self._fetch_user_delegation_key()
+                delay = self._seconds_until_refresh()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Refreshing the user delegation key failed")
+                delay = _REFRESH_RETRY_SECONDS
+            await asyncio.sleep(delay)
+
+    async def astart(self):
+        """Fetches the user delegation key and starts refreshing it ahead of its expiry,
+            so no request waits on key issuance. Does nothing when the account key is used."""
+        if self._storage_account_options.use_account_key or self._refresh_task:
+            return
+        self._refresh_task = asyncio.create_task(self._refresh_user_delegation_key())
+
+    async def awarm(self):
+        """Fetches the user delegation key, sharing the fetch of the background refresh,
+            so the first citation does not wait for it. Does nothing when the account key is used."""
+        if not self._storage_account_options.use_account_key:
+            await self._aget_user_delegation_key()
+
+    def _cache_key(self, blob_name: str, container_name: str):
+        if self._storage_account_options.sas_scope == "container":
+            return (container_name, None)
+        return (container_name, blob_name)
+
+    def _generate_sas_token(
         self,
         blob_name: str,
         container_name: str,
-        expiry: int = 3600
+        expiry: int,
+        user_delegation_key: UserDelegationKey = None
     ):
-        """Generates a SAS token for the given blob."""
+        """Signs the SAS token locally, with either the account key or the user delegation key.
+            Returns the token and when it expires."""
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=expiry)
+        if user_delegation_key:
+            # A token is only valid for as long as the key it was signed with.
+            expires_at = min(expires_at, isoparse(user_delegation_key.signed_expiry))
 
-        if not self._blob_service_client:
-            self._create_blob_service_client()
+        credentials = (
+            {"account_key": self._storage_account_options.account_key}
+            if self._storage_account_options.use_account_key
+            else {"user_delegation_key": user_delegation_key}
+        )
 
-        if self._storage_account_options.use_account_key:
-            sas_token = generate_blob_sas(
+        if self._storage_account_options.sas_scope == "container":
+            sas_token = generate_container_sas(
                 account_name=self._storage_account_options.account_name,
                 container_name=container_name,
-                blob_name=blob_name,
-                account_key=self._storage_account_options.account_key,
-                permission=BlobSasPermissions(read=True),
-                expiry=datetime.now(timezone.utc) + timedelta(seconds=expiry)
+                permission=ContainerSasPermissions(read=True),
+                expiry=expires_at,
+                **credentials
             )
         else:
             sas_token = generate_blob_sas(
                 account_name=self._storage_account_options.account_name,
                 container_name=container_name,
                 blob_name=blob_name,
-                user_delegation_key=self._get_user_delegation_key(),
                 permission=BlobSasPermissions(read=True),
-                expiry=datetime.now(timezone.utc) + timedelta(seconds=expiry)
+                expiry=expires_at,
+                **credentials
             )
 
+        return sas_token, expires_at
+
+    def _cache_token(self, cache_key, sas_token: str, expires_at: datetime):
+        """Keeps the token until less than the minimum remaining lifetime is left."""
+        reusable_for = ((expires_at - datetime.now(timezone.utc)).total_seconds()
+            - self._storage_account_options.sas_min_remaining_seconds)
+        if reusable_for > 0:
+            self._tokens.set(cache_key, sas_token, ttl_seconds=reusable_for)
+
+    def get_sas_token_for_blob(
+        self,
+        blob_name: str,
+        container_name: str,
+        expiry: int | None = None
+    ):
+        """Generates a SAS token for the given blob, or reuses a cached one."""
+        cache_key = self._cache_key(blob_name, container_name)
+        sas_token = self._tokens.get(cache_key)
+        if sas_token:
+            return sas_token
+
+        user_delegation_key = None
+        if not self._storage_account_options.use_account_key:
+            user_delegation_key = self._get_user_delegation_key()
+
+        with observe("sign_sas_token", SAS_SIGNING_SECONDS):
+            sas_token, expires_at = self._generate_sas_token(
+                blob_name, container_name,
+                expiry or self._storage_account_options.sas_expiry_seconds,
+                user_delegation_key)
+        self._cache_token(cache_key, sas_token, expires_at)
         return sas_token
+
+    async def aget_sas_token_for_blob(
+        self,
+        blob_name: str,
+        container_name: str,
+        expiry: int | None = None
+    ):
+        """Generates a SAS token for the given blob, or reuses a cached one,
+            fetching the user delegation key asynchronously."""
+        cache_key = self._cache_key(blob_name, container_name)
+        sas_token = self._tokens.get(cache_key)
+        if sas_token:
+            return sas_token
+
+        user_delegation_key = None
+        if not self._storage_account_options.use_account_key:
+            user_delegation_key = await self._aget_user_delegation_key()
+
+        with observe("sign_sas_token", SAS_SIGNING_SECONDS):
+            sas_token, expires_at = self._generate_sas_token(
+                blob_name, container_name,
+                expiry or self._storage_account_options.sas_expiry_seconds,
+                user_delegation_key)
+        self._cache_token(cache_key, sas_token, expires_at)
+        return sas_token
+
+    def stats(self) -> dict:
+        """Returns the counters of the SAS token cache."""
+        return self._tokens.stats()
+
+    async def aclose(self):
+        """Stops the key refresh and closes the blob service clients and credentials."""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        if self._blob_service_client:
+            self._blob_service_client.close()
+            self._blob_service_client = None
+        if self._async_blob_service_client:
+            await self._async_blob_service_client.close()
+            await self._async_credential.close()
+            self._async_blob_service_client = None
@@ -1,68 +1,363 @@
 """Service class for searching the vector index."""
 
-from typing import List, Tuple
+import base64
+import hashlib
+import json
+from typing import Any, Dict, List, Tuple
 
-from langchain_community.vectorstores.azuresearch import AzureSearch
+import httpx
+from azure.search.documents.models import VectorizedQuery
+from langchain_community.vectorstores.azuresearch import (
+    AzureSearch,
+    FIELDS_CONTENT,
+    FIELDS_CONTENT_VECTOR,
+    FIELDS_ID,
+    FIELDS_METADATA
+)
 from langchain_openai.embeddings import AzureOpenAIEmbeddings
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 from libs.core.models.options import VectorStoreOptions, OpenAIOptions
+from libs.core.services.embedding_cache import EmbeddingCache
+from libs.core.services.metrics import SEARCH_SECONDS
+from libs.core.services.resilience import ResilientEmbeddings, Upstream
+from libs.core.services.retrieval_cache import RetrievalCache
+from libs.core.services.tracing import observe
 
-def generate_embeddings(open_ai_options: OpenAIOptions) -> AzureOpenAIEmbeddings:
-    """Generate the Azure OpenAI embeddings."""
+class CachedEmbeddings(Embeddings):
+    """Embeddings which are looked up in an EmbeddingCache before calling the model.
+        Used for both the chat questions and the rated requests."""
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: EmbeddingCache):
+        self._embeddings = embeddings
+        self._model = model
+        self._cache = cache
+
+    @property
+    def embeddings(self) -> Embeddings:
+        """The embeddings the cache is in front of."""
+        return self._embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [self._cache.get(text, self._model) for text in texts]
+        missing = list(dict.fromkeys(
+            text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            # The texts which are not cached are embedded in a single batch.
+            embedded = dict(zip(missing, self._embeddings.embed_documents(missing)))
+            for text, vector in embedded.items():
+                self._cache.set(text, self._model, vector)
+            vectors = [embedded.get(text, vector) for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._cache.get(text, self._model)
+        if vector is None:
+            vector = self._embeddings.embed_query(text)
+            self._cache.set(text, self._model, vector)
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [await self._cache.aget(text, self._model) for text in texts]
+        missing = list(dict.fromkeys(
+            text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            embedded = dict(zip(missing, await self._embeddings.aembed_documents(missing)))
+            for text, vector in embedded.items():
+                self._cache.set(text, self._model, vector)
+            vectors = [embedded.get(text, vector) for text, vector in zip(texts, vectors)]
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = await self._cache.aget(text, self._model)
+        if vector is None:
+            vector = await self._embeddings.aembed_query(text)
+            self._cache.set(text, self._model, vector)
+        return vector
+
+def generate_embeddings(
+    open_ai_options: OpenAIOptions,
+    http_client: httpx.Client | None = None,
+    cache: EmbeddingCache | None = None,
+    http_async_client: httpx.AsyncClient | None = None,
+    upstream: Upstream | None = None) -> Embeddings:
+    """Generate the Azure OpenAI embeddings, cached when a cache is given. With the policy
+        of an upstream, the calls the cache misses are retried by it instead of the SDK."""
     api_options = open_ai_options.api_options
     model_options = open_ai_options.ai_model_options
-    return AzureOpenAIEmbeddings(
+    policy = upstream.policy if upstream else None
+    retries = {"max_retries": 0, "timeout": policy.timeout_seconds} if policy else {}
+    embeddings = AzureOpenAIEmbeddings(
         openai_api_key=api_options.api_key,
         openai_api_version=api_options.api_version,
         azure_endpoint=api_options.endpoint,
         model=model_options.embedding_model,
+        http_client=http_client,
+        http_async_client=http_async_client,
+        **retries,
     )
+    if policy:
+        embeddings = ResilientEmbeddings(embeddings, upstream)
+    if cache is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, model_options.embedding_model, cache)
 
 def generate_azure_search_client(
     index_name: str,
     vector_store_options: VectorStoreOptions,
-    embedding_function: List[float]) -> AzureSearch:
-    """Generate the Azure Search client."""
+    embedding_function: List[float],
+    search_client_options: Dict[str, Any] | None = None) -> AzureSearch:
+    """Generate the Azure Search client. The search client options are passed to the
+        SearchClient of the Azure SDK, e.g. its retry_total and read_timeout."""
     return AzureSearch(
         azure_search_endpoint=vector_store_options.endpoint,
         azure_search_key=vector_store_options.key,
         index_name=index_name,
         embedding_function=embedding_function,
         semantic_configuration_name=vector_store_options.semantic_configuration_name,
+        additional_search_client_options=search_client_options,
     )
 
+def _index_name(client: AzureSearch) -> str:
+    return getattr(client, "index_name", "unknown")
+
 def search(
     client: AzureSearch,
     query: str,
     number_of_results: int,
-    filters: str | None = None
+    filters: str | None = None,
+    cache: RetrievalCache | None = None
 ) -> List[Tuple[Document, float, float]]:
-    """Search the vector index and return the document scores / reranked values."""
-    return client.semantic_hybrid_search_with_score_and_rerank(
+    """Search the vector index and return the document scores / reranked values.
+        With a cache, results of a recent identical search are returned instead."""
+    key = cache.key(_index_name(client), query, filters) if cache else None
+    cached = cache.get(key, number_of_results) if cache else None
+    if cached is not None:
+        return cached
+
+    results = client.semantic_hybrid_search_with_score_and_rerank(
         query=query, k=number_of_results, filters=filters)
+    if cache:
+        cache.set(key, number_of_results, results)
+    return results
+
+def _to_document(result: dict) -> Document:
+    """Convert a search result into a document with the content, id and metadata AzureSearch
+        gives it. Unlike AzureSearch, no "captions" and "answers" are added to the metadata,
+        since the semantic queries below do not ask for them."""
+    if FIELDS_METADATA in result:
+        metadata = result[FIELDS_METADATA]
+        if not isinstance(metadata, dict):
+            metadata = json.loads(metadata)
+    else:
+        metadata = {
+            key: value for key, value in result.items()
+            if key not in (FIELDS_ID, FIELDS_CONTENT, FIELDS_CONTENT_VECTOR)
+        }
+    if FIELDS_ID in result:
+        metadata = {FIELDS_ID: result[FIELDS_ID]} | metadata
+    return Document(page_content=result[FIELDS_CONTENT], metadata=metadata)
+
+def _semantic_hybrid_query(
+    client: AzureSearch,
+    query: str,
+    vector: List[float],
+    number_of_results: int,
+    filters: str | None) -> dict:
+    # Unlike AzureSearch, no extractive captions and answers are requested: nothing reads
+    # them, and the service takes longer to produce them.
+    return {
+        "search_text": query,
+        "vector_queries": [
+            VectorizedQuery(
+                vector=vector,
+                k_nearest_neighbors=number_of_results,
+                fields=FIELDS_CONTENT_VECTOR,
+            )
+        ],
+        "filter": filters,
+        "query_type": "semantic",
+        "semantic_configuration_name": client.semantic_configuration_name,
+        "top": number_of_results,
+    }
+
+def _to_scored_document(result: dict) -> Tuple[Document, float, float]:
+    return (
+        _to_document(result),
+        float(result["@search.score"]),
+        float(result["@search.reranker_score"])
+    )
+
+def search_by_vector(
+    client: AzureSearch,
+    query: str,
+    vector: List[float],
+    number_of_results: int,
+    filters: str | None = None,
+    cache: RetrievalCache | None = None,
+    upstream: Upstream | None = None
+) -> List[Tuple[Document, float, float]]:
+    """Search the vector index with an already embedded query and return the
+        document scores / reranked values. Unlike search, no embedding call is made.
+        With a cache, results of a recent identical search are returned instead.
+        With an upstream, the search is made with its policy."""
+    key = cache.key(_index_name(client), query, filters) if cache else None
+    cached = cache.get(key, number_of_results) if cache else None
+    if cached is not None:
+        return cached
+
+    def fetch():
+        with observe("search", SEARCH_SECONDS, upstream="search", index=_index_name(client)):
+            results = client.client.search(
+                **_semantic_hybrid_query(client, query, vector, number_of_results, filters))
+            return [_to_scored_document(result) for result in results]
+
+    documents = upstream.call(fetch) if upstream else fetch()
+    if cache:
+        cache.set(key, number_of_results, documents)
+    return documents
+
+async def asearch_by_vector(
+    client: AzureSearch,
+    query: str,
+    vector: List[float],
+    number_of_results: int,
+    filters: str | None = None,
+    cache: RetrievalCache | None = None,
+    upstream: Upstream | None = None
+) -> List[Tuple[Document, float, float]]:
+    """Async version of search_by_vector. Slow searches are hedged per index."""
+    key = cache.key(_index_name(client), query, filters) if cache else None
+    cached = cache.get(key, number_of_results) if cache else None
+    if cached is not None:
+        return cached
+
+    async def fetch():
+        with observe("search", SEARCH_SECONDS, upstream="search", index=_index_name(client)):
+            results = await client.async_client.search(
+                **_semantic_hybrid_query(client, query, vector, number_of_results, filters))
+            return [_to_scored_document(result) async for result in results]
+
+    if upstream:
+        documents = await upstream.acall(fetch, hedge_key=_index_name(client))
+    else:
+        documents = await fetch()
+    if cache:
+        cache.set(key, number_of_results, documents)
+    return documents
+
+def _vector_query(vector: List[float], number_of_results: int, filters: str | None) -> dict:
+    return {
+        "search_text": None,
+        "vector_queries": [
+            VectorizedQuery(
+                vector=vector,
+                k_nearest_neighbors=number_of_results,
+                fields=FIELDS_CONTENT_VECTOR,
+            )
+        ],
+        "filter": filters,
+        "top": number_of_results,
+    }
+
+def vector_search(
+    client: AzureSearch,
+    vector: List[float],
+    number_of_results: int,
+    filters: str | None = None,
+    upstream: Upstream | None = None
+) -> List[Tuple[Document, float]]:
+    """Pure vector search of the index, for indexes without a semantic configuration."""
+    def fetch():
+        with observe("search", SEARCH_SECONDS, upstream="search", index=_index_name(client)):
+            results = client.client.search(**_vector_query(vector, number_of_results, filters))
+            return [(_to_document(result), float(result["@search.score"])) for result in results]
+
+    return upstream.call(fetch) if upstream else fetch()
+
+async def avector_search(
+    client: AzureSearch,
+    vector: List[float],
+    number_of_results: int,
+    filters: str | None = None,
+    upstream: Upstream | None = None
+) -> List[Tuple[Document, float]]:
+    """Async version of vector_search."""
+    async def fetch():
+        with observe("search", SEARCH_SECONDS, upstream="search", index=_index_name(client)):
+            results = await client.async_client.search(**_vector_query(vector, number_of_results, filters))
+            return [(_to_document(result), float(result["@search.score"])) async for result in results]
+
+    if upstream:
+        return await upstream.acall(fetch, hedge_key=_index_name(client))
+    return await fetch()
+
+def _rating_metadata(rating: bool | None, response: str, citations: List[dict] | None) -> dict:
+    return {
+        "response": response,
+        "citations": citations or [],
+        "labels": [{
+            True: "rating:thumbs-up",
+            False: "rating:thumbs-down",
+            None: "rating:none"}
+            [rating]
+        ]
+    }
 
 def rate(
     client: AzureSearch,
     dialog_id: str,
     rating: bool | None,
     request: str,
-    response: str) -> dict:
+    response: str,
+    citations: List[dict] | None = None) -> dict:
     """Rate the conversation."""
     output = client.add_texts(
         texts=[request],
-        metadatas=[{
-                "response": response,
-                "labels": [{
-                    True: "rating:thumbs-up",
-                    False: "rating:thumbs-down",
-                    None: "rating:none"}
-                    [rating]
-                ]
-        }]
+        metadatas=[_rating_metadata(rating, response, citations)]
     )
 
     return {
         "dialog_id": dialog_id,
         "output": output
     }
+
+async def arate(
+    client: AzureSearch,
+    dialog_id: str,
+    rating: bool | None,
+    request: str,
+    response: str,
+    citations: List[dict] | None = None) -> dict:
+    """Rate the conversation without blocking the event loop."""
+    output = await client.aadd_texts(
+        texts=[request],
+        metadatas=[_rating_metadata(rating, response, citations)]
+    )
+
+    return {
+        "dialog_id": dialog_id,
+        "output": output
+    }
+
+def rating_key(rating: bool | None, request: str, response: str) -> str:
+    """Returns the key of a rating. Identical ratings share a key, so they are
+        stored once and submitting one again overwrites it."""
+    return hashlib.sha256(json.dumps([request, response, rating]).encode("utf-8")).hexdigest()
+
+def rating_document_id(key: str) -> str:
+    """Returns the id of the document stored for a rating key, encoded like AzureSearch does."""
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+async def arate_batch(client: AzureSearch, ratings: List[dict]) -> List[str]:
+    """Stores many ratings with one batched embedding call and bulk uploads.
+        Each rating holds the key, rating, request, response and citations."""
+    return await client.aadd_texts(
+        texts=[rating["request"] for rating in ratings],
+        metadatas=[
+            _rating_metadata(rating["rating"], rating["response"], rating["citations"])
+            for rating in ratings
+        ],
+        keys=[rating["key"] for rating in ratings]
+    )
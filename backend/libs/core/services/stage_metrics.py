@@ -0,0 +1,85 @@
+"""Stage timings and token usage of the chat chain, recorded from its callbacks."""
+import time
+from typing import Any, Dict
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from libs.core.services.metrics import LLM_TOKENS, STAGE_ERRORS, STAGE_SECONDS, UPSTREAM_ERRORS
+from libs.core.services.tracing import error_reason, start_span
+
+class StageMetricsHandler(BaseCallbackHandler):
+    """Records the duration of every named stage of the chat chain, such as the
+        embedding, retrieval, packing, LLM and parsing stages, the token usage of the LLM
+        and the stages which failed. The runnables which only compose the stages are
+        left out. With OpenTelemetry every stage is also recorded as a span."""
+
+    run_inline = True
+
+    def __init__(self):
+        self._runs: Dict[UUID, tuple] = {}
+        self._parents: Dict[UUID, UUID | None] = {}
+
+    def _parent_span(self, parent_run_id: UUID | None):
+        """The span of the closest recorded stage the run is part of."""
+        while parent_run_id:
+            run = self._runs.get(parent_run_id)
+            if run and run[2]:
+                return run[2]
+            parent_run_id = self._parents.get(parent_run_id)
+        return None
+
+    def _start(self, name: str, run_id: UUID, parent_run_id: UUID | None):
+        self._parents[run_id] = parent_run_id
+        if name.startswith("Runnable"):
+            return
+        span = start_span(name, parent=self._parent_span(parent_run_id))
+        self._runs[run_id] = (name, time.perf_counter(), span)
+
+    def _end(self, run_id: UUID, error: BaseException | None = None) -> str | None:
+        self._parents.pop(run_id, None)
+        name, start, span = self._runs.pop(run_id, (None, None, None))
+        if not name:
+            return None
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        if error is not None:
+            STAGE_ERRORS.inc(stage=name)
+        if span:
+            if error is not None:
+                span.record_exception(error)
+            span.end()
+        return name
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, name=None, **kwargs: Any):
+        self._start(name or (serialized or {}).get("name", "chain"), run_id, parent_run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs: Any):
+        self._start("llm", run_id, parent_run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any):
+        self._end(run_id)
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if prompt_tokens is None and response.generations and response.generations[0]:
+            # Streamed responses carry the usage on the message, when the model reports it.
+            message = getattr(response.generations[0][0], "message", None)
+            usage = getattr(message, "usage_metadata", None) or {}
+            prompt_tokens = usage.get("input_tokens")
+            completion_tokens = usage.get("output_tokens")
+        model = llm_output.get("model_name") or "unknown"
+        if prompt_tokens:
+            LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+        if completion_tokens:
+            LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs: Any):
+        self._end(run_id, error)
+        UPSTREAM_ERRORS.inc(upstream="openai", reason=error_reason(error))
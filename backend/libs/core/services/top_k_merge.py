@@ -0,0 +1,59 @@
+"""This module merges the ranked results of several indexes into a single top k."""
+
+import heapq
+from itertools import islice, takewhile
+from typing import Callable, Dict, Iterable, List, Literal, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+ScoredDocument = Tuple[Document, float, float]
+ScoreNormalization = Literal["none", "max", "min_max"]
+
+def normalize_scores(
+    documents: Sequence[ScoredDocument],
+    normalization: ScoreNormalization
+) -> List[ScoredDocument]:
+    """ Rescales the reranker scores of one index's ranked results so indexes with
+        different score distributions can be compared. The order is preserved.
+        The best document of every index then has the same score, however relevant it is,
+        so the reranker scores, which share one scale, are best merged without it."""
+    if normalization == "none" or not documents:
+        return list(documents)
+
+    # The results are ranked, so the best and worst scores are at the ends.
+    highest = documents[0][2]
+    lowest = documents[-1][2] if normalization == "min_max" else 0.0
+    spread = highest - lowest
+    return [
+        (document, score, (reranker_score - lowest) / spread if spread > 0 else 1.0)
+        for document, score, reranker_score in documents
+    ]
+
+def merge_top_k(
+    ranked_documents: Dict[str, Sequence[ScoredDocument]],
+    k: int,
+    weights: Dict[str, float] | None = None,
+    normalization: ScoreNormalization = "none",
+    min_score: float = 0.0,
+    unique: Callable[[Iterable[ScoredDocument]], Iterable[ScoredDocument]] | None = None
+) -> List[ScoredDocument]:
+    """ Merges the per-index lists, each ranked by reranker score, into the k best
+        documents overall. Documents with a raw reranker score below min_score are
+        dropped before normalization, and the normalized scores are multiplied by the
+        weight of their index. The merged documents are passed through unique, best
+        first, e.g. to drop near-duplicates. The heap merge stops as soon as k documents
+        are taken."""
+    weights = weights or {}
+    lists = []
+    for index_name, documents in ranked_documents.items():
+        documents = list(takewhile(lambda document: document[2] >= min_score, documents))
+        weight = weights.get(index_name, 1.0)
+        lists.append([
+            (document, score, reranker_score * weight)
+            for document, score, reranker_score in normalize_scores(documents, normalization)
+        ])
+
+    merged = heapq.merge(*lists, key=lambda document: document[2], reverse=True)
+    if unique:
+        merged = unique(merged)
+    return list(islice(merged, k))
@@ -0,0 +1,97 @@
+"""Per-request trace IDs, timed upstream calls and optional OpenTelemetry spans."""
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Mapping
+
+from libs.core.services.metrics import UPSTREAM_ERRORS, Histogram
+
+try:
+    from opentelemetry import propagate, trace as otel_trace
+except ImportError: # pragma: no cover - OpenTelemetry is optional
+    propagate = otel_trace = None
+
+_TRACE_ID: ContextVar[str | None] = ContextVar("trace_id", default=None)
+_VALID_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+_tracer = None
+
+def configure_tracing(opentelemetry_enabled: bool):
+    """Sends spans to the OpenTelemetry tracer provider of the process when enabled
+        and the OpenTelemetry API is installed. Returns whether spans are sent."""
+    global _tracer # pylint: disable=global-statement
+    _tracer = otel_trace.get_tracer(__name__) if opentelemetry_enabled and otel_trace else None
+    return _tracer is not None
+
+def current_trace_id() -> str | None:
+    """Returns the trace ID of the request being handled."""
+    return _TRACE_ID.get()
+
+def status_code(error: BaseException) -> int | None:
+    """The HTTP status code of a failed upstream call, when the service responded."""
+    return getattr(error, "status_code", None) or getattr(
+        getattr(error, "response", None), "status_code", None)
+
+def error_reason(error: BaseException) -> str:
+    """A short, low cardinality reason for a failed upstream call."""
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    code = status_code(error)
+    return str(code) if code else type(error).__name__
+
+def start_span(name: str, parent=None, **attributes):
+    """Starts a span, as a child of the parent span when given, or returns None
+        when spans are not sent."""
+    if not _tracer:
+        return None
+    context = otel_trace.set_span_in_context(parent) if parent else None
+    return _tracer.start_span(name, context=context, attributes=attributes or None)
+
+@contextmanager
+def _request_span(name: str, headers: Mapping[str, str]):
+    if not _tracer:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, context=propagate.extract(headers)) as span:
+        yield span
+
+@contextmanager
+def request_trace(name: str, headers: Mapping[str, str], trace_header: str):
+    """Starts the trace of a request and yields its trace ID. With OpenTelemetry the ID is
+        the one of the request span, continuing a trace passed in with a traceparent header.
+        Otherwise a trace ID passed in the trace header is kept, or a new one is created."""
+    with _request_span(name, headers) as span:
+        span_context = span.get_span_context() if span else None
+        if span_context and span_context.is_valid:
+            trace_id = format(span_context.trace_id, "032x")
+        else:
+            # Without a tracer provider the spans are not recorded and have no trace ID.
+            trace_id = headers.get(trace_header, "")
+            if not _VALID_TRACE_ID.match(trace_id):
+                trace_id = uuid.uuid4().hex
+        token = _TRACE_ID.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            _TRACE_ID.reset(token)
+
+@contextmanager
+def observe(name: str, histogram: Histogram | None = None, upstream: str | None = None, **labels):
+    """Times the block into the histogram and, with OpenTelemetry, records it as a span.
+        Exceptions raised by the block are counted as errors of the upstream service."""
+    span = start_span(name, **labels)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        if upstream:
+            UPSTREAM_ERRORS.inc(upstream=upstream, reason=error_reason(error))
+        if span:
+            span.record_exception(error)
+        raise
+    finally:
+        if histogram:
+            histogram.observe(time.perf_counter() - start, **labels)
+        if span:
+            span.end()
@@ -0,0 +1,86 @@
+"""Thread-safe, size-bounded LRU cache whose entries expire after a time to live."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+class TtlLruCache:
+    """In-memory LRU cache with optional per-entry expiry.
+        Keeps hit, miss and eviction counters. Entries dropped because they
+        expired or because the cache was full both count as evictions."""
+
+    def __init__(
+            self,
+            max_entries: int,
+            ttl_seconds: float | None = None,
+            clock: Callable[[], float] = time.monotonic
+        ):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value, or the default when it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self._clock():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: float | None = None):
+        """Stores the value, evicting the least recently used entries when full."""
+        ttl_seconds = self._ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = None if ttl_seconds is None else self._clock() + ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes the entry and returns its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Removes every entry whose key matches the predicate and returns how many were removed."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """Returns the size and counters of the cache."""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
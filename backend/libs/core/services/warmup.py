@@ -0,0 +1,117 @@
+"""Warmup of a worker's upstream connections and caches before it takes traffic."""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import RatedAnswerOptions, WarmupOptions
+from libs.core.services.client_registry import ClientRegistry
+from libs.core.services.search_vector_index_service import asearch_by_vector, avector_search
+
+logger = logging.getLogger(__name__)
+
+class Warmup:
+    """Pays the costs of the first requests before the worker reports ready. In order:
+
+        - search_clients: creates the search client of every index, loading its schema.
+        - storage: fetches the user delegation key the citation URLs are signed with.
+        - embedding: embeds the query, bypassing the embedding cache, which opens a
+          connection to Azure OpenAI in the pool the chat models share.
+        - search: searches every index for the query, opening its connections.
+        - caches: embeds and retrieves the prime questions through the caches.
+
+        Each step is limited to timeout_seconds. Steps which failed are run again after
+        retry_seconds, and given up after max_attempts, so the worker still reports
+        ready when an upstream is down."""
+
+    def __init__(
+            self,
+            options: WarmupOptions,
+            builder: MultiIndexChatBuilder,
+            client_registry: ClientRegistry,
+            rated_answer_options: RatedAnswerOptions
+        ):
+        self._options = options
+        self._builder = builder
+        self._clients = client_registry
+        self._ratings_index = rated_answer_options.index_name if rated_answer_options.enabled else None
+        self._vector: List[float] | None = None
+        self._steps: Dict[str, dict] = {}
+
+    def steps(self) -> Dict[str, Callable[[], Awaitable]]:
+        """The steps of the warmup, in order. Empty when the warmup is disabled."""
+        if not self._options.enabled:
+            return {}
+        return {
+            "search_clients": self._search_clients,
+            "storage": self._builder.awarm_storage,
+            "embedding": self._embedding,
+            "search": self._search,
+            "caches": self._caches,
+        }
+
+    def _index_names(self) -> List[str]:
+        names = [index.name for index in self._builder.indexes]
+        return names + [self._ratings_index] if self._ratings_index else names
+
+    async def _search_clients(self):
+        await asyncio.gather(*(self._clients.asearch_client(name) for name in self._index_names()))
+
+    async def _embedding(self):
+        self._vector = await self._clients.embeddings(cached=False).aembed_query(self._options.query)
+
+    async def _search_index(self, index_name: str, vector: List[float]):
+        client = await self._clients.asearch_client(index_name)
+        if index_name == self._ratings_index:
+            await avector_search(client, vector, 1)
+        else:
+            await asearch_by_vector(client, self._options.query, vector, 1)
+
+    async def _search(self):
+        vector = self._vector or await self._builder.aembed_query(self._options.query)
+        await asyncio.gather(*(self._search_index(name, vector) for name in self._index_names()))
+
+    async def _caches(self):
+        questions = self._options.prime_questions
+        if not questions:
+            return
+        vectors = await self._builder.aembed_questions(questions)
+        await asyncio.gather(*(
+            self._builder.aget_documents({"question": question, "embedding": vector})
+            for question, vector in zip(questions, vectors)
+        ))
+
+    async def _run_step(self, name: str, step: Callable[[], Awaitable]) -> bool:
+        state = self._steps.setdefault(name, {"status": "pending", "attempts": 0})
+        state["attempts"] += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(step(), self._options.timeout_seconds)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning("Warmup step %s failed: %r", name, error)
+            state.update(status="failed", error=repr(error))
+            return False
+        finally:
+            state["seconds"] = round(time.perf_counter() - start, 3)
+        state.update(status="done", error=None)
+        return True
+
+    async def arun(self):
+        """Runs the steps until they succeeded or were given up."""
+        pending = self.steps()
+        attempt = 0
+        while pending:
+            attempt += 1
+            for name, step in list(pending.items()):
+                if await self._run_step(name, step):
+                    del pending[name]
+            if pending and self._options.max_attempts and attempt >= self._options.max_attempts:
+                logger.warning("Giving up the warmup steps %s after %d attempts", list(pending), attempt)
+                return
+            if pending:
+                await asyncio.sleep(self._options.retry_seconds)
+
+    def status(self) -> Dict[str, dict]:
+        """Returns the status, attempts, duration and last error of every step run so far."""
+        return {name: dict(state) for name, state in self._steps.items()}
@@ -1,62 +1,130 @@
 """Main module for the FastAPI application."""
+import asyncio
 import json
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from typing import Callable
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
+import config
+from app_services import AppServices, ServicesStartup, build_services
 from models.rate_models import RateRequest
-from models.chat_request import ChatRequest
+from models.cache_models import InvalidateRetrievalCacheRequest
+from models.chat_request import ChatBatchRequest, ChatRequest
 from models.llm_response import LlmResponse
 from models.chat_response import (
     Answer,
     AnswerQueryConfig,
+    ApproachType,
     ChatResponse,
     ChatResponseArgs,
     to_response_item,
 )
-from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
-from libs.core.approaches.chat_conversation import build_chain
-from libs.core.services.search_vector_index_service import (
-    generate_embeddings,
-    generate_azure_search_client,
-    rate
-)
-from config import (
-    multi_index_options,
-    chat_options
-)
+from libs.core.services.deadline import DEADLINE, Deadline, deadline_of
+from libs.core.services.metrics import REGISTRY
+from libs.core.services.tracing import request_trace
 
-chat_builder = MultiIndexChatBuilder(
-    multi_index_options = multi_index_options
-)
-app = FastAPI()
-
-@app.post("/rate")
-def rate_response(rate_message: RateRequest):
-    """API endpoint for rating the conversation."""
-    embeddings = generate_embeddings(multi_index_options.open_ai_options)
-    client = generate_azure_search_client(
-        index_name="ratings",
-        vector_store_options=multi_index_options.vector_store_options,
-        embedding_function=embeddings,
-    )
-    response = rate(
-        client = client,
+# How often a chat request checks whether its client has disconnected.
+DISCONNECT_POLL_SECONDS = 0.25
+
+router = APIRouter()
+
+async def get_services(request: Request) -> AppServices:
+    """Dependency returning the services, waiting while the worker is still building them."""
+    try:
+        return await request.app.state.startup.aget()
+    except RuntimeError as error:
+        raise HTTPException(status_code=503, detail=str(error)) from error
+
+async def trace_request(request: Request, call_next):
+    """Runs the request in its own trace and returns the trace ID in the response headers."""
+    trace_header = config.telemetry_options.trace_id_header
+    with request_trace(f"{request.method} {request.url.path}", request.headers, trace_header) as trace_id:
+        response = await call_next(request)
+    response.headers[trace_header] = trace_id
+    return response
+
+@router.get("/healthz")
+async def liveness(request: Request):
+    """API endpoint for the liveness probe. Answers 200 while the worker's event loop
+        is responsive, during the startup too, with the state of the startup."""
+    return {"status": request.app.state.startup.status()["status"]}
+
+@router.get("/readyz")
+async def readiness(request: Request):
+    """API endpoint for the readiness probe. Answers 200 once the services are built and
+        the warmup finished, and 503 until then. Reports the duration of the startup phases
+        and the status, attempts, duration and last error of every warmup step."""
+    startup: ServicesStartup = request.app.state.startup
+    return JSONResponse(startup.status(), status_code=200 if startup.ready else 503)
+
+@router.get("/metrics")
+async def metrics():
+    """API endpoint exposing the stage latencies, token usage, cache hit rates and
+        upstream errors in the Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@router.post("/rate")
+async def rate_response(rate_message: RateRequest, services: AppServices = Depends(get_services)):
+    """API endpoint for rating the conversation.
+        The rating is queued and stored in the ratings index with the next batch."""
+    return services.rating_queue.submit(
         dialog_id = rate_message.dialog_id,
         rating = rate_message.rating,
         request = rate_message.request,
-        response = rate_message.response
+        response = rate_message.response,
+        citations = rate_message.citations
     )
-    return response
 
-@app.post("/chat")
-def conversation(chat_message: ChatRequest):
-    """API endpoint for chat conversation."""
-    chain = build_chain(
-        builder=chat_builder,
-        chat_options=chat_options
-    )
+@router.get("/rate/stats")
+async def rate_stats(services: AppServices = Depends(get_services)):
+    """API endpoint reporting the depth and flush latency of the rating queue."""
+    return services.rating_queue.stats()
+
+@router.post("/cache/retrieval/invalidate")
+async def invalidate_retrieval_cache(
+        request: InvalidateRetrievalCacheRequest,
+        services: AppServices = Depends(get_services)
+    ):
+    """API endpoint called when an index was re-indexed, e.g. by the chunking pipeline.
+        Drops the cached search results of the index, or of every index without a name, in
+        every worker of the host sharing the versions file. Other hosts keep serving the old
+        results until they expire, unless they are called too. Reporting the content version
+        the index already has drops nothing."""
+    return {"dropped": services.retrieval_cache.invalidate(request.index_name, request.version)}
 
-    response = chain.invoke({"question": chat_message.dialog})
+def _run_config(request: Request) -> dict:
+    """The run config of the chain for a chat request, with the deadline of the request."""
+    deadline = Deadline.from_headers(request.headers, config.deadline_options)
+    return {"configurable": {DEADLINE: deadline}} if deadline else {}
 
+@asynccontextmanager
+async def _cancel_on_disconnect(request: Request):
+    """Cancels the work of the request, and with it the upstream calls in flight, once the
+        client disconnected. Raises HTTPException 499 instead of the cancellation."""
+    task = asyncio.current_task()
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        while not await request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+        disconnected = True
+        task.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    except asyncio.CancelledError as error:
+        if not disconnected:
+            raise
+        task.uncancel()
+        raise HTTPException(status_code=499, detail="Client closed request") from error
+    finally:
+        watcher.cancel()
+
+def _to_chat_response(chat_message: ChatRequest, response: dict) -> dict:
+    """Formats the output of the chain as the chat response item."""
     chat_answer = Answer(
         formatted_answer = response['answer'],
         citations=response['citations'],
@@ -67,14 +135,108 @@ def conversation(chat_message: ChatRequest):
         )
     )
     chat_response_args = ChatResponseArgs(
-        classification = None,
+        classification = (
+            ApproachType[response["classification"]] if response.get("classification") else None),
         data_points = None,
         error = None,
         suggested_classification = None
     )
     response = ChatResponse(
         answer=chat_answer,
-        chat_response_args=chat_response_args
+        chat_response_args=chat_response_args,
+        served_from_cache=response.get("served_from_cache", False),
+        dropped_indexes=response.get("dropped_indexes")
     )
 
     return to_response_item(response)
+
+@router.post("/chat")
+async def conversation(
+        chat_message: ChatRequest,
+        request: Request,
+        services: AppServices = Depends(get_services)
+    ):
+    """API endpoint for chat conversation. Identical questions asked at the same time are answered once.
+        The answer is given within the deadline of the request, and is not generated any
+        further once the client disconnected."""
+    run_config = _run_config(request)
+    async with _cancel_on_disconnect(request):
+        response = await services.chat_coalescer.run(
+            chat_message.dialog,
+            lambda: services.chain.ainvoke({"question": chat_message.dialog}, run_config),
+            deadline_of(run_config))
+    return _to_chat_response(chat_message, response)
+
+def _server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _chat_events(chat_message: ChatRequest, services: AppServices, request: Request):
+    from libs.core.approaches.chat_stream import astream_answer # pylint: disable=import-outside-toplevel
+    run_config = _run_config(request)
+    try:
+        async with _cancel_on_disconnect(request):
+            async for event, data in astream_answer(services.chain, {"question": chat_message.dialog}, run_config):
+                if event == "token":
+                    yield _server_sent_event("token", {"text": data})
+                else:
+                    yield _server_sent_event("answer", _to_chat_response(chat_message, data))
+    except HTTPException:
+        return
+    except Exception as error: # pylint: disable=broad-except
+        yield _server_sent_event("error", {"error": str(error)})
+
+@router.post("/chat/stream")
+async def conversation_stream(
+        chat_message: ChatRequest,
+        request: Request,
+        services: AppServices = Depends(get_services)
+    ):
+    """API endpoint streaming the chat answer as server-sent events.
+        "token" events carry the answer as it is generated, the final "answer" event
+        carries the complete response with its citations."""
+    return StreamingResponse(_chat_events(chat_message, services, request), media_type="text/event-stream")
+
+async def _chat_batch_items(chat_batch: ChatBatchRequest, services: AppServices):
+    from libs.core.approaches.chat_batch import aanswer_batch # pylint: disable=import-outside-toplevel
+    questions = [chat_message.dialog for chat_message in chat_batch.dialogs]
+    async for index, response, error in aanswer_batch(
+            services.chain, services.chat_builder, questions, services.chat_batch_options):
+        if error:
+            yield {"index": index, "error": str(error)}
+        else:
+            yield {"index": index, "response": _to_chat_response(chat_batch.dialogs[index], response)}
+
+async def _ndjson(items):
+    async for item in items:
+        yield json.dumps(item) + "\n"
+
+@router.post("/chat/batch")
+async def conversation_batch(chat_batch: ChatBatchRequest, services: AppServices = Depends(get_services)):
+    """API endpoint answering many dialogs. The results are in input order, and a dialog
+        which failed has an "error" instead of a "response". With "stream" set the results
+        are sent as NDJSON, one line per dialog, as they complete."""
+    items = _chat_batch_items(chat_batch, services)
+    if chat_batch.stream:
+        return StreamingResponse(_ndjson(items), media_type="application/x-ndjson")
+
+    return [item async for item in items]
+
+def create_app(services_factory: Callable[[], AppServices] = build_services) -> FastAPI:
+    """Creates the application. The services are built by the factory on a background
+        task once the worker started, so health probes are answered while they load."""
+    startup = ServicesStartup(services_factory)
+
+    @asynccontextmanager
+    async def lifespan(_app: FastAPI):
+        """Starts building the services, and closes them when the application shuts down."""
+        startup.start()
+        yield
+        await startup.aclose()
+
+    application = FastAPI(lifespan=lifespan)
+    application.state.startup = startup
+    application.middleware("http")(trace_request)
+    application.include_router(router)
+    return application
+
+app = create_app()
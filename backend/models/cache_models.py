@@ -0,0 +1,8 @@
+"""This module contains the models of the cache endpoints."""
+from pydantic import BaseModel
+
+class InvalidateRetrievalCacheRequest(BaseModel):
+    """Model for invalidating the retrieval cache after an index changed.
+        Without an index name every index is invalidated."""
+    index_name: str | None = None
+    version: str | None = None
@@ -1,6 +1,12 @@
 """This module contains the ChatRequest model."""
+from typing import List
 from pydantic import BaseModel
 
 class ChatRequest(BaseModel):
     """Model for the chat request."""
     dialog: str
+
+class ChatBatchRequest(BaseModel):
+    """Model for the batch chat request. Streamed batches are returned as NDJSON."""
+    dialogs: List[ChatRequest]
+    stream: bool = False
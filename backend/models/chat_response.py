@@ -87,6 +87,8 @@ class ChatResponse:
         answer: Answer,
         chat_response_args: Optional[ChatResponseArgs] = None,
         show_retry: bool = False,
+        served_from_cache: bool = False,
+        dropped_indexes: Optional[List[str]] = None,
     ):
         self.answer = answer
         self.classification = chat_response_args.classification
@@ -96,6 +98,8 @@ class ChatResponse:
         self.error = chat_response_args.error
         self.suggested_classification = chat_response_args.suggested_classification
         self.show_retry = show_retry
+        self.served_from_cache = served_from_cache
+        self.dropped_indexes = [] if dropped_indexes is None else dropped_indexes
 
 def to_response_item(response: ChatResponse):
     """Returns a formatted item for the chat response."""
@@ -112,4 +116,6 @@ def to_response_item(response: ChatResponse):
             else None
         ),
         "show_retry": response.show_retry,
+        "served_from_cache": response.served_from_cache,
+        "dropped_indexes": response.dropped_indexes,
     }
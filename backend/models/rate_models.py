@@ -1,5 +1,5 @@
 """This module contains the RateRequest model."""
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 class RateRequest(BaseModel):
@@ -8,6 +8,7 @@ class RateRequest(BaseModel):
     rating: bool | None
     request: str
     response: str
+    citations: Optional[List[dict]] = None
 
 class RateResponse(BaseModel):
     """Model for the rate response"""
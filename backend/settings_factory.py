@@ -4,11 +4,27 @@ import os
 from dotenv import load_dotenv
 import yaml
 from libs.core.models.options import (
+    ChatBatchOptions,
     ChatConversationOptions,
+    IndexOptions,
+    RatedAnswerOptions,
+    RatingQueueOptions,
+    RatingsMirrorOptions,
+    RequestCoalescingOptions,
+    RetrievalCacheOptions,
+    TelemetryOptions,
+    WarmupOptions,
+    ResilienceOptions,
+    UpstreamPolicyOptions,
+    DeadlineOptions,
+    DeduplicationOptions,
     MultiIndexVectorStoreOptions,
     OpenAIOptions,
     ApiOptions,
     ModelOptions,
+    ModelRouteOptions,
+    ModelRouterOptions,
+    EmbeddingCacheOptions,
     VectorStoreOptions,
     StorageAccountOptions
 )
@@ -16,16 +32,84 @@ from libs.core.models.options import (
 def _chat_conversation_from_settings(config: dict) -> ChatConversationOptions:
     return ChatConversationOptions(
         system_prompt=config["chat_approach"]["system_prompt"],
-        default_return_message=config["chat_approach"]["default_return_message"]
+        default_return_message=config["chat_approach"]["default_return_message"],
+        rated_answer_options=RatedAnswerOptions.from_settings(config)
+    )
+def _rated_answer_options_from_settings(config: dict) -> RatedAnswerOptions:
+    rated_answers = config["chat_approach"]["rated_answers"]
+    return RatedAnswerOptions(
+        enabled=rated_answers["enabled"],
+        index_name=rated_answers["index_name"],
+        min_score=rated_answers["min_score"],
+        k=rated_answers["k"]
+    )
+def _rating_queue_options_from_settings(config: dict) -> RatingQueueOptions:
+    rating_queue = config["chat_approach"]["rating_queue"]
+    return RatingQueueOptions(
+        batch_size=rating_queue["batch_size"],
+        flush_interval_seconds=rating_queue["flush_interval_seconds"],
+        max_pending=rating_queue["max_pending"]
+    )
+def _ratings_mirror_options_from_settings(config: dict) -> RatingsMirrorOptions:
+    ratings_mirror = config["chat_approach"]["ratings_mirror"]
+    return RatingsMirrorOptions(
+        enabled=ratings_mirror["enabled"],
+        path=ratings_mirror["path"],
+        sync_interval_seconds=ratings_mirror["sync_interval_seconds"]
+    )
+def _chat_batch_options_from_settings(config: dict) -> ChatBatchOptions:
+    chat_batch = config["chat_approach"]["chat_batch"]
+    return ChatBatchOptions(
+        embedding_batch_size=chat_batch["embedding_batch_size"],
+        max_concurrency=chat_batch["max_concurrency"],
+        max_search_concurrency=chat_batch["max_search_concurrency"],
+        max_llm_concurrency=chat_batch["max_llm_concurrency"]
+    )
+def _retrieval_cache_options_from_settings(config: dict) -> RetrievalCacheOptions:
+    retrieval_cache = config["chat_approach"]["retrieval_cache"]
+    return RetrievalCacheOptions(
+        enabled=retrieval_cache["enabled"],
+        ttl_seconds=retrieval_cache["ttl_seconds"],
+        max_entries=retrieval_cache["max_entries"],
+        versions_path=retrieval_cache.get("versions_path") or None
+    )
+def _request_coalescing_options_from_settings(config: dict) -> RequestCoalescingOptions:
+    request_coalescing = config["chat_approach"]["request_coalescing"]
+    return RequestCoalescingOptions(
+        enabled=request_coalescing["enabled"],
+        result_ttl_seconds=request_coalescing["result_ttl_seconds"],
+        max_entries=request_coalescing["max_entries"]
+    )
+def _telemetry_options_from_settings(config: dict) -> TelemetryOptions:
+    telemetry = config["chat_approach"]["telemetry"]
+    return TelemetryOptions(
+        opentelemetry_enabled=telemetry["opentelemetry_enabled"],
+        trace_id_header=telemetry["trace_id_header"]
     )
 def _multi_index_vector_store_from_settings(config: dict) -> MultiIndexVectorStoreOptions:
+    documents = config["chat_approach"]["documents"]
     return MultiIndexVectorStoreOptions(
-        primary_index_name=config["chat_approach"]["documents"]["primary_index_name"],
-        secondary_index_name=config["chat_approach"]["documents"]["secondary_index_name"],
+        indexes=[IndexOptions.from_settings(index) for index in documents["indexes"]],
+        final_k=documents["final_k"],
+        min_reranker_score=documents["min_reranker_score"],
+        score_normalization=documents["score_normalization"],
+        context_token_budget=documents["context_token_budget"],
+        min_chunk_tokens=documents["min_chunk_tokens"],
+        deduplication=DeduplicationOptions.from_settings(documents.get("deduplication") or {}),
         vector_store_options=VectorStoreOptions.from_settings(config),
         open_ai_options=OpenAIOptions.from_settings(config),
         storage_account_options=StorageAccountOptions.from_settings(config)
     )
+def _deduplication_options_from_settings(deduplication: dict) -> DeduplicationOptions:
+    return DeduplicationOptions(**deduplication)
+def _index_options_from_settings(index: dict) -> IndexOptions:
+    return IndexOptions(
+        name=index["name"],
+        k=index["k"],
+        weight=index["weight"],
+        timeout_seconds=index["timeout_seconds"],
+        containers=index.get("containers", [])
+    )
 def _open_ai_options_from_settings(config: dict) -> OpenAIOptions:
     return OpenAIOptions(
         api_options=ApiOptions.from_settings(config),
@@ -45,6 +129,31 @@ def _model_options_from_settings(config: dict) -> ModelOptions:
         max_tokens=config["chat_approach"]["openai_settings"]["max_tokens"],
         n=config["chat_approach"]["openai_settings"]["n"]
     )
+def _model_router_options_from_settings(config: dict) -> ModelRouterOptions:
+    model_router = config["chat_approach"]["model_router"]
+    return ModelRouterOptions(
+        enabled=model_router["enabled"],
+        latency_ewma_alpha=model_router["latency_ewma_alpha"],
+        throttle_cooldown_seconds=model_router["throttle_cooldown_seconds"],
+        routes=[ModelRouteOptions.from_settings(route) for route in model_router["routes"]]
+    )
+def _model_route_options_from_settings(route: dict) -> ModelRouteOptions:
+    return ModelRouteOptions(
+        deployment=route["deployment"],
+        context_window=route["context_window"],
+        max_tokens=route["max_tokens"],
+        approaches=route["approaches"],
+        max_question_tokens=route.get("max_question_tokens"),
+        max_latency_seconds=route.get("max_latency_seconds")
+    )
+def _embedding_cache_options_from_settings(config: dict) -> EmbeddingCacheOptions:
+    embedding_cache = config["chat_approach"]["embedding_cache"]
+    return EmbeddingCacheOptions(
+        max_entries=embedding_cache["max_entries"],
+        ttl_seconds=embedding_cache["ttl_seconds"],
+        persist_path=embedding_cache["persist_path"],
+        persist_max_entries=embedding_cache.get("persist_max_entries")
+    )
 def _vector_store_options_from_settings(config: dict) -> VectorStoreOptions:
     docs = config["chat_approach"]["documents"]
     return VectorStoreOptions(
@@ -52,11 +161,52 @@ def _vector_store_options_from_settings(config: dict) -> VectorStoreOptions:
         key=config["AZURE_AI_SEARCH_API_KEY"],
         semantic_configuration_name=docs["semantic_configuration_name"]
     )
+def _warmup_options_from_settings(config: dict) -> WarmupOptions:
+    warmup = config["chat_approach"]["warmup"]
+    return WarmupOptions(
+        enabled=warmup["enabled"],
+        query=warmup["query"],
+        prime_questions=warmup.get("prime_questions") or [],
+        timeout_seconds=warmup["timeout_seconds"],
+        retry_seconds=warmup["retry_seconds"],
+        max_attempts=warmup["max_attempts"]
+    )
+def _resilience_options_from_settings(config: dict) -> ResilienceOptions:
+    resilience = config["chat_approach"]["resilience"]
+    return ResilienceOptions(
+        enabled=resilience["enabled"],
+        upstreams={
+            name: UpstreamPolicyOptions.from_settings(policy)
+            for name, policy in (resilience.get("upstreams") or {}).items()
+        }
+    )
+def _upstream_policy_options_from_settings(policy: dict) -> UpstreamPolicyOptions:
+    return UpstreamPolicyOptions(**policy)
+def _deadline_options_from_settings(config: dict) -> DeadlineOptions:
+    deadline = config["chat_approach"]["deadline"]
+    return DeadlineOptions(
+        enabled=deadline["enabled"],
+        header=deadline["header"],
+        default_seconds=deadline["default_seconds"],
+        max_seconds=deadline["max_seconds"],
+        llm_reserve_seconds=deadline["llm_reserve_seconds"],
+        min_llm_seconds=deadline["min_llm_seconds"],
+        short_seconds=deadline["short_seconds"],
+        short_context_fraction=deadline["short_context_fraction"],
+        short_max_tokens=deadline["short_max_tokens"]
+    )
 def _storage_account_options_from_settings(config: dict) -> StorageAccountOptions:
+    storage_settings = config["chat_approach"]["storage_settings"]
     return StorageAccountOptions(
         account_name=config["STORAGE_ACCOUNT_NAME"],
         account_key=config["STORAGE_ACCOUNT_KEY"],
-        use_account_key=config["chat_approach"]["storage_settings"]["use_account_key"]
+        use_account_key=storage_settings["use_account_key"],
+        sas_scope=storage_settings["sas_scope"],
+        sas_expiry_seconds=storage_settings["sas_expiry_seconds"],
+        sas_min_remaining_seconds=storage_settings["sas_min_remaining_seconds"],
+        sas_cache_max_entries=storage_settings["sas_cache_max_entries"],
+        user_delegation_key_lifetime_seconds=storage_settings["user_delegation_key_lifetime_seconds"],
+        endpoint=config.get("STORAGE_ACCOUNT_ENDPOINT")
     )
 
 def load_config() -> dict:
@@ -67,9 +217,25 @@ def load_config() -> dict:
     return chat_config | os.environ
 
 ChatConversationOptions.from_settings = _chat_conversation_from_settings
+RatedAnswerOptions.from_settings = _rated_answer_options_from_settings
+ChatBatchOptions.from_settings = _chat_batch_options_from_settings
+RatingQueueOptions.from_settings = _rating_queue_options_from_settings
+RatingsMirrorOptions.from_settings = _ratings_mirror_options_from_settings
+RequestCoalescingOptions.from_settings = _request_coalescing_options_from_settings
+RetrievalCacheOptions.from_settings = _retrieval_cache_options_from_settings
+TelemetryOptions.from_settings = _telemetry_options_from_settings
+WarmupOptions.from_settings = _warmup_options_from_settings
+ResilienceOptions.from_settings = _resilience_options_from_settings
+UpstreamPolicyOptions.from_settings = _upstream_policy_options_from_settings
+DeadlineOptions.from_settings = _deadline_options_from_settings
+DeduplicationOptions.from_settings = _deduplication_options_from_settings
 MultiIndexVectorStoreOptions.from_settings = _multi_index_vector_store_from_settings
+IndexOptions.from_settings = _index_options_from_settings
 OpenAIOptions.from_settings = _open_ai_options_from_settings
 ApiOptions.from_settings = _api_options_from_settings
 ModelOptions.from_settings = _model_options_from_settings
+ModelRouterOptions.from_settings = _model_router_options_from_settings
+ModelRouteOptions.from_settings = _model_route_options_from_settings
+EmbeddingCacheOptions.from_settings = _embedding_cache_options_from_settings
 VectorStoreOptions.from_settings = _vector_store_options_from_settings
 StorageAccountOptions.from_settings = _storage_account_options_from_settings
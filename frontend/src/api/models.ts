@@ -29,6 +29,7 @@ export interface RateRequest extends DialogRequest {
     rating?: boolean | undefined;
     response: string;
     request?: string;
+    citations?: Array<Citation>;
 }
 
 export interface ChatRequest extends DialogRequest {
@@ -61,6 +62,7 @@ export type ChatResponse = {
     classification?: ApproachType;
     data_points: string[];
     show_retry?: boolean;
+    served_from_cache?: boolean;
     suggested_classification?: ApproachType;
     error?: string;
 };
@@ -50,7 +50,8 @@ export const Answer = ({
             dialogID: dialogInfo.dialogID,
             rating: value,
             request: answer.query,
-            response: answer.formatted_answer
+            response: answer.formatted_answer,
+            citations: answer.citations
         }).then(() => onRating(value));
     };
     const shouldNotShowThoughtProcess = !chatResponse.classification && !answer.query && !answer.query_generation_prompt && !answer.query_result;
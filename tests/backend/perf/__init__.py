@@ -0,0 +1 @@
+""" Offline benchmarks and load tools for the backend. They are not collected by pytest. """
@@ -0,0 +1,61 @@
+""" Microbenchmark of the per-request CPU cost of building the chat chain.
+
+Compares building the chain and the answer branch of ``_route`` on every request
+with invoking the routing step of a chain that is built once per process.
+
+Run from the repository root:
+    python -m tests.backend.perf.bench_chain_build --iterations 500
+"""
+import argparse
+import time
+
+from langchain.output_parsers.openai_tools import JsonOutputKeyToolsParser
+
+from libs.core.approaches.chat_conversation import build_chain, build_answer_chain, _route
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.cited_answer import CitedAnswer
+from tests.backend.perf.fakes import fake_chat_options, fake_multi_index_options
+
+CONTEXT_INFO = {"context": "ID: 0URL: https://example/doc.pdfCONTENT: text\n\n", "question": "q"}
+
+def _per_request(builder, chat_options):
+    """The work the endpoint used to repeat for every request."""
+    build_chain(builder=builder, chat_options=chat_options)
+    output_parser = JsonOutputKeyToolsParser(key_name="CitedAnswer", first_tool_only=True)
+    llm_with_tool = builder.llm().bind_tools([CitedAnswer], tool_choice="CitedAnswer")
+    chat_template = builder.chat_template(chat_options.system_prompt)
+    return chat_template | llm_with_tool | output_parser
+
+def _prebuilt(answer_chain, default_answer):
+    """The only chain work left for a request once the chain is built at startup."""
+    return _route(answer_chain, default_answer, CONTEXT_INFO)
+
+def _cpu_time_per_call(func, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - start) / iterations
+
+def main():
+    """Runs the benchmark and prints the CPU time per request for both strategies."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    chat_options = fake_chat_options()
+    builder = MultiIndexChatBuilder(multi_index_options=fake_multi_index_options())
+    answer_chain = build_answer_chain(builder, chat_options)
+    default_answer = builder.default_return_message(chat_options.default_return_message)
+
+    # Warm up so that one-time imports and client creation are not measured.
+    _per_request(builder, chat_options)
+
+    per_request = _cpu_time_per_call(lambda: _per_request(builder, chat_options), args.iterations)
+    prebuilt = _cpu_time_per_call(lambda: _prebuilt(answer_chain, default_answer), args.iterations)
+
+    print(f"build per request : {per_request * 1e6:10.1f} us CPU / request")
+    print(f"prebuilt chain    : {prebuilt * 1e6:10.1f} us CPU / request")
+    print(f"saved             : {(per_request - prebuilt) * 1e6:10.1f} us CPU / request")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+""" Microbenchmarks of the CPU cost of the retrieval and response hot path.
+
+Every stage runs offline against deterministic stand-ins, at a realistic size
+and at a large size. The results are written as JSON and can be compared with
+a stored baseline, which fails the run when a stage got slower than the
+allowed threshold.
+
+Run from the repository root:
+    python -m tests.backend.perf.bench_hot_path --output bench.json
+    python -m tests.backend.perf.bench_hot_path --baseline baseline.json --save-baseline
+    python -m tests.backend.perf.bench_hot_path --baseline baseline.json --threshold 1.25
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+from langchain.output_parsers.openai_tools import JsonOutputKeyToolsParser
+from langchain_core.messages import AIMessage
+
+from libs.core.approaches.chat_conversation import build_chain, build_answer_chain, _route
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import IndexOptions
+from libs.core.services.search_vector_index_service import _to_scored_document
+from models.chat_response import (
+    Answer,
+    AnswerQueryConfig,
+    ChatResponse,
+    ChatResponseArgs,
+    to_response_item,
+)
+from tests.backend.perf.fakes import (
+    FAKE_CITED_ANSWER,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+    fake_search_results,
+)
+
+# Documents per index and number of indexes, for the realistic and the large case.
+SIZES = {"realistic": (10, 2), "large": (500, 8)}
+# Citations in the parsed answer and the chat response.
+CITATIONS = {"realistic": 3, "large": 100}
+
+def _builder(per_index: int, indexes: int) -> MultiIndexChatBuilder:
+    options = fake_multi_index_options()
+    options.indexes = [
+        IndexOptions(name=f"index-{i}", k=per_index, weight=1.0, timeout_seconds=5.0)
+        for i in range(indexes)
+    ]
+    options.final_k = 3 if per_index <= 10 else 50
+    builder = MultiIndexChatBuilder(multi_index_options=options)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    return builder
+
+def _retrieval(per_index: int, indexes: int) -> dict:
+    return {
+        "documents": {
+            f"index-{i}": [
+                _to_scored_document(result)
+                for result in fake_search_results("prune tomatoes", per_index, seed=i)
+            ]
+            for i in range(indexes)
+        },
+        "dropped_indexes": [],
+    }
+
+def _cited_answer(citations: int) -> dict:
+    return {
+        "answer": FAKE_CITED_ANSWER["answer"] * max(1, citations // 3),
+        "citations": [
+            {"source_id": i, "url": f"source-{i}", "title": f"Source {i}", "page_number": i}
+            for i in range(citations)
+        ],
+    }
+
+def _tool_call_message(cited_answer: dict) -> AIMessage:
+    return AIMessage(content="", tool_calls=[
+        {"name": "CitedAnswer", "args": cited_answer, "id": "call_0"}])
+
+def _chat_response(cited_answer: dict) -> ChatResponse:
+    return ChatResponse(
+        answer=Answer(
+            formatted_answer=cited_answer["answer"],
+            citations=cited_answer["citations"],
+            answer_query_config=AnswerQueryConfig(query="How do I prune tomatoes?")),
+        chat_response_args=ChatResponseArgs(),
+        dropped_indexes=[])
+
+def _cases():
+    """Yields (name, size, function) for every stage at every size."""
+    chat_options = fake_chat_options()
+    parser = JsonOutputKeyToolsParser(key_name="CitedAnswer", first_tool_only=True)
+
+    for size, (per_index, indexes) in SIZES.items():
+        builder = _builder(per_index, indexes)
+        retrieval = _retrieval(per_index, indexes)
+        ranked = builder.sort_and_filter_documents(retrieval)
+        yield "sort_and_filter_documents", size, lambda b=builder, r=retrieval: (
+            b.sort_and_filter_documents(r))
+        yield "format_docs", size, lambda b=builder, d=ranked: b.format_docs(d)
+
+    builder = _builder(*SIZES["realistic"])
+    answer_chain = build_answer_chain(builder, chat_options)
+    default_answer = builder.default_return_message(chat_options.default_return_message)
+    context_info = {"context": "ID: 0\nURL: source-0\nCONTENT: text\n\n", "question": "q"}
+    yield "build_chain", "realistic", lambda: build_chain(builder=builder, chat_options=chat_options)
+    yield "_route", "realistic", lambda: _route(answer_chain, default_answer, context_info)
+
+    for size, citations in CITATIONS.items():
+        cited_answer = _cited_answer(citations)
+        message = _tool_call_message(cited_answer)
+        response = _chat_response(cited_answer)
+        yield "cited_answer_parsing", size, lambda m=message: parser.invoke(m)
+        yield "to_response_item", size, lambda r=response: json.dumps(to_response_item(r))
+
+def _measure(func, rounds: int, min_round_seconds: float) -> dict:
+    """Times the function in rounds long enough to be measured reliably,
+        and reports the CPU time of one call in microseconds."""
+    func()
+    iterations = 1
+    while True:
+        start = time.process_time()
+        for _ in range(iterations):
+            func()
+        if time.process_time() - start >= min_round_seconds:
+            break
+        iterations *= 2
+
+    per_call = []
+    for _ in range(rounds):
+        start = time.process_time()
+        for _ in range(iterations):
+            func()
+        per_call.append((time.process_time() - start) / iterations * 1e6)
+
+    return {
+        "median_us": statistics.median(per_call),
+        "min_us": min(per_call),
+        "iterations": iterations,
+        "rounds": rounds,
+    }
+
+def run(rounds: int = 5, min_round_seconds: float = 0.05) -> dict:
+    """Runs every benchmark and returns the machine-readable results."""
+    results = {}
+    for name, size, func in _cases():
+        results[f"{name}[{size}]"] = _measure(func, rounds, min_round_seconds)
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """Returns (benchmark, ratio) for every benchmark whose median is more than
+        threshold times the baseline median."""
+    regressions = []
+    for name, result in report["results"].items():
+        expected = baseline["results"].get(name)
+        if not expected:
+            continue
+        ratio = result["median_us"] / expected["median_us"]
+        result["baseline_median_us"] = expected["median_us"]
+        result["ratio"] = ratio
+        if ratio > threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+def main():
+    """Runs the benchmarks, writes the results and compares them with the baseline."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench_hot_path.json",
+        help="File the results are written to.")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with.")
+    parser.add_argument("--save-baseline", action="store_true",
+        help="Write the results to the baseline file instead of comparing with it.")
+    parser.add_argument("--threshold", type=float, default=1.2,
+        help="Slowdown relative to the baseline which fails the run.")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline needs the --baseline file to write")
+
+    report = run(rounds=args.rounds)
+    regressions = []
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.threshold)
+
+    for name, result in report["results"].items():
+        ratio = f"  x{result['ratio']:.2f}" if "ratio" in result else ""
+        print(f"{name:40} {result['median_us']:12.1f} us{ratio}")
+
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"results written to {output}")
+
+    if regressions:
+        for name, ratio in regressions:
+            print(f"REGRESSION {name}: {ratio:.2f}x the baseline")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
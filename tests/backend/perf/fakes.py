@@ -0,0 +1,290 @@
+""" Deterministic stand-ins used by the offline benchmarks. """
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from libs.core.models.options import (
+    ApiOptions,
+    ChatConversationOptions,
+    IndexOptions,
+    ModelOptions,
+    MultiIndexVectorStoreOptions,
+    OpenAIOptions,
+    RatedAnswerOptions,
+    StorageAccountOptions,
+    VectorStoreOptions,
+)
+from libs.core.services.client_registry import ClientRegistry
+from libs.core.services.resilience import Resilience
+
+SYSTEM_PROMPT = """Answer the question based only on the following context.
+Remember, you must return both an answer and citations.
+
+{context}"""
+
+def fake_multi_index_options(
+    openai_endpoint: str = "https://fake-openai.invalid",
+    search_endpoint: str = "https://fake-search.invalid") -> MultiIndexVectorStoreOptions:
+    """Options pointing at endpoints which are never called by the offline benchmarks."""
+    return MultiIndexVectorStoreOptions(
+        indexes=[
+            IndexOptions(name=name, k=10, weight=1.0, timeout_seconds=5.0, containers=["docs"])
+            for name in ("primary", "secondary")
+        ],
+        vector_store_options=VectorStoreOptions(
+            endpoint=search_endpoint,
+            key="fake-key",
+            semantic_configuration_name="payload_scoring"),
+        open_ai_options=OpenAIOptions(
+            api_options=ApiOptions(
+                endpoint=openai_endpoint,
+                api_key="fake-key",
+                api_version="2024-02-01"),
+            ai_model_options=ModelOptions(
+                deployment_model="gpt-35-turbo-16k",
+                embedding_model="text-embedding-ada-002",
+                temperature=0.0,
+                max_tokens=800,
+                n=1)),
+        storage_account_options=StorageAccountOptions(
+            account_name="fakeaccount",
+            account_key="ZmFrZS1rZXk=",
+            use_account_key=True))
+
+def fake_chat_options() -> ChatConversationOptions:
+    """Chat options with a representative system prompt."""
+    return ChatConversationOptions(
+        system_prompt=SYSTEM_PROMPT,
+        default_return_message="I'm sorry, I don't have an answer for that.",
+        rated_answer_options=RatedAnswerOptions(
+            enabled=True,
+            index_name="ratings",
+            min_score=0.95,
+            k=5))
+
+class StubSasTokenService:
+    """SasTokenService which signs nothing, so only the formatting of documents is measured."""
+
+    def get_sas_token_for_blob(self, blob_name, container_name, expiry=None):
+        return f"sv=2024-01-01&sr=b&sig={container_name}-{blob_name}"
+
+    async def aget_sas_token_for_blob(self, blob_name, container_name, expiry=None):
+        return self.get_sas_token_for_blob(blob_name, container_name, expiry)
+
+    async def astart(self):
+        pass
+
+    async def awarm(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+def _sleep(latency: float):
+    if latency:
+        time.sleep(latency)
+
+async def _asleep(latency: float):
+    if latency:
+        await asyncio.sleep(latency)
+
+def fake_search_results(query: str, count: int, seed: int = 0) -> List[dict]:
+    """Deterministic search results, shaped like the rows returned by the Azure SDK."""
+    rng = random.Random(f"{seed}:{query}")
+    rerank_scores = sorted((rng.uniform(0.0, 4.0) for _ in range(count)), reverse=True)
+    return [
+        {
+            "id": f"{seed}-{i}",
+            "content": f"Passage {i} of index {seed}. " * 20,
+            "metadata": json.dumps({"file_name": f"doc-{seed}-{i}.pdf", "container": "docs"}),
+            "@search.score": rng.uniform(0.0, 0.05),
+            "@search.reranker_score": rerank_score,
+        }
+        for i, rerank_score in enumerate(rerank_scores)
+    ]
+
+class _AsyncResults:
+    def __init__(self, results: List[dict]):
+        self._results = results
+
+    async def __aiter__(self):
+        for result in self._results:
+            yield result
+
+class FakeSearchClient:
+    """Stand-in for azure.search.documents.SearchClient."""
+
+    def __init__(self, seed: int, latency: float = 0.0):
+        self._seed = seed
+        self._latency = latency
+
+    def search(self, search_text=None, top=10, **_kwargs):
+        _sleep(self._latency)
+        return fake_search_results(search_text or "", top, self._seed)
+
+    def close(self):
+        pass
+
+class FakeAsyncSearchClient(FakeSearchClient):
+    """Stand-in for azure.search.documents.aio.SearchClient."""
+
+    async def search(self, search_text=None, top=10, **_kwargs):
+        await _asleep(self._latency)
+        return _AsyncResults(fake_search_results(search_text or "", top, self._seed))
+
+    async def close(self):
+        pass
+
+class FakeAzureSearch:
+    """Stand-in for the langchain AzureSearch vector store."""
+
+    def __init__(self, seed: int, latency: float = 0.0, index_name: str = "fake"):
+        self.index_name = index_name
+        self.client = FakeSearchClient(seed, latency)
+        self.async_client = FakeAsyncSearchClient(seed, latency)
+        self.semantic_configuration_name = "payload_scoring"
+        self._latency = latency
+
+    def add_texts(self, texts, metadatas=None, **_kwargs):
+        _sleep(self._latency)
+        return [str(uuid.uuid4()) for _ in texts]
+
+    async def aadd_texts(self, texts, metadatas=None, **_kwargs):
+        await _asleep(self._latency)
+        return [str(uuid.uuid4()) for _ in texts]
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings with a configurable latency per call."""
+
+    def __init__(self, size: int = 1536, latency: float = 0.0):
+        self._size = size
+        self._latency = latency
+
+    def _vector(self, text: str) -> List[float]:
+        rng = random.Random(text)
+        return [rng.uniform(-1.0, 1.0) for _ in range(self._size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        _sleep(self._latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await _asleep(self._latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+FAKE_CITED_ANSWER = {
+    "answer": "Prune the suckers which grow where a leaf meets the stem. " * 5,
+    "citations": [
+        {"source_id": 0, "url": "source-0", "title": "Pruning tomatoes", "page_number": 1},
+        {"source_id": 1, "url": "source-1", "title": "Tomato care", "page_number": 3},
+    ],
+}
+
+class FakeToolCallingChatModel(BaseChatModel):
+    """Chat model which always calls the CitedAnswer tool, after a configurable latency."""
+
+    latency: float = 0.0
+    cited_answer: dict = FAKE_CITED_ANSWER
+    chunk_size: int = 8
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-tool-calling"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        return self.bind(
+            tools=[convert_to_openai_tool(tool) for tool in tools],
+            tool_choice=tool_choice,
+            **kwargs)
+
+    def _result(self) -> ChatResult:
+        arguments = json.dumps(self.cited_answer)
+        message = AIMessage(
+            content="",
+            additional_kwargs={"tool_calls": [{
+                "id": "call_0",
+                "type": "function",
+                "function": {"name": "CitedAnswer", "arguments": arguments},
+            }]},
+            tool_calls=[{"name": "CitedAnswer", "args": self.cited_answer, "id": "call_0"}],
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        _sleep(self.latency)
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await _asleep(self.latency)
+        return self._result()
+
+    def _chunks(self):
+        arguments = json.dumps(self.cited_answer)
+        for start in range(0, len(arguments), self.chunk_size):
+            first = start == 0
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[{
+                    "name": "CitedAnswer" if first else None,
+                    "args": arguments[start:start + self.chunk_size],
+                    "id": "call_0" if first else None,
+                    "index": 0,
+                }]))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        _sleep(self.latency)
+        yield from self._chunks()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await _asleep(self.latency)
+        for chunk in self._chunks():
+            yield chunk
+
+class FakeClientRegistry(ClientRegistry):
+    """Client registry handing out the fakes above instead of Azure clients."""
+
+    def __init__(
+            self,
+            multi_index_options: MultiIndexVectorStoreOptions,
+            embedding_latency: float = 0.0,
+            search_latency: float = 0.0,
+            llm_latency: float = 0.0,
+            embedding_size: int = 1536,
+            resilience: Resilience | None = None
+        ):
+        super().__init__(multi_index_options, resilience=resilience)
+        self._fake_embeddings = FakeEmbeddings(size=embedding_size, latency=embedding_latency)
+        self._search_latency = search_latency
+        self._fake_search_clients = {}
+        self._fake_chat_model = FakeToolCallingChatModel(latency=llm_latency)
+
+    def embeddings(self, cached: bool = True) -> Embeddings:
+        return self._fake_embeddings
+
+    def search_client(self, index_name: str):
+        if index_name not in self._fake_search_clients:
+            seed = len(self._fake_search_clients)
+            self._fake_search_clients[index_name] = FakeAzureSearch(
+                seed, self._search_latency, index_name)
+        return self._fake_search_clients[index_name]
+
+    def chat_model(self, deployment: str):
+        return self._fake_chat_model
+
+    async def aclose(self):
+        pass
@@ -0,0 +1,93 @@
+""" Import-time profile of a worker's startup.
+
+Runs a fresh interpreter with ``-X importtime`` which imports backend/main.py,
+which is what a worker does before it can answer a probe, and then builds the
+services, which the app does on a background task after the worker started.
+Reports the wall time of both phases and, for each, the modules which took
+longest to import, by cumulative and by self time, and the time per top-level
+package. The settings point at unreachable hosts; building the services makes
+no requests.
+
+Run from the repository root:
+    python -m tests.backend.perf.import_profile --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "backend"))
+MARKER = "--- services ---"
+
+STARTUP = f"""
+import sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+sys.stderr.write("{MARKER}\\n")
+import app_services
+app_services.build_services()
+built = time.perf_counter()
+print(imported - start, built - imported)
+"""
+
+STUB_ENVIRONMENT = {
+    "AZURE_OPENAI_ENDPOINT": "https://openai.invalid",
+    "AZURE_OPENAI_API_KEY": "stub-key",
+    "AZURE_SEARCH_ENDPOINT": "https://search.invalid",
+    "AZURE_AI_SEARCH_API_KEY": "stub-key",
+    "STORAGE_ACCOUNT_NAME": "stubaccount",
+    "STORAGE_ACCOUNT_KEY": "c3R1Yi1rZXk=",
+}
+
+Import = Tuple[str, int, int]
+
+def _parse(lines: List[str]) -> List[Import]:
+    """Parses the "import time: self | cumulative | module" lines, in microseconds."""
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+def _by_package(imports: List[Import]) -> Dict[str, int]:
+    packages = defaultdict(int)
+    for module, self_us, _ in imports:
+        packages[module.split(".")[0]] += self_us
+    return packages
+
+def _report(title: str, seconds: float, imports: List[Import], top: int):
+    print(f"{title}: {seconds * 1000:.0f} ms, {len(imports)} modules imported")
+    print("  by cumulative time")
+    for module, _, cumulative_us in sorted(imports, key=lambda i: -i[2])[:top]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  {module}")
+    print("  by self time")
+    for module, self_us, _ in sorted(imports, key=lambda i: -i[1])[:top]:
+        print(f"    {self_us / 1000:8.1f} ms  {module}")
+    print("  by package")
+    for package, self_us in sorted(_by_package(imports).items(), key=lambda p: -p[1])[:top]:
+        print(f"    {self_us / 1000:8.1f} ms  {package}")
+    print()
+
+def main():
+    """Profiles the startup in a new interpreter and prints the report."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP],
+        cwd=BACKEND_DIR, env={**os.environ, **STUB_ENVIRONMENT},
+        capture_output=True, text=True, check=True)
+    import_seconds, build_seconds = (float(value) for value in result.stdout.split()[-2:])
+    before, _, after = result.stderr.partition(MARKER)
+
+    _report("import main (before the worker serves)", import_seconds, _parse(before.splitlines()), args.top)
+    _report("build_services (in the background)", build_seconds, _parse(after.splitlines()), args.top)
+
+if __name__ == "__main__":
+    main()
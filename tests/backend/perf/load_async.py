@@ -0,0 +1,80 @@
+""" Load test comparing the sync and async chat paths against local stub services.
+
+The stubs add a fixed latency to every embedding, search and LLM call, so the test
+shows how many requests one worker can keep waiting on I/O at the same time. The
+sync path runs chain.invoke through a thread pool limited to 40 threads, the
+default for sync endpoints in Starlette. The async path awaits chain.ainvoke on the
+event loop.
+
+Run from the repository root:
+    python -m tests.backend.perf.load_async --requests 2000 --concurrency 500
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import anyio
+
+from libs.core.approaches.chat_conversation import build_chain
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from tests.backend.perf.fakes import (
+    FakeClientRegistry,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+STARLETTE_THREADPOOL_SIZE = 40
+
+async def _drive(call, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await call({"question": f"How do I prune tomato plant {i}?"})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, latencies
+
+def _report(name: str, throughput: float, latencies):
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:6}: {throughput:8.1f} req/s  "
+          f"p50 {quantiles[49] * 1000:7.1f} ms  p99 {quantiles[98] * 1000:7.1f} ms")
+
+async def main():
+    """Runs the same load through the sync and the async path and prints the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.15)
+    parser.add_argument("--llm-latency", type=float, default=1.5)
+    parser.add_argument("--embedding-size", type=int, default=1536,
+        help="Smaller vectors reduce the CPU spent serializing vector queries.")
+    args = parser.parse_args()
+
+    multi_index_options = fake_multi_index_options()
+    registry = FakeClientRegistry(
+        multi_index_options,
+        embedding_latency=args.embedding_latency,
+        search_latency=args.search_latency,
+        llm_latency=args.llm_latency,
+        embedding_size=args.embedding_size)
+    builder = MultiIndexChatBuilder(multi_index_options, client_registry=registry)
+    chain = build_chain(builder=builder, chat_options=fake_chat_options())
+
+    limiter = anyio.CapacityLimiter(STARLETTE_THREADPOOL_SIZE)
+
+    async def sync_call(inputs):
+        return await anyio.to_thread.run_sync(chain.invoke, inputs, limiter=limiter)
+
+    _report("sync", *await _drive(sync_call, args.requests, args.concurrency))
+    _report("async", *await _drive(chain.ainvoke, args.requests, args.concurrency))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,261 @@
+""" End-to-end load test of the chat app against local stand-ins for the Azure services.
+
+Starts the stand-ins of stub_services and the app of backend/main.py in this
+process, pointed at them, then sends /chat and /rate requests at a target
+rate for a fixed duration. Requests are sent on schedule whether or not
+earlier ones finished, so a saturated app shows up as growing latency
+instead of a lower send rate. Reports throughput, p50, p95 and p99 per
+endpoint, the time spent in every chain stage, and the calls made to the
+stand-ins.
+
+The app, the stand-ins and the driver share one process, so once the app is
+CPU bound the results are pessimistic. A smaller --embedding-size lowers the
+CPU spent serializing vectors.
+
+Run from the repository root:
+    python -m tests.backend.perf.load_e2e --rps 20 --duration 30 --output load.json
+    python -m tests.backend.perf.load_e2e --rps 50 --chat-latency 0.8:2 --search-error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict
+from uuid import UUID
+
+import httpx
+import uvicorn
+from langchain_core.callbacks import BaseCallbackHandler
+
+from tests.backend.perf.stub_services import (
+    add_profile_arguments,
+    create_stub_app,
+    profiles_from_arguments,
+)
+
+READY_TIMEOUT_SECONDS = 30
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "backend"))
+
+class StageTimer(BaseCallbackHandler):
+    """Records how long every named stage of the chain takes, such as the
+        retrieval, packing and LLM stages. The runnables which only compose
+        the stages are left out."""
+
+    run_inline = True
+
+    def __init__(self):
+        self._starts: Dict[UUID, tuple] = {}
+        self.durations = defaultdict(list)
+
+    def _start(self, name: str, run_id: UUID):
+        if not name.startswith("Runnable"):
+            self._starts[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id: UUID):
+        name, start = self._starts.pop(run_id, (None, None))
+        if name:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, name=None, **kwargs: Any):
+        self._start(name or (serialized or {}).get("name", "chain"), run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs: Any):
+        self._start("llm", run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs: Any):
+        self._end(run_id)
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class _ServerThread:
+    """Runs a uvicorn server on a background thread."""
+
+    def __init__(self, app, port: int):
+        self._server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.05)
+
+    def stop(self):
+        """Stops the server once its lifespan has shut down."""
+        self._server.should_exit = True
+        self._thread.join()
+
+def _start_app(stub_url: str, timer: StageTimer, port: int) -> _ServerThread:
+    """Imports the app with its settings pointed at the stand-ins and serves it."""
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": stub_url,
+        "AZURE_OPENAI_API_KEY": "stub-key",
+        "AZURE_SEARCH_ENDPOINT": stub_url,
+        "AZURE_AI_SEARCH_API_KEY": "stub-key",
+        "STORAGE_ACCOUNT_NAME": "stubaccount",
+        "STORAGE_ACCOUNT_KEY": "c3R1Yi1rZXk=",
+        "STORAGE_ACCOUNT_ENDPOINT": stub_url,
+    })
+    # The app reads chat_config.yaml from the working directory.
+    os.chdir(BACKEND_DIR)
+    sys.path.insert(0, BACKEND_DIR)
+    import main # pylint: disable=import-outside-toplevel,import-error
+
+    def services_factory():
+        services = main.build_services()
+        services.chain = services.chain.with_config(callbacks=[timer])
+        return services
+
+    server = _ServerThread(main.create_app(services_factory), port)
+    # Wait for the services to be built and their clients warm, so the startup is not measured.
+    deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+    while (readiness := httpx.get(f"http://127.0.0.1:{port}/readyz")).status_code != 200:
+        if time.monotonic() > deadline:
+            print(f"app not ready, starting anyway: {readiness.json()}", file=sys.stderr)
+            break
+        time.sleep(0.05)
+    return server
+
+def _chat_body(i: int) -> dict:
+    return {"dialog": f"How do I prune tomato plant number {i}?"}
+
+def _rate_body(i: int) -> dict:
+    return {
+        "dialog_id": f"dialog-{i}",
+        "rating": i % 3 != 0,
+        "request": f"How do I prune tomato plant number {i}?",
+        "response": "Prune the suckers which grow where a leaf meets the stem.",
+        "citations": [],
+    }
+
+async def _drive(app_url: str, rps: float, duration: float, rate_share: float, seed: int):
+    """Sends requests at the target rate, with Poisson arrivals, and records the outcomes."""
+    rng = random.Random(seed)
+    outcomes = defaultdict(list)
+    tasks = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        async def one(i: int, endpoint: str, body: dict):
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, json=body)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            outcomes[endpoint].append((ok, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        next_send, i = start, 0
+        while next_send < start + duration:
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            if rng.random() < rate_share:
+                tasks.append(asyncio.create_task(one(i, "/rate", _rate_body(i))))
+            else:
+                tasks.append(asyncio.create_task(one(i, "/chat", _chat_body(i))))
+            next_send += rng.expovariate(rps)
+            i += 1
+        sent_seconds = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return outcomes, sent_seconds, elapsed
+
+def _percentiles(latencies) -> dict:
+    if len(latencies) < 2:
+        value = latencies[0] if latencies else 0.0
+        return {"p50": value, "p95": value, "p99": value, "mean": value}
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": quantiles[49],
+        "p95": quantiles[94],
+        "p99": quantiles[98],
+        "mean": statistics.fmean(latencies),
+    }
+
+def build_report(outcomes, sent_seconds: float, elapsed: float, timer: StageTimer, stub_stats: dict) -> dict:
+    """Summarizes the load test as a machine-readable report."""
+    endpoints = {}
+    for endpoint, results in outcomes.items():
+        latencies = [latency for ok, latency in results if ok]
+        endpoints[endpoint] = {
+            "sent": len(results),
+            "succeeded": len(latencies),
+            "failed": len(results) - len(latencies),
+            "sent_per_second": len(results) / sent_seconds,
+            "throughput_per_second": len(latencies) / elapsed,
+            "latency_seconds": _percentiles(latencies),
+        }
+    stages = {
+        name: {"count": len(durations), **_percentiles(durations)}
+        for name, durations in sorted(
+            timer.durations.items(), key=lambda item: -sum(item[1]))
+    }
+    return {"endpoints": endpoints, "stages_seconds": stages, "stand_ins": stub_stats}
+
+def _print_report(report: dict):
+    for endpoint, result in report["endpoints"].items():
+        latency = result["latency_seconds"]
+        print(f"{endpoint:6} sent {result['sent']:6}  failed {result['failed']:5}  "
+            f"{result['throughput_per_second']:7.1f} req/s  p50 {latency['p50'] * 1000:8.1f} ms  "
+            f"p95 {latency['p95'] * 1000:8.1f} ms  p99 {latency['p99'] * 1000:8.1f} ms")
+    print("stage                              count     mean ms      p50 ms      p95 ms")
+    for name, stage in report["stages_seconds"].items():
+        print(f"{name[:32]:32} {stage['count']:8}  {stage['mean'] * 1000:10.1f}  "
+            f"{stage['p50'] * 1000:10.1f}  {stage['p95'] * 1000:10.1f}")
+    for name, stand_in in report["stand_ins"].items():
+        print(f"stand-in {name:10} calls {stand_in['calls']:7}  errors {stand_in['errors']:5}")
+
+def main():
+    """Starts the stand-ins and the app, runs the load and reports the results."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rps", type=float, default=20.0, help="Target requests per second.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to send requests for.")
+    parser.add_argument("--rate-share", type=float, default=0.1,
+        help="Share of the requests sent to /rate instead of /chat.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="File the JSON report is written to.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    profiles = profiles_from_arguments(args)
+    stub_port, app_port = _free_port(), _free_port()
+    stub_server = _ServerThread(create_stub_app(profiles, args.seed), stub_port)
+    timer = StageTimer()
+    app_server = _start_app(f"http://127.0.0.1:{stub_port}", timer, app_port)
+
+    try:
+        outcomes, sent_seconds, elapsed = asyncio.run(_drive(
+            f"http://127.0.0.1:{app_port}", args.rps, args.duration, args.rate_share, args.seed))
+    finally:
+        # The app flushes its queued ratings to the stand-ins while shutting down.
+        app_server.stop()
+        stub_server.stop()
+
+    report = build_report(outcomes, sent_seconds, elapsed, timer, profiles.stats())
+    report["settings"] = vars(args)
+    _print_report(report)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
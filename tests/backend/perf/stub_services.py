@@ -0,0 +1,249 @@
+""" Local HTTP stand-ins for the Azure services the chat app calls.
+
+One FastAPI app serves the parts of the Azure AI Search, Azure OpenAI and Blob
+Storage REST APIs used by the backend. Each service adds a latency drawn
+from a log-normal distribution and fails a share of its calls, so the
+backend can be load tested without calling paid endpoints.
+
+Run on its own from the repository root:
+    python -m tests.backend.perf.stub_services --port 8100 --search-latency 0.15:0.6
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+from tests.backend.perf.fakes import FAKE_CITED_ANSWER, fake_search_results
+
+# z-score of the 99th percentile of a normal distribution.
+_Z_99 = 2.326
+
+@dataclass
+class ServiceProfile:
+    """Latency distribution and error rate of one stand-in service.
+        The latency is log-normal with the given median and 99th percentile, in seconds."""
+    median: float = 0.0
+    p99: float = 0.0
+    error_rate: float = 0.0
+    calls: int = 0
+    errors: int = 0
+    injected_seconds: float = 0.0
+
+    def latency(self, rng: random.Random) -> float:
+        """Draws the latency of one call."""
+        if self.median <= 0:
+            return 0.0
+        sigma = math.log(max(self.p99, self.median) / self.median) / _Z_99
+        return rng.lognormvariate(math.log(self.median), sigma)
+
+    @classmethod
+    def parse(cls, value: str, error_rate: float = 0.0) -> "ServiceProfile":
+        """Parses "median" or "median:p99", in seconds."""
+        median, _, p99 = value.partition(":")
+        return cls(median=float(median), p99=float(p99 or median), error_rate=error_rate)
+
+@dataclass
+class StubProfiles:
+    """The profiles of every stand-in service."""
+    search: ServiceProfile = field(default_factory=ServiceProfile)
+    embeddings: ServiceProfile = field(default_factory=ServiceProfile)
+    chat: ServiceProfile = field(default_factory=ServiceProfile)
+    blob: ServiceProfile = field(default_factory=ServiceProfile)
+    embedding_size: int = 1536
+
+    def stats(self) -> Dict[str, dict]:
+        """Returns the calls, failures and injected latency of every service."""
+        return {
+            name: {
+                "calls": profile.calls,
+                "errors": profile.errors,
+                "mean_injected_seconds": (
+                    profile.injected_seconds / profile.calls if profile.calls else 0.0),
+            }
+            for name, profile in (
+                ("search", self.search),
+                ("embeddings", self.embeddings),
+                ("chat", self.chat),
+                ("blob", self.blob))
+        }
+
+def _index_definition(index_name: str, embedding_size: int) -> dict:
+    return {
+        "name": index_name,
+        "fields": [
+            {"name": "id", "type": "Edm.String", "key": True, "filterable": True},
+            {"name": "content", "type": "Edm.String", "searchable": True},
+            {"name": "content_vector", "type": "Collection(Edm.Single)", "searchable": True,
+                "dimensions": embedding_size, "vectorSearchProfile": "default"},
+            {"name": "metadata", "type": "Edm.String", "searchable": True},
+        ],
+    }
+
+def _search_result(result: dict) -> dict:
+    """Renames the reranker score to its name on the wire."""
+    wire = dict(result)
+    wire["@search.rerankerScore"] = wire.pop("@search.reranker_score")
+    return wire
+
+def _chat_completion(deployment: str) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": deployment,
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls",
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": "CitedAnswer", "arguments": json.dumps(FAKE_CITED_ANSWER)},
+                }],
+            },
+        }],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 150, "total_tokens": 1350},
+    }
+
+def _user_delegation_key() -> str:
+    now = time.gmtime()
+    expiry = time.gmtime(time.time() + 86400)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><UserDelegationKey>'
+        "<SignedOid>00000000-0000-0000-0000-000000000000</SignedOid>"
+        "<SignedTid>00000000-0000-0000-0000-000000000000</SignedTid>"
+        f"<SignedStart>{time.strftime('%Y-%m-%dT%H:%M:%SZ', now)}</SignedStart>"
+        f"<SignedExpiry>{time.strftime('%Y-%m-%dT%H:%M:%SZ', expiry)}</SignedExpiry>"
+        "<SignedService>b</SignedService><SignedVersion>2024-08-04</SignedVersion>"
+        "<Value>ZmFrZS1kZWxlZ2F0aW9uLWtleQ==</Value></UserDelegationKey>"
+    )
+
+def create_stub_app(profiles: StubProfiles, seed: int = 0) -> FastAPI:
+    """Creates the app serving the Azure AI Search, Azure OpenAI and Blob Storage stand-ins."""
+    app = FastAPI()
+    app.state.profiles = profiles
+    rng = random.Random(seed)
+
+    async def _delay(profile: ServiceProfile, status_code: int) -> Response | None:
+        """Waits for the drawn latency, and returns an error response for failed calls."""
+        latency = profile.latency(rng)
+        profile.calls += 1
+        profile.injected_seconds += latency
+        await asyncio.sleep(latency)
+        if rng.random() < profile.error_rate:
+            profile.errors += 1
+            return JSONResponse(
+                {"error": {"code": "Injected", "message": "Injected failure"}},
+                status_code=status_code,
+                headers={"Retry-After": "1"})
+        return None
+
+    @app.get("/indexes('{index_name}')")
+    async def get_index(index_name: str):
+        return _index_definition(index_name, profiles.embedding_size)
+
+    @app.post("/indexes('{index_name}')/docs/search.post.search")
+    async def search(index_name: str, request: Request):
+        error = await _delay(profiles.search, 503)
+        if error:
+            return error
+        body = await request.json()
+        results = fake_search_results(
+            body.get("search") or "", body.get("top") or 10, seed=zlib.crc32(index_name.encode()))
+        return {"value": [_search_result(result) for result in results]}
+
+    @app.post("/indexes('{index_name}')/docs/search.index")
+    async def upload(index_name: str, request: Request):
+        error = await _delay(profiles.search, 503)
+        if error:
+            return error
+        documents = (await request.json())["value"]
+        return {"value": [
+            {"key": document["id"], "status": True, "errorMessage": None, "statusCode": 201}
+            for document in documents
+        ]}
+
+    @app.post("/openai/deployments/{deployment}/embeddings")
+    async def embeddings(deployment: str, request: Request):
+        error = await _delay(profiles.embeddings, 429)
+        if error:
+            return error
+        inputs = (await request.json())["input"]
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        return {
+            "object": "list",
+            "model": deployment,
+            "data": [
+                {"object": "embedding", "index": i,
+                    "embedding": [rng.uniform(-1.0, 1.0) for _ in range(profiles.embedding_size)]}
+                for i in range(len(inputs))
+            ],
+            "usage": {"prompt_tokens": 10 * len(inputs), "total_tokens": 10 * len(inputs)},
+        }
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str):
+        error = await _delay(profiles.chat, 429)
+        if error:
+            return error
+        return _chat_completion(deployment)
+
+    @app.post("/")
+    async def user_delegation_key(restype: str = "", comp: str = ""):
+        if (restype, comp) != ("service", "userdelegationkey"):
+            return Response(status_code=400)
+        error = await _delay(profiles.blob, 503)
+        if error:
+            return error
+        return Response(_user_delegation_key(), media_type="application/xml")
+
+    @app.get("/stub/stats")
+    async def stats():
+        return profiles.stats()
+
+    return app
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Adds the latency and error rate arguments of every stand-in service."""
+    for name, latency in (("search", "0.15:0.6"), ("embeddings", "0.05:0.2"),
+            ("chat", "1.5:4.0"), ("blob", "0.05:0.2")):
+        parser.add_argument(f"--{name}-latency", default=latency,
+            help=f"Median, or median:p99, latency of {name} calls in seconds.")
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0,
+            help=f"Share of {name} calls which fail.")
+    parser.add_argument("--embedding-size", type=int, default=1536)
+
+def profiles_from_arguments(args: argparse.Namespace) -> StubProfiles:
+    """Builds the service profiles from the parsed arguments."""
+    return StubProfiles(
+        search=ServiceProfile.parse(args.search_latency, args.search_error_rate),
+        embeddings=ServiceProfile.parse(args.embeddings_latency, args.embeddings_error_rate),
+        chat=ServiceProfile.parse(args.chat_latency, args.chat_error_rate),
+        blob=ServiceProfile.parse(args.blob_latency, args.blob_error_rate),
+        embedding_size=args.embedding_size)
+
+def main():
+    """Serves the stand-ins until interrupted."""
+    import uvicorn # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    uvicorn.run(create_stub_app(profiles_from_arguments(args)), port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+""" This module contains tests for the lazy configuration and the background startup of the app. """
+
+import asyncio
+import threading
+import time
+import types
+import pytest
+from fastapi.testclient import TestClient
+import config
+import main
+
+class _FakeServices:
+    """ Services whose warmup finishes once released."""
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.closed = False
+        self.rating_queue = types.SimpleNamespace(stats=lambda: {"queue_depth": 0})
+
+    async def astart(self):
+        pass
+
+    async def awarm(self):
+        await asyncio.to_thread(self.released.wait)
+
+    def warmup_status(self):
+        return {"search": {"status": "done" if self.released.is_set() else "pending"}}
+
+    async def aclose(self):
+        self.closed = True
+
+def _wait_for_status(client: TestClient, status: str) -> dict:
+    for _ in range(200):
+        body = client.get("/readyz").json()
+        if body["status"] == status:
+            return body
+        time.sleep(0.01)
+    raise AssertionError(f"the startup never reached {status}: {body}")
+
+@pytest.fixture(name="loads")
+def loads_fixture(monkeypatch):
+    """ Counts the loads of a configuration which only has the telemetry section."""
+
+    loads = []
+    settings = {"chat_approach": {"telemetry": {"opentelemetry_enabled": False, "trace_id_header": "X-Id"}}}
+    monkeypatch.setattr(config, "load_config", lambda: loads.append(1) or settings)
+    vars(config).pop("telemetry_options", None)
+    config.get_config.cache_clear()
+    yield loads
+    vars(config).pop("telemetry_options", None)
+    config.get_config.cache_clear()
+
+def test_config_is_loaded_once_on_first_use(loads):
+    """ Test that importing the configuration loads nothing, and the first option access loads it once."""
+
+    assert not loads
+    assert config.telemetry_options.trace_id_header == "X-Id"
+    assert config.telemetry_options is config.telemetry_options
+    assert len(loads) == 1
+
+def test_ready_once_the_clients_are_warm(monkeypatch):
+    """ Test that requests are served once the services are built, and the app is ready once they are warm."""
+
+    monkeypatch.setitem(vars(config), "telemetry_options", types.SimpleNamespace(trace_id_header="X-Trace-Id"))
+    services = _FakeServices()
+
+    with TestClient(main.create_app(lambda: services)) as client:
+        warming = _wait_for_status(client, "warming")
+        liveness = client.get("/healthz")
+        rate_stats = client.get("/rate/stats")
+        services.released.set()
+        ready = _wait_for_status(client, "ready")
+        readiness = client.get("/readyz")
+
+    assert "build_seconds" in warming
+    assert liveness.json() == {"status": "warming"}
+    assert rate_stats.json() == {"queue_depth": 0}
+    assert readiness.status_code == 200
+    assert "warm_seconds" in ready
+    assert ready["warmup"] == {"search": {"status": "done"}}
+    assert services.closed
+
+def test_failed_builds_are_reported(monkeypatch):
+    """ Test that services which failed to build answer 503, while the worker stays live."""
+
+    monkeypatch.setitem(vars(config), "telemetry_options", types.SimpleNamespace(trace_id_header="X-Trace-Id"))
+
+    def failing_factory():
+        raise KeyError("AZURE_SEARCH_ENDPOINT")
+
+    with TestClient(main.create_app(failing_factory)) as client:
+        failed = _wait_for_status(client, "failed")
+        readiness = client.get("/readyz")
+        liveness = client.get("/healthz")
+        rate_stats = client.get("/rate/stats")
+
+    assert "AZURE_SEARCH_ENDPOINT" in failed["error"]
+    assert readiness.status_code == 503
+    assert liveness.status_code == 200
+    assert rate_stats.status_code == 503
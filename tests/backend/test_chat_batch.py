@@ -0,0 +1,38 @@
+""" This module contains tests for answering a batch of questions. """
+
+import asyncio
+import random
+from unittest.mock import AsyncMock, Mock
+import pytest
+from langchain_core.runnables import RunnableLambda
+from libs.core.approaches.chat_batch import answer_batch
+from libs.core.models.options import ChatBatchOptions
+
+@pytest.fixture(name="builder")
+def builder_fixture():
+    """ A builder which embeds every question as its length."""
+
+    builder = Mock()
+    builder.aembed_questions = AsyncMock(
+        side_effect=lambda questions: [[float(len(question))] for question in questions])
+    return builder
+
+async def _answer(inputs):
+    await asyncio.sleep(random.uniform(0, 0.01))
+    if inputs["question"] == "fail":
+        raise ValueError("no answer")
+    return {"answer": inputs["question"], "embedding": inputs["embedding"]}
+
+def test_results_are_in_input_order_with_errors(builder):
+    """ Test that every question gets its own result, in order, and failures do not stop the batch."""
+
+    questions = [f"question {i}" for i in range(20)] + ["fail", "last"]
+    options = ChatBatchOptions(
+        embedding_batch_size=8, max_concurrency=4, max_search_concurrency=4, max_llm_concurrency=2)
+
+    results = asyncio.run(answer_batch(RunnableLambda(_answer), builder, questions, options))
+
+    assert [output["answer"] for output, _ in results[:20]] == questions[:20]
+    assert results[20][0] is None and isinstance(results[20][1], ValueError)
+    assert results[21][0] == {"answer": "last", "embedding": [4.0]}
+    assert builder.aembed_questions.await_count == 3
@@ -0,0 +1,86 @@
+""" This module contains tests for streaming the chat answer. """
+
+import asyncio
+import time
+from unittest.mock import Mock
+import pytest
+import main
+from libs.core.approaches.chat_conversation import build_chain
+from libs.core.approaches.chat_stream import astream_answer
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from models.chat_request import ChatRequest
+from tests.backend.perf.fakes import (
+    FAKE_CITED_ANSWER,
+    FakeClientRegistry,
+    FakeToolCallingChatModel,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+STORAGE = "https://fakeaccount.blob.core.windows.net"
+# Quotes, a line break and accented letters are escaped in the tool call arguments,
+# and the small chunks split their escape sequences.
+ANSWER = 'Pinch out the "suckers" in the leaf axils.\nA légère pruning in été helps. ' * 3
+
+def _chain(model: FakeToolCallingChatModel):
+    registry = FakeClientRegistry(fake_multi_index_options(), embedding_size=8)
+    registry.chat_model = lambda deployment: model
+    builder = MultiIndexChatBuilder(fake_multi_index_options(), client_registry=registry)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    chat_options = fake_chat_options()
+    chat_options.rated_answer_options.enabled = False
+    return build_chain(builder=builder, chat_options=chat_options)
+
+async def _events(chain, question="How do I prune tomatoes?"):
+    return [event async for event in astream_answer(chain, {"question": question})]
+
+@pytest.mark.parametrize("chunk_size", [1, 5])
+def test_answer_is_streamed_from_the_partial_tool_call(chunk_size):
+    """ Test that the answer is streamed in several tokens while the arguments of the
+        tool call are still incomplete JSON, and the tokens add up to the answer
+        however the arguments are split."""
+
+    model = FakeToolCallingChatModel(cited_answer=FAKE_CITED_ANSWER | {"answer": ANSWER}, chunk_size=chunk_size)
+    events = asyncio.run(_events(_chain(model)))
+
+    tokens = [data for event, data in events if event == "token"]
+    assert len(tokens) > 10
+    assert "".join(tokens) == ANSWER
+    assert [event for event, _ in events[:-1]] == ["token"] * len(tokens)
+    assert events[-1][0] == "answer"
+    assert events[-1][1]["answer"] == ANSWER
+
+def test_streamed_citations_have_signed_urls():
+    """ Test that the citations of the final event refer to the signed URLs of the sources,
+        not to the short references the model was given."""
+
+    _, output = asyncio.run(_events(_chain(FakeToolCallingChatModel(chunk_size=3))))[-1]
+
+    urls = [citation["url"] for citation in output["citations"]]
+    assert len(urls) == len(FAKE_CITED_ANSWER["citations"])
+    for url in urls:
+        assert url.startswith(f"{STORAGE}/docs/doc-")
+        assert "sig=docs-doc-" in url
+
+def test_disconnect_stops_the_stream(monkeypatch):
+    """ Test that the stream ends without an answer, and the LLM call is cancelled,
+        once the client disconnected."""
+
+    monkeypatch.setattr(main, "DISCONNECT_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(main, "_run_config", lambda request: {})
+    polls = iter([False, False, True])
+    request = Mock()
+    request.is_disconnected = lambda: asyncio.sleep(0, next(polls))
+    services = Mock()
+    services.chain = _chain(FakeToolCallingChatModel(latency=5.0))
+
+    async def scenario():
+        return [event async for event in main._chat_events( # pylint: disable=protected-access
+            ChatRequest(dialog="How do I prune tomatoes?"), services, request)]
+
+    start = time.monotonic()
+    events = asyncio.run(scenario())
+
+    assert time.monotonic() - start < 1.0
+    assert events == []
@@ -0,0 +1,46 @@
+""" This module contains tests for packing documents into the prompt token budget. """
+
+import pytest
+from libs.core.services.context_packer import ContextPacker, expand_citations
+
+class _WordCounter:
+    """ Counts every word as one token, so budgets are easy to reason about."""
+
+    def count(self, text):
+        return len(text.split())
+
+    def truncate(self, text, max_tokens):
+        return " ".join(text.split()[:max_tokens])
+
+@pytest.fixture(name="packer")
+def packer_fixture():
+    """ A packer with room for 24 words, of which each header uses 5."""
+
+    return ContextPacker(_WordCounter(), token_budget=24, min_chunk_tokens=3)
+
+def test_documents_within_budget_are_kept(packer):
+    """ Test that documents which fit are packed whole, best first."""
+
+    context, packed = packer.pack(["one two three", "four five"])
+
+    assert packed == 2
+    assert context.startswith("ID: 0\nURL: source-0\nCONTENT: one two three\n\n")
+
+def test_documents_past_budget_are_truncated_then_dropped(packer):
+    """ Test that the document crossing the budget is truncated and later ones are dropped."""
+
+    context, packed = packer.pack(["a " * 10, "b " * 10, "c " * 10])
+
+    assert packed == 2
+    assert context.count("b") == 4
+    assert "source-2" not in context
+
+def test_citations_are_expanded():
+    """ Test that short source references are replaced with the signed URLs."""
+
+    sources = {"source-0": "https://account/docs/a.pdf?sig", "source-1": "https://account/docs/b.pdf?sig"}
+
+    citations = expand_citations(
+        [{"source_id": 0, "url": "source-0"}, {"source_id": 1, "url": "b.pdf"}], sources)
+
+    assert [citation["url"] for citation in citations] == list(sources.values())
@@ -0,0 +1,146 @@
+""" This module contains tests for the deadline of a chat request. """
+
+import asyncio
+from unittest.mock import Mock
+import pytest
+from fastapi import HTTPException
+import main
+from libs.core.approaches.chat_conversation import build_chain
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import DeadlineOptions, RequestCoalescingOptions
+from libs.core.services.deadline import DEADLINE, Deadline
+from libs.core.services.request_coalescer import RequestCoalescer
+from tests.backend.perf.fakes import (
+    FakeClientRegistry,
+    FakeToolCallingChatModel,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+def _options(**overrides) -> DeadlineOptions:
+    return DeadlineOptions(**{
+        "enabled": True,
+        "header": "X-Request-Timeout",
+        "default_seconds": 30,
+        "max_seconds": 60,
+        "llm_reserve_seconds": 10,
+        "min_llm_seconds": 2,
+        "short_seconds": 15,
+        "short_context_fraction": 0.5,
+        "short_max_tokens": 400,
+        **overrides,
+    })
+
+class _RecordingChatModel(FakeToolCallingChatModel):
+    """ Chat model which records the arguments of its calls."""
+
+    calls: list = []
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(kwargs)
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+def test_deadline_from_headers_and_budgets():
+    """ Test that the deadline is read from the header, capped and defaulted, and that the
+        searches end before the time kept for the LLM call."""
+
+    options = _options()
+
+    assert Deadline.from_headers({"X-Request-Timeout": "45"}, options).remaining() == pytest.approx(45, abs=0.1)
+    assert Deadline.from_headers({"X-Request-Timeout": "600"}, options).remaining() == pytest.approx(60, abs=0.1)
+    assert Deadline.from_headers({"X-Request-Timeout": "soon"}, options).remaining() == pytest.approx(30, abs=0.1)
+    for value in ["nan", "inf", "-inf"]:
+        assert Deadline.from_headers({"X-Request-Timeout": value}, options).remaining() == pytest.approx(30, abs=0.1)
+    assert Deadline.from_headers({}, _options(enabled=False)) is None
+
+    relaxed, short = Deadline(30, options), Deadline(8, options)
+    assert relaxed.search_timeout(3.0) == 3.0
+    assert short.search_timeout(5.0) == pytest.approx(4.0, abs=0.1)
+    assert (relaxed.short, relaxed.context_token_budget(3000), relaxed.max_tokens(800)) == (False, 3000, 800)
+    assert (short.short, short.context_token_budget(3000), short.max_tokens(800)) == (True, 1500, 400)
+
+def test_short_deadline_shrinks_the_context_and_the_answer():
+    """ Test that a request short on time is answered from a smaller context, with fewer tokens
+        and a timeout of the time left, and that the default answer is returned once too
+        little time is left to call the LLM."""
+
+    model = _RecordingChatModel(calls=[])
+    registry = FakeClientRegistry(fake_multi_index_options(), embedding_size=8)
+    registry.chat_model = lambda deployment: model
+    builder = MultiIndexChatBuilder(fake_multi_index_options(), client_registry=registry)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    pack = Mock(wraps=builder._context_packer.pack) # pylint: disable=protected-access
+    builder._context_packer.pack = pack # pylint: disable=protected-access
+    chat_options = fake_chat_options()
+    chat_options.rated_answer_options.enabled = False
+    chain = build_chain(builder=builder, chat_options=chat_options)
+
+    def ask(seconds):
+        run_config = {"configurable": {DEADLINE: Deadline(seconds, _options())}}
+        return asyncio.run(chain.ainvoke({"question": "How do I prune tomatoes?"}, run_config))
+
+    ask(12)
+    default = ask(1)
+
+    assert pack.call_args_list[0].args[1] == builder.context_token_budget // 2
+    assert model.calls[0]["max_tokens"] == 400
+    assert 0 < model.calls[0]["timeout"] <= 12
+    assert len(model.calls) == 1
+    assert default["answer"] == chat_options.default_return_message
+
+def test_default_answer_is_not_served_to_the_next_caller():
+    """ Test that the default answer given to a request out of time is not reused
+        for the same question asked with time to answer it."""
+
+    model = _RecordingChatModel(calls=[])
+    registry = FakeClientRegistry(fake_multi_index_options(), embedding_size=8)
+    registry.chat_model = lambda deployment: model
+    builder = MultiIndexChatBuilder(fake_multi_index_options(), client_registry=registry)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    chat_options = fake_chat_options()
+    chat_options.rated_answer_options.enabled = False
+    chain = build_chain(builder=builder, chat_options=chat_options)
+    coalescer = RequestCoalescer(
+        RequestCoalescingOptions(enabled=True, result_ttl_seconds=60, max_entries=10), fingerprint="test")
+
+    async def ask(seconds):
+        deadline = Deadline(seconds, _options())
+        return await coalescer.run(
+            "How do I prune tomatoes?",
+            lambda: chain.ainvoke({"question": "How do I prune tomatoes?"}, {"configurable": {DEADLINE: deadline}}),
+            deadline)
+
+    default = asyncio.run(ask(1))
+    answer = asyncio.run(ask(30))
+
+    assert default["answer"] == chat_options.default_return_message
+    assert answer["answer"] != chat_options.default_return_message
+    assert len(model.calls) == 1
+    assert asyncio.run(ask(30)) == answer
+
+def test_disconnect_cancels_the_request(monkeypatch):
+    """ Test that the work of a request is cancelled once its client disconnected."""
+
+    monkeypatch.setattr(main, "DISCONNECT_POLL_SECONDS", 0.01)
+    request = Mock()
+    polls = iter([False, False, True])
+    request.is_disconnected = lambda: asyncio.sleep(0, next(polls))
+    cancelled = []
+
+    async def answer():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        async with main._cancel_on_disconnect(request): # pylint: disable=protected-access
+            await answer()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(scenario())
+
+    assert error.value.status_code == 499
+    assert cancelled
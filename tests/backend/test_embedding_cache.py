@@ -0,0 +1,150 @@
+""" This module contains tests for the embedding cache. """
+
+from unittest.mock import Mock
+import asyncio
+import sqlite3
+import threading
+import time
+import pytest
+from langchain_core.embeddings import Embeddings
+from libs.core.services.ttl_lru_cache import TtlLruCache
+from libs.core.services import embedding_cache
+from libs.core.services.embedding_cache import EmbeddingCache
+from libs.core.services.search_vector_index_service import CachedEmbeddings
+
+MODEL = "text-embedding-ada-002"
+
+@pytest.fixture(name="clock")
+def clock_fixture():
+    """ A clock which only moves when the test advances it."""
+
+    clock = Mock()
+    clock.return_value = 0.0
+    return clock
+
+def test_lru_eviction():
+    """ Test that the least recently used entry is evicted when the cache is full."""
+
+    cache = TtlLruCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+def test_ttl_expiry(clock):
+    """ Test that entries expire after their time to live."""
+
+    cache = TtlLruCache(max_entries=10, ttl_seconds=60, clock=clock)
+    cache.set("a", 1)
+    clock.return_value = 59.0
+    assert cache.get("a") == 1
+    clock.return_value = 60.0
+    assert cache.get("a") is None
+    assert cache.evictions == 1
+
+def test_key_is_normalized():
+    """ Test that equivalent questions share a key, but different models do not."""
+
+    assert EmbeddingCache.key(" How do I  prune\ttomatoes? ", MODEL) == \
+        EmbeddingCache.key("how do i prune tomatoes?", MODEL)
+    assert EmbeddingCache.key("tomatoes", MODEL) != EmbeddingCache.key("tomatoes", "other-model")
+
+def test_persistent_tier(tmp_path):
+    """ Test that vectors survive a restart through the on-disk tier."""
+
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(max_entries=10, persist_path=path)
+    cache.set("tomatoes", MODEL, [0.25, 0.5])
+    cache.close()
+
+    restarted = EmbeddingCache(max_entries=10, persist_path=path)
+    assert asyncio.run(restarted.aget("Tomatoes", MODEL)) == [0.25, 0.5]
+    assert restarted.stats()["hits"] == 1
+    assert restarted.stats()["persistent_hits"] == 1
+    restarted.close()
+
+def test_persistent_tier_is_pruned(tmp_path):
+    """ Test that the expired vectors and the oldest vectors beyond the size of the
+        on-disk tier are dropped."""
+
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(max_entries=10, persist_path=path)
+    cache.set("expired", MODEL, [1.0])
+    cache.close()
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE embeddings SET created = created - 120")
+
+    cache = EmbeddingCache(max_entries=10, ttl_seconds=60, persist_path=path, persist_max_entries=2)
+    for text in ["first", "second", "third"]:
+        cache.set(text, MODEL, [2.0])
+    cache.close()
+
+    with sqlite3.connect(path) as connection:
+        keys = {key for (key,) in connection.execute("SELECT key FROM embeddings")}
+    assert keys <= {EmbeddingCache.key(text, MODEL) for text in ["first", "second", "third"]}
+    assert len(keys) == 2
+
+def test_writer_survives_failed_writes(tmp_path, monkeypatch):
+    """ Test that a batch which keeps failing is rolled back and dropped, and the writer
+        goes on storing the vectors which come after it."""
+
+    monkeypatch.setattr(embedding_cache, "WRITE_ATTEMPTS", 2)
+    path = str(tmp_path / "embeddings.sqlite")
+    EmbeddingCache(max_entries=10, persist_path=path).close()
+    failing = EmbeddingCache.key("failing", MODEL)
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            f"CREATE TRIGGER failing BEFORE INSERT ON embeddings WHEN NEW.key = '{failing}' "
+            "BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END")
+
+    cache = EmbeddingCache(max_entries=10, persist_path=path)
+    cache.set("failing", MODEL, [1.0])
+    deadline = time.monotonic() + 5.0
+    while cache.stats()["dropped_writes"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    cache.set("tomatoes", MODEL, [2.0])
+    cache.close()
+
+    assert cache.stats()["dropped_writes"] == 1
+    with sqlite3.connect(path) as connection:
+        keys = {key for (key,) in connection.execute("SELECT key FROM embeddings")}
+    assert keys == {EmbeddingCache.key("tomatoes", MODEL)}
+
+def test_full_write_queue_drops_vectors(tmp_path, monkeypatch):
+    """ Test that the vectors stored while the queue of the writer is full are dropped
+        instead of waiting or growing the queue."""
+
+    monkeypatch.setattr(embedding_cache, "MAX_QUEUED_WRITES", 1)
+    resume = threading.Event()
+    write = embedding_cache._SqliteVectorStore._write # pylint: disable=protected-access
+    monkeypatch.setattr(embedding_cache._SqliteVectorStore, "_write", # pylint: disable=protected-access
+        lambda store: resume.wait() and write(store))
+    cache = EmbeddingCache(max_entries=10, persist_path=str(tmp_path / "embeddings.sqlite"))
+    cache.set("queued", MODEL, [1.0])
+    cache.set("tomatoes", MODEL, [2.0])
+
+    assert cache.stats()["dropped_writes"] == 1
+    assert cache.get("tomatoes", MODEL) == [2.0]
+    resume.set()
+    cache.close()
+
+def test_cached_embeddings_batches_misses():
+    """ Test that only uncached texts are embedded, in a single batch."""
+
+    embeddings = Mock(spec=Embeddings)
+    embeddings.embed_documents.side_effect = lambda texts: [[float(len(text))] for text in texts]
+    cache = EmbeddingCache(max_entries=10)
+    cache.set("cached", MODEL, [1.0])
+    cached_embeddings = CachedEmbeddings(embeddings, MODEL, cache)
+
+    vectors = cached_embeddings.embed_documents(["cached", "new", "newer", "new"])
+
+    assert vectors == [[1.0], [3.0], [5.0], [3.0]]
+    embeddings.embed_documents.assert_called_once_with(["new", "newer"])
+    assert cached_embeddings.embed_query("newer") == [5.0]
+    embeddings.embed_query.assert_not_called()
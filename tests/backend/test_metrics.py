@@ -0,0 +1,70 @@
+""" This module contains tests for the metrics and the stage instrumentation. """
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.runnables import RunnableLambda
+from libs.core.services.metrics import MetricsRegistry
+from libs.core.services.stage_metrics import StageMetricsHandler
+from libs.core.services.tracing import request_trace
+from libs.core.services import stage_metrics, tracing
+
+@pytest.fixture(name="registry")
+def registry_fixture():
+    """ An empty metrics registry."""
+
+    return MetricsRegistry()
+
+def test_histogram_renders_cumulative_buckets(registry):
+    """ Test that the buckets are cumulative and the labels are escaped."""
+
+    histogram = registry.histogram("stage_seconds", "Stage latency.", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage='a"b')
+    histogram.observe(0.5, stage='a"b')
+    histogram.observe(5.0, stage='a"b')
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE stage_seconds histogram" in lines
+    assert 'stage_seconds_bucket{stage="a\\"b",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="a\\"b",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="a\\"b",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="a\\"b"} 3' in lines
+
+def test_handler_records_stages_and_token_usage(monkeypatch, registry):
+    """ Test that named stages and the LLM token usage are recorded,
+        and the runnables which only compose the stages are not."""
+
+    stage_seconds = registry.histogram("stages", "Stages.", ("stage",))
+    llm_tokens = registry.counter("tokens", "Tokens.", ("model", "kind"))
+    monkeypatch.setattr(stage_metrics, "STAGE_SECONDS", stage_seconds)
+    monkeypatch.setattr(stage_metrics, "LLM_TOKENS", llm_tokens)
+    handler = StageMetricsHandler()
+
+    chain = RunnableLambda(lambda x: x, name="get_documents") | RunnableLambda(lambda x: x, name="format_docs")
+    chain.invoke({}, {"callbacks": [handler]})
+    handler.on_llm_end(
+        LLMResult(
+            generations=[[ChatGeneration(message=AIMessage(content=""))]],
+            llm_output={"model_name": "gpt", "token_usage": {"prompt_tokens": 12, "completion_tokens": 3}}),
+        run_id=None)
+
+    rendered = registry.render()
+
+    assert 'stages_count{stage="get_documents"} 1' in rendered
+    assert 'stages_count{stage="format_docs"} 1' in rendered
+    assert "RunnableSequence" not in rendered
+    assert 'tokens{model="gpt",kind="prompt"} 12' in rendered
+    assert 'tokens{model="gpt",kind="completion"} 3' in rendered
+
+def test_request_trace_keeps_valid_trace_ids():
+    """ Test that a trace ID passed in is kept, and an unusable one is replaced."""
+
+    with request_trace("POST /chat", {"X-Trace-Id": "abc-123"}, "X-Trace-Id") as trace_id:
+        assert trace_id == "abc-123"
+        assert tracing.current_trace_id() == "abc-123"
+
+    with request_trace("POST /chat", {"X-Trace-Id": "bad id\n"}, "X-Trace-Id") as trace_id:
+        assert len(trace_id) == 32
+
+    assert tracing.current_trace_id() is None
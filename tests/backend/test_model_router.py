@@ -0,0 +1,101 @@
+""" This module contains tests for routing the LLM call across chat deployments. """
+
+from unittest.mock import Mock
+import httpx
+import pytest
+from langchain_core.prompts import ChatPromptTemplate
+from openai import RateLimitError
+from libs.core.approaches.chat_conversation import build_answer_chain
+from libs.core.approaches.model_router import ModelRouter, classify_question
+from libs.core.models.options import ModelRouteOptions, ModelRouterOptions
+from libs.core.services.resilience import Upstream
+from models.chat_response import ApproachType
+from tests.backend.perf.fakes import FAKE_CITED_ANSWER, FakeToolCallingChatModel
+
+class _ThrottledChatModel(FakeToolCallingChatModel):
+    """ Chat model whose every call is throttled."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise RateLimitError(
+            "Rate limit reached",
+            response=httpx.Response(429, request=httpx.Request("POST", "https://openai.invalid")),
+            body=None)
+
+@pytest.fixture(name="builder")
+def builder_fixture():
+    """ A builder which counts a token per word and hands out a fake model per deployment."""
+
+    models = {"small": FakeToolCallingChatModel(), "large": FakeToolCallingChatModel()}
+    builder = Mock()
+    builder.count_tokens = lambda text: len(text.split())
+    builder.llm = lambda deployment=None: models[deployment]
+    builder.upstream = Upstream
+    builder.chat_template = lambda system_prompt: ChatPromptTemplate.from_messages(
+        [("system", system_prompt), ("human", "{question}")])
+    builder.models = models
+    return builder
+
+def _router(builder):
+    options = ModelRouterOptions(
+        enabled=True,
+        latency_ewma_alpha=0.5,
+        throttle_cooldown_seconds=60,
+        routes=[
+            ModelRouteOptions(deployment="small", context_window=100, max_tokens=20,
+                approaches=["CHIT_CHAT", "UNSTRUCTURED"], max_question_tokens=10, max_latency_seconds=2.0),
+            ModelRouteOptions(deployment="large", context_window=1000, max_tokens=50,
+                approaches=["STRUCTURED", "UNSTRUCTURED"]),
+        ])
+    return ModelRouter(options, builder, "Answer from {context}")
+
+def _deployments(router, question, context=""):
+    return [route.deployment for route in router.select({"question": question, "context": context})]
+
+def test_classification():
+    """ Test the classification of greetings, follow ups, structured and other questions,
+        where the markers only match whole words."""
+
+    assert classify_question("Hello!") == ApproachType.CHIT_CHAT.name
+    assert classify_question("Tell me more about that") == ApproachType.CONTINUATION.name
+    assert classify_question("Compare pruning and topping") == ApproachType.STRUCTURED.name
+    assert classify_question("Why do tomatoes split?") == ApproachType.UNSTRUCTURED.name
+    assert classify_question("Tomatoes vs. peppers: which need more water?") == ApproachType.STRUCTURED.name
+    assert classify_question("List the steps to repot a basil plant") == ApproachType.STRUCTURED.name
+    for question in [
+        "Which vegetable grows well next to tomatoes?",
+        "Is my container app stable?",
+        "Why are there footsteps in my garden?",
+        "Should I go online to buy seeds?",
+    ]:
+        assert classify_question(question) == ApproachType.UNSTRUCTURED.name
+
+def test_routes_by_question_context_latency_and_throttling(builder):
+    """ Test that simple questions go to the first route, and the others when it cannot answer."""
+
+    router = _router(builder)
+
+    assert _deployments(router, "Why do tomatoes split?") == ["small", "large"]
+    assert _deployments(router, "Compare pruning and topping") == ["large", "small"]
+    assert _deployments(router, "Why " * 11) == ["large", "small"]
+    assert _deployments(router, "Why do tomatoes split?", context="word " * 80) == ["large"]
+
+    router.record_latency("small", 3.0)
+    assert _deployments(router, "Why do tomatoes split?")[0] == "large"
+
+    router.record_latency("small", 0.5)
+    router.record_throttle("small")
+    assert _deployments(router, "Why do tomatoes split?") == ["large"]
+
+def test_throttled_deployment_falls_back(builder):
+    """ Test that a 429 from the chosen deployment is answered by the next route and skips it afterwards."""
+
+    builder.models["small"] = _ThrottledChatModel()
+    router = _router(builder)
+    chat_options = Mock(system_prompt="Answer from {context}")
+    answer_chain = build_answer_chain(builder, chat_options, router)
+
+    answer = answer_chain.invoke({"question": "Why do tomatoes split?", "context": "source"})
+
+    assert answer == FAKE_CITED_ANSWER
+    assert router.stats()["small"]["throttled"]
+    assert router.stats()["large"]["calls"] == 1
@@ -0,0 +1,65 @@
+""" This module contains tests for searching several indexes with a timeout per index. """
+
+import asyncio
+import time
+import pytest
+from libs.core.approaches import multi_index_chat_builder
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from tests.backend.perf.fakes import FakeAzureSearch, FakeClientRegistry, fake_multi_index_options
+
+QUERY = {"question": "How do I prune tomatoes?", "embedding": [0.1] * 8}
+TIMEOUT = 0.2
+
+def _builder():
+    options = fake_multi_index_options()
+    options.indexes[1].timeout_seconds = TIMEOUT
+    registry = FakeClientRegistry(options, embedding_size=8)
+    registry._fake_search_clients["primary"] = FakeAzureSearch(0, index_name="primary") # pylint: disable=protected-access
+    registry._fake_search_clients["secondary"] = FakeAzureSearch( # pylint: disable=protected-access
+        1, latency=1.0, index_name="secondary")
+    return MultiIndexChatBuilder(options, client_registry=registry)
+
+@pytest.fixture(name="builder")
+def builder_fixture():
+    """ A builder whose primary index answers at once, and whose secondary index takes
+        a second, far beyond its timeout."""
+
+    return _builder()
+
+def _assert_partial(result):
+    assert result["dropped_indexes"] == ["secondary"]
+    assert list(result["documents"]) == ["primary"]
+    assert result["documents"]["primary"]
+
+def test_slow_index_is_dropped(builder):
+    """ Test that the index which misses its timeout is dropped, and the documents of
+        the other index are kept, without waiting for the slow search."""
+
+    start = time.monotonic()
+    result = builder.get_documents(QUERY)
+
+    assert time.monotonic() - start < TIMEOUT + 0.3
+    _assert_partial(result)
+
+def test_slow_index_is_dropped_async(builder):
+    """ Test the same with the async search."""
+
+    start = time.monotonic()
+    result = asyncio.run(builder.aget_documents(QUERY))
+
+    assert time.monotonic() - start < TIMEOUT + 0.3
+    _assert_partial(result)
+
+def test_index_without_free_threads_is_dropped_at_once(monkeypatch):
+    """ Test that an index whose searches still hold all its threads is dropped without
+        waiting for its timeout, while the other index is still searched."""
+
+    monkeypatch.setattr(multi_index_chat_builder, "SEARCH_THREADS_PER_INDEX", 1)
+    builder = _builder()
+    _assert_partial(builder.get_documents(QUERY))
+
+    start = time.monotonic()
+    result = builder.get_documents(QUERY)
+
+    assert time.monotonic() - start < TIMEOUT / 2
+    _assert_partial(result)
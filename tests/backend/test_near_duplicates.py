@@ -0,0 +1,59 @@
+""" This module contains tests for dropping near-duplicate documents before the top k is taken. """
+
+import pytest
+from langchain_core.documents import Document
+from libs.core.models.options import DeduplicationOptions
+from libs.core.services.near_duplicates import NearDuplicateFilter
+from libs.core.services.top_k_merge import merge_top_k
+
+PRUNING = ("Prune the suckers which grow in the joint where a leaf branch meets the main stem "
+    "of the tomato plant, once they are a few centimetres long, so the plant puts its energy "
+    "into the fruit rather than into new foliage.")
+WATERING = ("Water tomatoes deeply at the base twice a week rather than a little every day, "
+    "and keep the leaves dry to prevent blight from spreading through the crop.")
+MULCHING = ("A layer of straw mulch keeps the soil moist and warm, suppresses weeds and stops "
+    "soil splashing onto the lower leaves when it rains.")
+
+@pytest.fixture(name="near_duplicates")
+def near_duplicates_fixture():
+    """ A filter with the configured defaults."""
+
+    return NearDuplicateFilter(DeduplicationOptions(enabled=True))
+
+def _document(content, reranker_score):
+    return (Document(page_content=content), 0.0, reranker_score)
+
+def test_signatures_estimate_the_similarity(near_duplicates):
+    """ Test that the signatures estimate the Jaccard similarity of the shingles of two texts."""
+
+    def similarity(first, second):
+        return (near_duplicates.signature(first) == near_duplicates.signature(second)).mean()
+
+    def jaccard(first, second):
+        first, second = set(near_duplicates.shingles(first)), set(near_duplicates.shingles(second))
+        return len(first & second) / len(first | second)
+
+    respelled = PRUNING.replace("a few centimetres", "a few centimeters")
+    assert similarity(PRUNING, respelled) == pytest.approx(jaccard(PRUNING, respelled), abs=0.1)
+    assert similarity(PRUNING, WATERING) < 0.1
+    assert near_duplicates.signature("  ") is None
+
+def test_near_duplicates_across_indexes_keep_the_best_scored_copy(near_duplicates):
+    """ Test that the near-duplicates of both indexes collapse into the best scored copy,
+        and the top k is filled with distinct documents."""
+
+    ranked_documents = {
+        "aca-data": [_document(PRUNING, 3.5), _document(WATERING, 3.0), _document(PRUNING + " Use clean shears.", 2.9)],
+        "garden-data": [_document("Tomatoes: " + PRUNING, 3.8), _document(MULCHING, 2.0)],
+    }
+
+    merged = merge_top_k(ranked_documents, 3, unique=near_duplicates.unique)
+
+    assert [document[2] for document in merged] == [3.8, 3.0, 2.0]
+    assert [document[0].page_content for document in merged] == ["Tomatoes: " + PRUNING, WATERING, MULCHING]
+
+def test_bands_must_divide_the_hashes():
+    """ Test that a signature which cannot be split into the bands is rejected."""
+
+    with pytest.raises(ValueError):
+        NearDuplicateFilter(DeduplicationOptions(enabled=True, num_hashes=64, bands=10))
@@ -0,0 +1,78 @@
+""" This module contains tests for answering from previously rated responses. """
+
+import asyncio
+from unittest.mock import Mock
+import pytest
+from langchain_core.documents import Document
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from tests.backend.perf.fakes import (
+    FakeClientRegistry,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+STORAGE = "https://fakeaccount.blob.core.windows.net"
+QUERY = {"question": "How do I prune tomatoes?", "embedding": [0.1] * 8}
+
+def _rating(label, score, citations=None):
+    metadata = {"response": f"{label} answer", "citations": citations or [], "labels": [f"rating:{label}"]}
+    return (Document(page_content=QUERY["question"], metadata=metadata), score)
+
+@pytest.fixture(name="ratings")
+def ratings_fixture():
+    """ The ratings found for the question, in a local mirror of the ratings index."""
+
+    return []
+
+@pytest.fixture(name="builder")
+def builder_fixture(ratings):
+    """ A builder which looks the ratings up in the local mirror."""
+
+    mirror = Mock(ready=True)
+    mirror.search.side_effect = lambda embedding, k: ratings
+    builder = MultiIndexChatBuilder(
+        fake_multi_index_options(),
+        client_registry=FakeClientRegistry(fake_multi_index_options(), embedding_size=8),
+        ratings_mirror=mirror)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    return builder
+
+def test_thumbs_up_above_the_threshold_is_the_answer(builder, ratings):
+    """ Test that the best thumbs-up rating above min_score is returned, unless a
+        thumbs-down rating outranks it, and that nothing is returned below min_score
+        or without ratings."""
+
+    options = fake_chat_options().rated_answer_options
+    ratings.extend([_rating("thumbs-up", 0.97), _rating("thumbs-down", 0.96)])
+    assert builder.get_rated_answer(options, QUERY)["answer"] == "thumbs-up answer"
+
+    ratings[:] = [_rating("thumbs-up", 0.96), _rating("thumbs-down", 0.98)]
+    assert builder.get_rated_answer(options, QUERY) is None
+
+    ratings[:] = [_rating("thumbs-up", options.min_score - 0.01)]
+    assert builder.get_rated_answer(options, QUERY) is None
+
+    ratings.clear()
+    assert builder.get_rated_answer(options, QUERY) is None
+
+def test_rated_citations_are_signed_again_only_for_the_index_containers(builder, ratings):
+    """ Test that the citations of a rated answer are signed again when they point into a
+        container of the indexes, and dropped when they point anywhere else."""
+
+    ratings.append(_rating("thumbs-up", 0.99, citations=[
+        {"title": "Pruning", "url": f"{STORAGE}/docs/pruning.pdf?sig=expired"},
+        {"title": "Secrets", "url": f"{STORAGE}/private/keys.txt?sig=expired"},
+        {"title": "Escape", "url": f"{STORAGE}/docs/../private/keys.txt"},
+        {"title": "Elsewhere", "url": "https://attacker.invalid/docs/pruning.pdf"},
+    ]))
+    options = fake_chat_options().rated_answer_options
+
+    answer = asyncio.run(builder.aget_rated_answer(options, QUERY))
+
+    assert answer["served_from_cache"]
+    assert answer["citations"] == [{
+        "title": "Pruning",
+        "url": f"{STORAGE}/docs/pruning.pdf?sv=2024-01-01&sr=b&sig=docs-pruning.pdf",
+    }]
+    assert builder.get_rated_answer(options, QUERY)["citations"] == answer["citations"]
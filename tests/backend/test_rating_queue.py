@@ -0,0 +1,69 @@
+""" This module contains tests for the rating ingestion queue. """
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+import pytest
+from libs.core.models.options import RatingQueueOptions
+from libs.core.services.rating_queue import RatingQueue
+
+@pytest.fixture(name="ratings_index")
+def ratings_index_fixture():
+    """ A ratings index which records the uploaded batches."""
+
+    index = Mock()
+    index.aadd_texts = AsyncMock(side_effect=lambda texts, metadatas, keys: keys)
+    return index
+
+def _queue(ratings_index, batch_size=10):
+    registry = Mock()
+    registry.asearch_client = AsyncMock(return_value=ratings_index)
+    options = RatingQueueOptions(batch_size=batch_size, flush_interval_seconds=60, max_pending=100)
+    return RatingQueue(options, registry, "ratings")
+
+def test_duplicates_are_stored_once(ratings_index):
+    """ Test that identical ratings share a document and are uploaded once, in one batch."""
+
+    queue = _queue(ratings_index)
+    first = queue.submit("1", True, "question", "answer")
+    second = queue.submit("2", True, "question", "answer")
+    queue.submit("3", False, "question", "answer")
+
+    asyncio.run(queue.flush())
+
+    assert first["output"] == second["output"]
+    ratings_index.aadd_texts.assert_awaited_once()
+    assert ratings_index.aadd_texts.await_args.kwargs["texts"] == ["question", "question"]
+    assert queue.stats()["duplicates"] == 1
+    assert queue.stats()["queue_depth"] == 0
+
+def test_full_batch_is_flushed_without_waiting(ratings_index):
+    """ Test that a full batch is stored before the flush interval passes."""
+
+    async def scenario():
+        queue = _queue(ratings_index, batch_size=2)
+        await queue.astart()
+        queue.submit("1", True, "first", "answer")
+        queue.submit("2", True, "second", "answer")
+        await asyncio.sleep(0.1)
+        depth = queue.stats()["queue_depth"]
+        queue.submit("3", True, "third", "answer")
+        await queue.aclose()
+        return depth, queue.stats()
+
+    depth, stats = asyncio.run(scenario())
+
+    assert depth == 0
+    assert stats["flushed"] == 3
+    assert stats["batches"] == 2
+
+def test_failed_batch_is_kept_for_retry(ratings_index):
+    """ Test that ratings stay queued when the ratings index cannot be reached."""
+
+    ratings_index.aadd_texts.side_effect = ConnectionError
+    queue = _queue(ratings_index)
+    queue.submit("1", True, "question", "answer")
+
+    asyncio.run(queue.flush())
+
+    assert queue.stats()["queue_depth"] == 1
+    assert queue.stats()["failed"] == 1
@@ -0,0 +1,115 @@
+""" This module contains tests for the local mirror of the ratings index. """
+
+import asyncio
+import json
+import re
+from unittest.mock import AsyncMock, Mock
+import pytest
+from libs.core.models.options import RatingsMirrorOptions
+from libs.core.services.ratings_mirror import RatingsMirror
+
+class _AsyncResults:
+    def __init__(self, results):
+        self._results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration as stop:
+            raise StopAsyncIteration from stop
+
+class _RatingsIndex:
+    """ Ratings index answering the id listing and the filtered fetches of the mirror."""
+
+    def __init__(self):
+        self.documents = {}
+        self.fetched_ids = []
+        self.async_client = Mock()
+        self.async_client.search = AsyncMock(side_effect=self._search)
+
+    def add(self, document_id, vector, response):
+        self.documents[document_id] = {
+            "id": document_id,
+            "content": f"question {document_id}",
+            "content_vector": vector,
+            "metadata": json.dumps({"response": response, "labels": ["rating:thumbs-up"]}),
+        }
+
+    async def _search(self, search_text, select, filter=None, top=None): # pylint: disable=redefined-builtin
+        if filter is None:
+            return _AsyncResults([{"id": document_id} for document_id in self.documents])
+        ids = re.search(r"'([^']*)'", filter).group(1).split(",")
+        self.fetched_ids.extend(ids)
+        return _AsyncResults([dict(self.documents[i]) for i in ids if i in self.documents])
+
+@pytest.fixture(name="ratings_index")
+def ratings_index_fixture():
+    """ A ratings index holding two ratings."""
+
+    index = _RatingsIndex()
+    index.add("a", [1.0, 0.0, 0.0], "answer a")
+    index.add("b", [0.0, 1.0, 0.0], "answer b")
+    return index
+
+def _mirror(ratings_index, path):
+    registry = Mock()
+    registry.asearch_client = AsyncMock(return_value=ratings_index)
+    options = RatingsMirrorOptions(enabled=True, path=str(path), sync_interval_seconds=60)
+    return RatingsMirror(options, registry, "ratings")
+
+def _sync(mirror):
+    async def run():
+        assert mirror._try_lead() # pylint: disable=protected-access
+        await mirror.sync()
+        mirror.reload()
+    asyncio.run(run())
+
+def test_sync_fetches_only_new_rows(ratings_index, tmp_path):
+    """ Test that the search is scored like the index, and a second sync only fetches new ratings."""
+
+    mirror = _mirror(ratings_index, tmp_path)
+    _sync(mirror)
+
+    [(document, score)] = mirror.search([2.0, 0.0, 0.0], 1)
+    assert document.metadata["response"] == "answer a"
+    assert score == pytest.approx(1.0)
+
+    ratings_index.add("c", [0.0, 0.0, 1.0], "answer c")
+    ratings_index.fetched_ids.clear()
+    _sync(mirror)
+
+    assert ratings_index.fetched_ids == ["c"]
+    assert [d.metadata["response"] for d, _ in mirror.search([0.0, 0.6, 0.8], 2)] == ["answer c", "answer b"]
+
+def test_removed_rows_are_dropped(ratings_index, tmp_path):
+    """ Test that ratings removed from the index are no longer returned."""
+
+    mirror = _mirror(ratings_index, tmp_path)
+    _sync(mirror)
+    del ratings_index.documents["a"]
+    _sync(mirror)
+
+    assert [d.metadata["response"] for d, _ in mirror.search([1.0, 0.0, 0.0], 5)] == ["answer b"]
+    assert len(list(tmp_path.glob("vectors-*.f32"))) == 1
+
+def test_followers_share_the_leaders_files(ratings_index, tmp_path):
+    """ Test that a second worker cannot take the sync lock but searches the synced files,
+        without reading the ids or payloads of the rows when it loads them."""
+
+    leader = _mirror(ratings_index, tmp_path)
+    _sync(leader)
+    follower = _mirror(ratings_index, tmp_path)
+
+    assert not follower._try_lead() # pylint: disable=protected-access
+    follower.reload()
+    assert follower.ready
+    assert follower.stats()["rows"] == 2
+    # The followers only read the size of the mirror, the rows are mapped from the other files.
+    assert json.loads((tmp_path / "metadata.json").read_text()) == {"generation": 0, "dimensions": 3, "rows": 2}
+    assert follower.search([0.0, 1.0, 0.0], 1)[0][0].metadata["response"] == "answer b"
+
+    asyncio.run(leader.aclose())
+    assert follower._try_lead() # pylint: disable=protected-access
@@ -0,0 +1,146 @@
+""" This module contains tests for coalescing identical chat requests. """
+
+import asyncio
+from unittest.mock import Mock
+import pytest
+from libs.core.models.options import RequestCoalescingOptions
+from libs.core.services.request_coalescer import RequestCoalescer
+
+@pytest.fixture(name="coalescer")
+def coalescer_fixture():
+    """ A coalescer which keeps results for a minute."""
+
+    options = RequestCoalescingOptions(enabled=True, result_ttl_seconds=60, max_entries=10)
+    return RequestCoalescer(options, fingerprint="test")
+
+class _Chain:
+    """ Counts the executions and blocks each one until it is released."""
+
+    def __init__(self, error: Exception | None = None, result: dict | None = None):
+        self.calls = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+        self._error = error
+        self._result = result or {"answer": "Prune the suckers."}
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self._error:
+            raise self._error
+        return self._result
+
+def test_identical_requests_share_one_execution(coalescer):
+    """ Test that concurrent identical requests run once and repeats are served from the cache."""
+
+    async def run():
+        chain = _Chain()
+        requests = [
+            asyncio.create_task(coalescer.run(text, chain))
+            for text in ("How do I prune tomatoes?", "how do i  prune TOMATOES?", "How do I prune tomatoes?")
+        ]
+        await asyncio.sleep(0)
+        chain.release.set()
+        results = await asyncio.gather(*requests)
+        repeat = await coalescer.run("How do I prune tomatoes?", chain)
+        return chain.calls, results, repeat
+
+    calls, results, repeat = asyncio.run(run())
+
+    assert calls == 1
+    assert all(result == {"answer": "Prune the suckers."} for result in results)
+    assert repeat == results[0]
+
+def test_failures_are_shared_but_not_cached(coalescer):
+    """ Test that every waiting caller gets the failure and the next request runs again."""
+
+    async def run():
+        chain = _Chain(error=RuntimeError("search failed"))
+        requests = [asyncio.create_task(coalescer.run("question", chain)) for _ in range(2)]
+        await asyncio.sleep(0)
+        chain.release.set()
+        results = await asyncio.gather(*requests, return_exceptions=True)
+
+        retry = _Chain()
+        retry.release.set()
+        return results, await coalescer.run("question", retry), retry.calls
+
+    results, retried, retry_calls = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retried == {"answer": "Prune the suckers."}
+    assert retry_calls == 1
+
+def test_degraded_results_are_shared_but_not_cached(coalescer):
+    """ Test that a default answer given instead of failing reaches the waiting callers,
+        and the next request runs again."""
+
+    async def run():
+        chain = _Chain(result={"answer": "Sorry.", "degraded": True})
+        requests = [asyncio.create_task(coalescer.run("question", chain)) for _ in range(2)]
+        await asyncio.sleep(0)
+        chain.release.set()
+        results = await asyncio.gather(*requests)
+
+        retry = _Chain()
+        retry.release.set()
+        return results, chain.calls, await coalescer.run("question", retry)
+
+    results, calls, retried = asyncio.run(run())
+
+    assert calls == 1
+    assert all(result["degraded"] for result in results)
+    assert retried == {"answer": "Prune the suckers."}
+
+def test_short_deadlines_do_not_share_full_executions(coalescer):
+    """ Test that callers short on time and callers with time to spare never wait on each
+        other's execution, and that the shortened answers are not cached."""
+
+    short, relaxed = Mock(short=True), Mock(short=False)
+
+    async def run():
+        full_chain, short_chain = _Chain(), _Chain(result={"answer": "Prune."})
+        requests = [
+            asyncio.create_task(coalescer.run("question", full_chain, relaxed)),
+            asyncio.create_task(coalescer.run("question", short_chain, short)),
+            asyncio.create_task(coalescer.run("question", short_chain, short)),
+        ]
+        await asyncio.sleep(0)
+        short_chain.release.set()
+        await asyncio.gather(*requests[1:])
+        full_chain.release.set()
+        results = await asyncio.gather(*requests)
+        repeat = await coalescer.run("question", _Chain(), short)
+        return full_chain.calls, short_chain.calls, results, repeat
+
+    full_calls, short_calls, results, repeat = asyncio.run(run())
+
+    assert (full_calls, short_calls) == (1, 1)
+    assert [result["answer"] for result in results] == ["Prune the suckers.", "Prune.", "Prune."]
+    assert repeat == {"answer": "Prune the suckers."}
+
+def test_execution_is_cancelled_when_every_caller_leaves(coalescer):
+    """ Test that the shared execution keeps running while a caller waits, and stops when none do."""
+
+    async def run():
+        chain = _Chain()
+        first = asyncio.create_task(coalescer.run("question", chain))
+        second = asyncio.create_task(coalescer.run("question", chain))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        still_running = not chain.cancelled
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0)
+        return still_running, chain.cancelled, coalescer.stats()["in_flight"]
+
+    still_running, cancelled, in_flight = asyncio.run(run())
+
+    assert still_running
+    assert cancelled
+    assert in_flight == 0
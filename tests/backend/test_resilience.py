@@ -0,0 +1,199 @@
+""" This module contains tests for the retries, circuit breakers and hedged requests of the upstream calls. """
+
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ServiceResponseError
+from azure.search.documents import SearchClient
+from openai import RateLimitError
+from libs.core.services import client_registry
+from libs.core.approaches.chat_conversation import build_chain
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import ResilienceOptions, UpstreamPolicyOptions
+from libs.core.services.resilience import CircuitOpenError, Resilience, Upstream
+from tests.backend.perf.fakes import (
+    FakeClientRegistry,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+def _policy(**overrides) -> UpstreamPolicyOptions:
+    return UpstreamPolicyOptions(**{
+        "timeout_seconds": 1.0,
+        "max_retries": 2,
+        "backoff_base_seconds": 0.001,
+        "backoff_max_seconds": 0.01,
+        "failure_threshold": 2,
+        "open_seconds": 60,
+        **overrides,
+    })
+
+def _throttled(retry_after: str = "0.005") -> RateLimitError:
+    return RateLimitError(
+        "Rate limit reached",
+        response=httpx.Response(429, headers={"retry-after": retry_after},
+            request=httpx.Request("POST", "https://search.invalid")),
+        body=None)
+
+@pytest.fixture(name="calls")
+def calls_fixture():
+    """ The calls made to a fake upstream, which fails with the queued errors before it answers."""
+
+    return {"count": 0, "errors": []}
+
+def _fake_call(calls, latency: float = 0.0):
+    async def call():
+        calls["count"] += 1
+        await asyncio.sleep(latency)
+        if calls["errors"]:
+            raise calls["errors"].pop(0)
+        return calls["count"]
+    return call
+
+def test_throttled_calls_are_retried(calls):
+    """ Test that throttled and timed out calls are retried, and bad requests are not."""
+
+    upstream = Upstream("search", _policy())
+    calls["errors"] = [_throttled(), TimeoutError()]
+    assert asyncio.run(upstream.acall(_fake_call(calls))) == 3
+
+    calls["errors"] = [ValueError("bad request")]
+    with pytest.raises(ValueError):
+        asyncio.run(upstream.acall(_fake_call(calls)))
+
+    assert upstream.stats()["retries"] == 2
+    assert upstream.stats()["circuit"] == "closed"
+
+def test_open_circuit_fails_fast_until_a_trial_succeeds(calls):
+    """ Test that the circuit opens after consecutive failed calls, fails the calls without
+        making them, and closes once the trial call after open_seconds succeeds."""
+
+    upstream = Upstream("search", _policy(max_retries=0, open_seconds=0.05))
+    for _ in range(2):
+        calls["errors"] = [_throttled()]
+        with pytest.raises(RateLimitError):
+            asyncio.run(upstream.acall(_fake_call(calls)))
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(upstream.acall(_fake_call(calls)))
+    assert calls["count"] == 2
+
+    time.sleep(0.06)
+    assert asyncio.run(upstream.acall(_fake_call(calls))) == 3
+    assert upstream.stats()["circuit"] == "closed"
+
+def test_only_the_trial_call_gives_up_the_trial(calls):
+    """ Test that a call made while the circuit was closed, and cancelled once it opened,
+        leaves the trial of the half open circuit to the call which took it."""
+
+    upstream = Upstream("search", _policy(failure_threshold=1, open_seconds=0.05))
+
+    async def scenario():
+        slow = asyncio.create_task(upstream.acall(_fake_call(calls, latency=0.5)))
+        await asyncio.sleep(0.01)
+        upstream.breaker.record_failure()
+        await asyncio.sleep(0.06)
+        trial = upstream.check()
+        slow.cancel()
+        await asyncio.gather(slow, return_exceptions=True)
+        with pytest.raises(CircuitOpenError):
+            upstream.check()
+        upstream.breaker.release(trial)
+        return trial, upstream.check()
+
+    trial, next_trial = asyncio.run(scenario())
+
+    assert trial is not None
+    assert next_trial not in (None, trial)
+    assert upstream.stats()["circuit"] == "half_open"
+
+class _SlowHandler(BaseHTTPRequestHandler):
+    """ Answers every request after a second, like a hung search service."""
+
+    def do_POST(self): # pylint: disable=invalid-name
+        time.sleep(1.0)
+        self.send_response(200)
+        self.end_headers()
+
+    do_GET = do_POST
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+@pytest.fixture(name="slow_search_endpoint")
+def slow_search_endpoint_fixture():
+    """ The endpoint of a search service which takes a second to answer."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def test_slow_sync_search_times_out(slow_search_endpoint, monkeypatch):
+    """ Test that the sync search clients are created with the timeout of the search policy,
+        so every attempt of a hung search gives up after timeout_seconds."""
+
+    created = {}
+    monkeypatch.setattr(client_registry, "generate_azure_search_client",
+        lambda **kwargs: created.update(kwargs) or kwargs)
+    resilience = Resilience(ResilienceOptions(enabled=True, upstreams={"search": _policy(timeout_seconds=0.2)}))
+    registry = client_registry.ClientRegistry(fake_multi_index_options(), resilience=resilience)
+    registry._embeddings = object() # pylint: disable=protected-access
+    registry.search_client("primary")
+
+    client = SearchClient(slow_search_endpoint, "primary", AzureKeyCredential("fake-key"),
+        **created["search_client_options"])
+    start = time.monotonic()
+    with pytest.raises(ServiceResponseError):
+        resilience.upstream("search").call(lambda: list(client.search(search_text="tomatoes")))
+
+    # Three attempts of 0.2 seconds, far from the second each response takes.
+    assert time.monotonic() - start < 1.0
+    assert resilience.stats()["search"]["retries"] == 2
+
+def test_slow_search_is_hedged(calls):
+    """ Test that a search slower than the hedge percentile of its index is sent again,
+        and the faster response is used."""
+
+    upstream = Upstream("search", _policy(hedge_percentile=50, hedge_min_samples=4))
+
+    async def scenario():
+        for _ in range(4):
+            await upstream.acall(_fake_call(calls, latency=0.01), hedge_key="primary")
+        latencies = iter([0.5, 0.01])
+        async def slow_then_fast():
+            calls["count"] += 1
+            await asyncio.sleep(next(latencies))
+            return calls["count"]
+        start = time.monotonic()
+        result = await upstream.acall(slow_then_fast, hedge_key="primary")
+        return result, time.monotonic() - start
+
+    result, seconds = asyncio.run(scenario())
+
+    assert result == 6
+    assert seconds < 0.3
+    assert upstream.stats()["hedges"] == 1
+    assert upstream.stats()["hedge_wins"] == 1
+
+def test_chain_answers_with_the_default_message_while_the_llm_circuit_is_open():
+    """ Test that the chain returns the default answer without calling the LLM when its circuit is open."""
+
+    resilience = Resilience(ResilienceOptions(enabled=True, upstreams={"openai": _policy(failure_threshold=1)}))
+    registry = FakeClientRegistry(fake_multi_index_options(), embedding_size=8, resilience=resilience)
+    builder = MultiIndexChatBuilder(fake_multi_index_options(), client_registry=registry)
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    chain = build_chain(builder=builder, chat_options=fake_chat_options())
+
+    resilience.upstream("openai").breaker.record_failure()
+    answer = asyncio.run(chain.ainvoke({"question": "How do I prune tomatoes?"}))
+
+    assert answer["answer"] == fake_chat_options().default_return_message
+    assert resilience.stats()["openai"]["rejected"] == 1
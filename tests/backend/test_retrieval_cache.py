@@ -0,0 +1,79 @@
+""" This module contains tests for the cache of index search results. """
+
+from unittest.mock import Mock
+import pytest
+from libs.core.models.options import RetrievalCacheOptions
+from libs.core.services.retrieval_cache import RetrievalCache
+from libs.core.services.search_vector_index_service import search_by_vector
+from tests.backend.perf.fakes import fake_search_results
+
+@pytest.fixture(name="client")
+def client_fixture():
+    """ A search client of the garden-data index which counts its searches."""
+
+    client = Mock()
+    client.index_name = "garden-data"
+    client.semantic_configuration_name = "payload_scoring"
+    client.client.search = Mock(side_effect=lambda top, **_kwargs: fake_search_results("q", top))
+    return client
+
+@pytest.fixture(name="cache")
+def cache_fixture():
+    """ An enabled retrieval cache."""
+
+    return RetrievalCache(RetrievalCacheOptions(enabled=True, ttl_seconds=60, max_entries=100))
+
+def test_repeated_searches_are_cached(client, cache):
+    """ Test that a repeated or smaller search is answered from the cache with fresh documents."""
+
+    first = search_by_vector(client, "How do I prune tomatoes?", [0.1], 5, cache=cache)
+    first[0][0].metadata["file_name"] = "changed.pdf"
+    repeated = search_by_vector(client, "how do I prune  tomatoes?", [0.1], 5, cache=cache)
+    smaller = search_by_vector(client, "How do I prune tomatoes?", [0.1], 2, cache=cache)
+
+    assert client.client.search.call_count == 1
+    assert repeated[0][0].metadata["file_name"] == "doc-0-0.pdf"
+    assert [d[0].page_content for d in smaller] == [d[0].page_content for d in repeated[:2]]
+    assert smaller[0][1:] == repeated[0][1:]
+
+def test_larger_searches_and_filters_miss(client, cache):
+    """ Test that a search for more results, or with other filters, goes to the index."""
+
+    search_by_vector(client, "question", [0.1], 2, cache=cache)
+    search_by_vector(client, "question", [0.1], 5, cache=cache)
+    search_by_vector(client, "question", [0.1], 5, filters="container eq 'docs'", cache=cache)
+
+    assert client.client.search.call_count == 3
+
+def test_invalidation_by_content_version(client, cache):
+    """ Test that a new content version drops the results, and reporting it again does not."""
+
+    key = cache.key("garden-data", "question", None)
+    search_by_vector(client, "question", [0.1], 5, cache=cache)
+
+    assert cache.invalidate("garden-data", "v2") == 1
+    assert cache.invalidate("garden-data", "v2") == 0
+    # Results of a search started before the invalidation are never served.
+    cache.set(key, 5, [])
+    search_by_vector(client, "question", [0.1], 5, cache=cache)
+
+    assert client.client.search.call_count == 2
+
+def test_invalidation_reaches_the_other_workers(client, tmp_path):
+    """ Test that an invalidation received by one worker stops the other workers of the
+        host from serving the old results, through the shared versions file."""
+
+    def worker():
+        return RetrievalCache(RetrievalCacheOptions(
+            enabled=True, ttl_seconds=60, max_entries=100, versions_path=str(tmp_path / "versions.json")))
+
+    first, second = worker(), worker()
+    search_by_vector(client, "question", [0.1], 5, cache=second)
+    search_by_vector(client, "question", [0.1], 5, cache=second)
+    assert client.client.search.call_count == 1
+
+    assert first.invalidate("garden-data", "v2") == 0
+    search_by_vector(client, "question", [0.1], 5, cache=second)
+
+    assert client.client.search.call_count == 2
+    assert second.stats()["versions"] == {"garden-data": "v2"}
@@ -0,0 +1,66 @@
+""" This module contains tests for the SAS token service. """
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, Mock
+import pytest
+from libs.core.models.options import StorageAccountOptions
+from libs.core.services.sas_token_service import SasTokenService
+
+def _options(**kwargs):
+    return StorageAccountOptions(
+        **{"account_name": "account", "account_key": "ZmFrZS1rZXk=", "use_account_key": True} | kwargs)
+
+@pytest.fixture(name="delegation_key")
+def delegation_key_fixture():
+    """ A user delegation key which expires in two hours."""
+
+    key = Mock()
+    key.signed_oid = key.signed_tid = key.signed_service = key.signed_version = "x"
+    key.signed_start = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    key.signed_expiry = (datetime.now(timezone.utc) + timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    key.value = "ZmFrZS1rZXk="
+    return key
+
+def test_tokens_are_reused_per_blob():
+    """ Test that a blob is signed once and other blobs get their own token."""
+
+    service = SasTokenService(_options())
+
+    token = service.get_sas_token_for_blob("a.pdf", "docs")
+
+    assert service.get_sas_token_for_blob("a.pdf", "docs") == token
+    assert service.get_sas_token_for_blob("b.pdf", "docs") != token
+    assert service.stats()["hits"] == 1
+
+def test_container_scope_shares_one_token():
+    """ Test that a container SAS token is shared by every blob in the container."""
+
+    service = SasTokenService(_options(sas_scope="container"))
+
+    token = service.get_sas_token_for_blob("a.pdf", "docs")
+
+    assert service.get_sas_token_for_blob("b.pdf", "docs") == token
+    assert "sr=c" in token
+
+def test_background_refresh_provides_the_delegation_key(delegation_key):
+    """ Test that requests use the key fetched in the background and tokens never outlive it."""
+
+    blob_service_client = Mock(
+        get_user_delegation_key=AsyncMock(return_value=delegation_key), close=AsyncMock())
+
+    async def scenario():
+        service = SasTokenService(_options(use_account_key=False))
+        service._async_blob_service_client = blob_service_client # pylint: disable=protected-access
+        service._async_credential = AsyncMock() # pylint: disable=protected-access
+
+        await service.astart()
+        await asyncio.sleep(0)
+        token = await service.aget_sas_token_for_blob("a.pdf", "docs", expiry=86400)
+        await service.aclose()
+        return token
+
+    token = asyncio.run(scenario())
+
+    blob_service_client.get_user_delegation_key.assert_awaited_once()
+    assert f"se={delegation_key.signed_expiry.replace(':', '%3A')}" in token
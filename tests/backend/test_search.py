@@ -2,11 +2,13 @@
 
 from unittest.mock import Mock
 from typing import List, Tuple
+import asyncio
+import json
 import types
 from langchain_core.documents import Document
 from langchain_community.vectorstores.azuresearch import AzureSearch
 import pytest
-from libs.core.services.search_vector_index_service import search
+from libs.core.services.search_vector_index_service import asearch_by_vector, search, search_by_vector
 
 @pytest.fixture(name="setup")
 def setup_fixture():
@@ -33,3 +35,66 @@ def test_search(setup):
         assert isinstance(item[0], Document)
         assert isinstance(item[1], float)
         assert isinstance(item[2], float)
+
+RESULTS = [
+    {"id": "doc-1", "content": "Prune the suckers.", "metadata": json.dumps({"source": "tomatoes.pdf"}),
+        "@search.score": 0.03, "@search.reranker_score": 3.2},
+    {"id": "doc-2", "content": "Water at the base.", "metadata": {"source": "watering.pdf"},
+        "@search.score": 0.02, "@search.reranker_score": 1.5},
+]
+
+class _AsyncResults:
+    """ The async iterator over the results of a search."""
+
+    def __init__(self, results):
+        self._results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration as error:
+            raise StopAsyncIteration from error
+
+@pytest.fixture(name="vector_client")
+def vector_client_fixture():
+    """ A search client whose index returns RESULTS."""
+
+    client = Mock(spec=AzureSearch)
+    client.semantic_configuration_name = "default"
+    client.client = Mock()
+    client.client.search.return_value = iter(RESULTS)
+    client.async_client = Mock()
+    async def asearch(**_):
+        return _AsyncResults(RESULTS)
+    client.async_client.search = Mock(side_effect=asearch)
+    return client
+
+def _assert_mapped(result):
+    assert [(document.page_content, document.metadata) for document, _, _ in result] == [
+        ("Prune the suckers.", {"id": "doc-1", "source": "tomatoes.pdf"}),
+        ("Water at the base.", {"id": "doc-2", "source": "watering.pdf"}),
+    ]
+    assert [(score, reranker_score) for _, score, reranker_score in result] == [(0.03, 3.2), (0.02, 1.5)]
+
+def test_search_by_vector_maps_the_results(vector_client):
+    """ Test that the results of a search by vector become documents with their id and
+        metadata, and their search and reranker scores."""
+
+    result = search_by_vector(vector_client, "prune", [0.1, 0.2], 2, filters="x eq 1")
+
+    _assert_mapped(result)
+    query = vector_client.client.search.call_args.kwargs
+    assert (query["search_text"], query["filter"], query["top"], query["query_type"]) == ("prune", "x eq 1", 2, "semantic")
+    assert query["vector_queries"][0].vector == [0.1, 0.2]
+    assert query["vector_queries"][0].k_nearest_neighbors == 2
+
+def test_asearch_by_vector_maps_the_results(vector_client):
+    """ Test that the async search by vector maps the results the same way."""
+
+    result = asyncio.run(asearch_by_vector(vector_client, "prune", [0.1, 0.2], 2))
+
+    _assert_mapped(result)
+    assert vector_client.async_client.search.call_args.kwargs["top"] == 2
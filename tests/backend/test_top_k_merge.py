@@ -0,0 +1,53 @@
+""" This module contains tests for merging the ranked results of several indexes. """
+
+import pytest
+from langchain_core.documents import Document
+from libs.core.services.top_k_merge import merge_top_k, normalize_scores
+
+def _ranked(prefix, reranker_scores):
+    return [
+        (Document(page_content=f"{prefix}{i}"), 0.0, reranker_score)
+        for i, reranker_score in enumerate(reranker_scores)
+    ]
+
+@pytest.fixture(name="ranked_documents")
+def ranked_documents_fixture():
+    """ Two indexes whose reranker scores have different ranges."""
+
+    return {
+        "aca-data": _ranked("aca", [3.8, 3.6, 3.5, 1.2]),
+        "garden-data": _ranked("garden", [2.0, 1.9, 0.5]),
+    }
+
+def _contents(documents):
+    return [document[0].page_content for document in documents]
+
+def test_merge_takes_top_k(ranked_documents):
+    """ Test that the merge returns the k best raw scores across indexes."""
+
+    merged = merge_top_k(ranked_documents, 3)
+
+    assert _contents(merged) == ["aca0", "aca1", "aca2"]
+
+def test_merge_normalizes_per_index(ranked_documents):
+    """ Test that normalization lets the best document of each index compete fairly."""
+
+    merged = merge_top_k(ranked_documents, 3, normalization="max")
+
+    assert _contents(merged) == ["aca0", "garden0", "garden1"]
+    assert merged[0][2] == pytest.approx(1.0)
+
+def test_merge_applies_weights_and_min_score(ranked_documents):
+    """ Test that weights scale an index and low raw scores are never used."""
+
+    merged = merge_top_k(
+        ranked_documents, 10, weights={"garden-data": 2.5}, min_score=1.0)
+
+    assert _contents(merged) == ["garden0", "garden1", "aca0", "aca1", "aca2", "aca3"]
+
+def test_min_max_normalization_keeps_order():
+    """ Test that min-max normalization maps each index onto 0 to 1."""
+
+    normalized = normalize_scores(_ranked("aca", [4.0, 3.0, 2.0]), "min_max")
+
+    assert [document[2] for document in normalized] == [1.0, 0.5, 0.0]
@@ -0,0 +1,87 @@
+""" This module contains tests for the warmup of a worker before it reports ready. """
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+import pytest
+from libs.core.approaches.multi_index_chat_builder import MultiIndexChatBuilder
+from libs.core.models.options import RetrievalCacheOptions, WarmupOptions
+from libs.core.services.retrieval_cache import RetrievalCache
+from libs.core.services.warmup import Warmup
+from tests.backend.perf.fakes import (
+    FakeClientRegistry,
+    StubSasTokenService,
+    fake_chat_options,
+    fake_multi_index_options,
+)
+
+def _options(**overrides) -> WarmupOptions:
+    return WarmupOptions(**{
+        "enabled": True,
+        "query": "How do I prune tomatoes?",
+        "timeout_seconds": 1.0,
+        "retry_seconds": 0.0,
+        "max_attempts": 3,
+        **overrides,
+    })
+
+@pytest.fixture(name="registry")
+def registry_fixture():
+    """ A client registry of fake clients which counts the searches of every index."""
+
+    registry = FakeClientRegistry(fake_multi_index_options(), embedding_size=8)
+    for name in ("primary", "secondary", "ratings"):
+        client = registry.search_client(name)
+        client.async_client.search = AsyncMock(wraps=client.async_client.search)
+    return registry
+
+@pytest.fixture(name="builder")
+def builder_fixture(registry):
+    """ A builder of the fake clients, with a retrieval cache and without blob storage."""
+
+    builder = MultiIndexChatBuilder(
+        multi_index_options=fake_multi_index_options(),
+        client_registry=registry,
+        retrieval_cache=RetrievalCache(RetrievalCacheOptions(enabled=True, ttl_seconds=60, max_entries=10)))
+    builder._token_service = StubSasTokenService() # pylint: disable=protected-access
+    return builder
+
+def test_warmup_searches_every_index_and_primes_the_caches(registry, builder):
+    """ Test that every index, the ratings index included, is searched once, and the
+        prime questions are then answered from the retrieval cache."""
+
+    options = _options(prime_questions=["Why do tomatoes split?"])
+    warmup = Warmup(options, builder, registry, fake_chat_options().rated_answer_options)
+
+    asyncio.run(warmup.arun())
+    searches = {name: registry.search_client(name).async_client.search.await_count
+        for name in ("primary", "secondary", "ratings")}
+    vector = registry.embeddings().embed_query("Why do tomatoes split?")
+    asyncio.run(builder.aget_documents({"question": "Why do tomatoes split?", "embedding": vector}))
+
+    assert list(warmup.status()) == ["search_clients", "storage", "embedding", "search", "caches"]
+    assert all(step["status"] == "done" for step in warmup.status().values())
+    assert searches == {"primary": 2, "secondary": 2, "ratings": 1}
+    assert registry.search_client("primary").async_client.search.await_count == 2
+
+def test_failing_steps_are_retried_and_given_up(registry, builder):
+    """ Test that a failing step is run max_attempts times, while the other steps run once."""
+
+    builder.awarm_storage = Mock(side_effect=ConnectionError("key unavailable"))
+    warmup = Warmup(_options(max_attempts=2), builder, registry, fake_chat_options().rated_answer_options)
+
+    asyncio.run(warmup.arun())
+    status = warmup.status()
+
+    assert status["storage"]["status"] == "failed"
+    assert status["storage"]["attempts"] == 2
+    assert "key unavailable" in status["storage"]["error"]
+    assert status["search"] == {**status["search"], "status": "done", "attempts": 1}
+
+def test_disabled_warmup_runs_nothing(registry, builder):
+    """ Test that a disabled warmup has no steps."""
+
+    warmup = Warmup(_options(enabled=False), builder, registry, fake_chat_options().rated_answer_options)
+
+    asyncio.run(warmup.arun())
+
+    assert not warmup.status()